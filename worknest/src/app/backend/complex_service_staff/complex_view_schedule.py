@@ -1,53 +1,386 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from os import environ
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
 
-import requests
+from http_client import ServiceClient, latency_stats, upstream_url
 
 
 
 app = Flask(__name__)
 CORS(app)
 
-event_url = environ.get("EVENT_URL") or "http://localhost:5001/event/public-holiday"
-profile_url = environ.get("PROFILE_URL") or "http://localhost:5002/profile"
-request_url = environ.get("REQUEST_URL") or "http://localhost:5003/request"
+event_url = upstream_url("EVENT_URL", "http://localhost:5001/event/public-holiday")
+profile_url = upstream_url("PROFILE_URL", "http://localhost:5002/profile")
+request_url = upstream_url("REQUEST_URL", "http://localhost:5003/request")
+occurrence_url = upstream_url("OCCURRENCE_URL", "http://localhost:5003/occurrences")
+
+# name -> (pooled client with its own timeouts, error message)
+UPSTREAMS = {
+    "public_holidays": (ServiceClient("event", event_url, read_timeout=float(environ.get("EVENT_TIMEOUT") or 5)), "Failed to fetch events"),
+    "profiles": (ServiceClient("profile", profile_url, read_timeout=float(environ.get("PROFILE_TIMEOUT") or 5)), "Failed to fetch profiles"),
+    "requests": (ServiceClient("request", request_url, read_timeout=float(environ.get("REQUEST_TIMEOUT") or 10)), "Failed to fetch requests"),
+    "occurrences": (ServiceClient("occurrence", occurrence_url, read_timeout=float(environ.get("REQUEST_TIMEOUT") or 10)), "Failed to fetch WFH days"),
+}
+# The unscoped view passes the raw upstream lists through; the joined view needs each WFH
+# day as micro_request materialized it (recurring series included), not the requests
+RAW_UPSTREAMS = ("public_holidays", "profiles", "requests")
+JOINED_UPSTREAMS = ("public_holidays", "profiles", "occurrences")
+
+# Bounded pool so the three upstream calls run side by side
+executor = ThreadPoolExecutor(max_workers=int(environ.get("UPSTREAM_WORKERS") or 12), thread_name_prefix="upstream")
+# Background revalidation gets its own small pool so it never queues in front of live requests
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="snapshot-refresh")
+
+
+# Longest window the joined view will build, in days
+MAX_RANGE_DAYS = int(environ.get("MAX_RANGE_DAYS") or 92)
+
+
+def fetch_upstream(name, params=None, etag=None):
+    """Fetch one upstream and return (data, error, etag); never raises.
+
+    When etag is given the upstream may answer 304, in which case data is NOT_MODIFIED.
+    """
+    client, error_message = UPSTREAMS[name]
+    headers = {"If-None-Match": etag} if etag else None
+    try:
+        response = client.get(params=params, headers=headers)
+        if response.status_code == 304 and etag:
+            return NOT_MODIFIED, None, etag
+        if response.status_code == 200:
+            return response.json(), None, response.headers.get("ETag")
+        return None, error_message, None
+    except Exception as e:
+        return None, f"{error_message}: {e}", None
+
+
+NOT_MODIFIED = object()
+
+# ---------------------------------- Snapshot Cache ----------------------------------
+
+# Entries younger than the refresh interval are fresh; older ones are still served
+# (and refreshed in the background) until they pass the max staleness.
+SNAPSHOT_REFRESH_INTERVAL = float(environ.get("SNAPSHOT_REFRESH_INTERVAL") or 30)
+SNAPSHOT_MAX_STALENESS = float(environ.get("SNAPSHOT_MAX_STALENESS") or 300)
+# Entries nobody asked for in this long are dropped instead of refreshed
+SNAPSHOT_IDLE_EXPIRY = float(environ.get("SNAPSHOT_IDLE_EXPIRY") or 600)
+
+
+class SnapshotEntry:
+    def __init__(self, data, etag, fetched_at):
+        self.data = data
+        self.etag = etag
+        self.fetched_at = fetched_at
+        self.last_used = fetched_at
+
+
+class SnapshotCache:
+    """Stale-while-revalidate snapshot of upstream responses, keyed by upstream and params."""
+
+    def __init__(self, refresh_interval, max_staleness, idle_expiry):
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.idle_expiry = idle_expiry
+        self.entries = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.counters = {"hit": 0, "stale_hit": 0, "miss": 0, "refresh": 0, "revalidated": 0, "refresh_error": 0}
+        self.refresher = None
+
+    def key(self, name, params):
+        return name, tuple(sorted((params or {}).items()))
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get(self, name, params=None):
+        """Return (data, error, age_seconds, state) where state is fresh, stale or miss."""
+        self.start_refresher()
+        key = self.key(name, params)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                entry.last_used = now
+        age = now - entry.fetched_at if entry else None
+
+        if entry and age <= self.refresh_interval:
+            self.count("hit")
+            return entry.data, None, age, "fresh"
+        if entry and age <= self.max_staleness:
+            self.count("stale_hit")
+            refresh_executor.submit(self.refresh, key)
+            return entry.data, None, age, "stale"
+
+        self.count("miss")
+        data, error, etag = fetch_upstream(name, params, entry.etag if entry else None)
+        if data is NOT_MODIFIED:
+            data = entry.data
+        if error:
+            return None, error, None, "miss"
+        self.store(key, data, etag)
+        return data, None, 0.0, "miss"
+
+    def store(self, key, data, etag):
+        with self.lock:
+            entry = SnapshotEntry(data, etag, time.monotonic())
+            previous = self.entries.get(key)
+            if previous:
+                entry.last_used = previous.last_used
+            self.entries[key] = entry
+
+    def refresh(self, key):
+        """Revalidate one entry against its upstream; concurrent refreshes of a key are collapsed."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        try:
+            name, params = key
+            data, error, etag = fetch_upstream(name, dict(params), entry.etag)
+            self.count("refresh")
+            if error:
+                self.count("refresh_error")
+                logging.warning(f"Snapshot refresh of {name} failed: {error}")
+            elif data is NOT_MODIFIED:
+                self.count("revalidated")
+                self.store(key, entry.data, entry.etag)
+            else:
+                self.store(key, data, etag)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def refresh_all(self):
+        now = time.monotonic()
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if now - entry.last_used > self.idle_expiry:
+                    del self.entries[key]
+            due = [key for key, entry in self.entries.items() if now - entry.fetched_at >= self.refresh_interval]
+        for key in due:
+            self.refresh(key)
+
+    def run_refresher(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh_all()
+            except Exception as e:
+                logging.error(f"Snapshot refresher error: {e}")
+
+    def start_refresher(self):
+        if self.refresher is None:
+            with self.lock:
+                if self.refresher is None:
+                    self.refresher = threading.Thread(target=self.run_refresher, name="snapshot-refresher", daemon=True)
+                    self.refresher.start()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.counters = dict.fromkeys(self.counters, 0)
+
+    def metrics(self):
+        with self.lock:
+            counters = dict(self.counters)
+            entries = len(self.entries)
+        lines = []
+        for counter, value in counters.items():
+            lines.append(f"# TYPE view_schedule_snapshot_{counter}_total counter")
+            lines.append(f"view_schedule_snapshot_{counter}_total {value}")
+        lines.append("# TYPE view_schedule_snapshot_entries gauge")
+        lines.append(f"view_schedule_snapshot_entries {entries}")
+        return "\n".join(lines) + "\n"
+
+
+snapshot_cache = SnapshotCache(SNAPSHOT_REFRESH_INTERVAL, SNAPSHOT_MAX_STALENESS, SNAPSHOT_IDLE_EXPIRY)
+
+
+def fetch_all(params=None, names=RAW_UPSTREAMS):
+    """Read the named upstreams through the snapshot cache concurrently.
+
+    Returns ({name: (data, error)}, freshness) where freshness describes the oldest piece of data used.
+    """
+    params = params or {}
+    futures = {name: executor.submit(snapshot_cache.get, name, params.get(name)) for name in names}
+    results = {}
+    ages = []
+    states = set()
+    for name, future in futures.items():
+        data, error, age, state = future.result()
+        results[name] = (data, error)
+        if not error:
+            ages.append(age)
+            states.add(state)
+    freshness = {
+        "age": int(max(ages)) if ages else 0,
+        "state": "stale" if "stale" in states else "miss" if "miss" in states else "fresh",
+    }
+    return results, freshness
+
+
+def with_freshness(response, freshness):
+    """Tell the client how old the snapshot behind this response is."""
+    response.headers["Age"] = str(freshness["age"])
+    response.headers["X-Cache"] = freshness["state"].upper()
+    return response
+
+
+def parse_date(value):
+    """Parse the YYYY-MM-DD used by request/event data (event to_dict emits DD-MM-YYYY).
+
+    Also accepts the HTTP date Flask's jsonify writes for a datetime.date, e.g.
+    "Fri, 01 Mar 2024 00:00:00 GMT", which services without an ISO JSON provider send.
+    """
+    for fmt in ("%Y-%m-%d", "%d-%m-%Y", "%a, %d %b %Y %H:%M:%S GMT"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def upstream_params(args):
+    """Translate the view's scope parameters into the filters each upstream understands."""
+    scope = {}
+    if args.get("department"):
+        scope["department"] = args["department"]
+    if args.get("staff_id"):
+        scope["staff_id"] = args["staff_id"]
+    if args.get("manager_id"):
+        scope["reporting_manager_id"] = args["manager_id"]
+
+    dates = {"start": args["start"], "end": args["end"]}
+    return {
+        "public_holidays": {**({"department": scope["department"]} if "department" in scope else {}), **dates},
+        "profiles": scope,
+        "occurrences": {**scope, **dates, "status": "approved"},
+    }
+
+
+def build_joined_view(start, end, holidays, profiles, occurrences):
+    """Join profiles, approved WFH days and holidays into per-staff, per-day statuses."""
+    dates = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+    holiday_dates = {}
+    for holiday in holidays or []:
+        holiday_date = parse_date(holiday.get("event_date"))
+        if holiday_date:
+            holiday_dates.setdefault(holiday.get("department"), set()).add(holiday_date)
+
+    wfh_dates = {}
+    for occurrence in occurrences or []:
+        if (occurrence.get("status") or "").lower() != "approved":
+            continue
+        occurrence_date = parse_date(occurrence.get("occurrence_date"))
+        if occurrence_date:
+            wfh_dates.setdefault(occurrence["staff_id"], set()).add(occurrence_date)
+
+    schedule = []
+    for profile in profiles:
+        department_holidays = holiday_dates.get(profile.get("department"), set())
+        staff_wfh = wfh_dates.get(profile["staff_id"], set())
+        days = {}
+        for day in dates:
+            if day in department_holidays:
+                days[day.isoformat()] = "holiday"
+            elif day in staff_wfh:
+                days[day.isoformat()] = "wfh"
+            else:
+                days[day.isoformat()] = "office"
+        schedule.append({
+            "staff_id": profile["staff_id"],
+            "staff_name": f"{profile.get('staff_fname')} {profile.get('staff_lname')}",
+            "department": profile.get("department"),
+            "days": days,
+        })
+
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "dates": [day.isoformat() for day in dates],
+        "schedule": schedule,
+    }
+
+
+def get_joined_schedule(args):
+    # /view-schedule?start=YYYY-MM-DD&end=YYYY-MM-DD[&department=..][&staff_id=..][&manager_id=..]
+    if not args.get("start") or not args.get("end"):
+        return jsonify({"error": "start and end are required when scoping the schedule"}), 400
+    start = parse_date(args["start"])
+    end = parse_date(args["end"])
+    if not start or not end or start > end:
+        return jsonify({"error": "Invalid date range, expected start <= end as YYYY-MM-DD"}), 400
+    if (end - start).days + 1 > MAX_RANGE_DAYS:
+        return jsonify({"error": f"Date range cannot exceed {MAX_RANGE_DAYS} days"}), 400
+    args = {**args, "start": start.isoformat(), "end": end.isoformat()}
+
+    results, freshness = fetch_all(upstream_params(args), JOINED_UPSTREAMS)
+    errors = {name: error for name, (_, error) in results.items() if error}
+
+    # Without profiles there is nobody to build a schedule for
+    if "profiles" in errors:
+        return jsonify({"error": "Failed to fetch schedule", "errors": errors}), 500
+
+    joined_view = build_joined_view(
+        start, end,
+        results["public_holidays"][0],
+        results["profiles"][0],
+        results["occurrences"][0],
+    )
+    if errors:
+        joined_view["errors"] = errors
+
+    return with_freshness(jsonify(joined_view), freshness)
+
+
+SCOPE_ARGS = ("department", "start", "end", "staff_id", "manager_id")
+
 
 @app.route('/view-schedule', methods=['GET'])
 def get_schedule():
     try:
-        # Get public holiday events from the event microservice
-        event_response = requests.get(event_url)
-        if event_response.status_code == 200:
-            event_data = event_response.json()
-        else:
-            return jsonify({"error": "Failed to fetch events"}), 500
-        
-        # Get profile information from the profile microservice
-        profile_response = requests.get(profile_url)
-        if profile_response.status_code == 200:
-            profile_data = profile_response.json()
-        else:
-            return jsonify({"error": "Failed to fetch profiles"}), 500
-        
-        # Get request information (WFH requests) from the request microservice
-        request_response = requests.get(request_url)
-        if request_response.status_code == 200:
-            request_data = request_response.json()
-        else:
-            return jsonify({"error": "Failed to fetch requests"}), 500
+        if any(request.args.get(arg) for arg in SCOPE_ARGS):
+            return get_joined_schedule(request.args.to_dict())
+
+        # Issue the event, profile and request calls concurrently so the
+        # latency is bounded by the slowest upstream rather than their sum;
+        # most calls are answered from the snapshot cache without any upstream call
+        results, freshness = fetch_all()
 
         # Create a complex view by merging data from all microservices
-        complex_view = {
-            "public_holidays": event_data,
-            "profiles": profile_data,
-            "requests": request_data
-        }
+        complex_view = {}
+        errors = {}
+        for name, (data, error) in results.items():
+            complex_view[name] = data
+            if error:
+                errors[name] = error
+
+        if len(errors) == len(RAW_UPSTREAMS):
+            return jsonify({"error": "Failed to fetch schedule", "errors": errors}), 500
 
-        return jsonify(complex_view)
+        # Partial failure: return whatever we have and tell the client what is missing
+        if errors:
+            complex_view["errors"] = errors
+
+        return with_freshness(jsonify(complex_view), freshness)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format so the snapshot counters can be scraped
+    return Response(snapshot_cache.metrics() + latency_stats.metrics(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
-    app.run(host="0.0.0.0",port=5000, debug=True)  
\ No newline at end of file
+    app.run(host="0.0.0.0",port=5000, debug=True)
@@ -0,0 +1,57 @@
+import unittest
+import requests
+from unittest.mock import patch, MagicMock
+from http_client import ServiceClient, LatencyStats
+
+def mock_response(status_code):
+    response = MagicMock()
+    response.status_code = status_code
+    return response
+
+class ServiceClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = ServiceClient("test", "http://upstream:5000/items/", connect_timeout=1, read_timeout=2, retries=2)
+
+    @patch('http_client.time.sleep')
+    @patch('http_client.requests.Session.request')
+    def test_get_retries_then_succeeds(self, mock_request, mock_sleep):
+        mock_request.side_effect = [requests.ConnectionError("reset"), mock_response(503), mock_response(200)]
+
+        response = self.client.get(params={"department": "IT"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        mock_request.assert_called_with("GET", "http://upstream:5000/items", params={"department": "IT"}, timeout=(1, 2))
+
+    @patch('http_client.time.sleep')
+    @patch('http_client.requests.Session.request')
+    def test_get_gives_up_after_retries(self, mock_request, mock_sleep):
+        mock_request.side_effect = requests.Timeout("slow")
+
+        with self.assertRaises(requests.Timeout):
+            self.client.get()
+        self.assertEqual(mock_request.call_count, 3)
+
+    @patch('http_client.requests.Session.request')
+    def test_post_is_not_retried_by_default(self, mock_request):
+        mock_request.return_value = mock_response(503)
+
+        response = self.client.post("batch", json=[])
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(mock_request.call_args.args[1], "http://upstream:5000/items/batch")
+
+    def test_latency_metrics(self):
+        stats = LatencyStats()
+        stats.record("event", 0.02)
+        stats.record("event", 3, error=True)
+
+        metrics = stats.metrics()
+        self.assertIn('internal_http_request_duration_seconds_bucket{upstream="event",le="0.025"} 1', metrics)
+        self.assertIn('internal_http_request_duration_seconds_count{upstream="event"} 2', metrics)
+        self.assertIn('internal_http_request_errors_total{upstream="event"} 1', metrics)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+import requests
+from flask import json
+from unittest.mock import patch, MagicMock
+from complex_view_schedule import app, parse_date, event_url, profile_url, request_url, occurrence_url, snapshot_cache
+
+def mock_response(status_code, data=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.json.return_value = data
+    response.headers = {"ETag": '"v1"'} if status_code == 200 else {}
+    return response
+
+class ViewScheduleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        snapshot_cache.clear()
+
+    @patch('http_client.requests.Session.request')
+    def test_get_schedule(self, mock_get):
+        responses = {
+            event_url: mock_response(200, [{"event_name": "New Year Day"}]),
+            profile_url: mock_response(200, [{"staff_id": 1}]),
+            request_url: mock_response(200, [{"request_id": 1}]),
+        }
+        mock_get.side_effect = lambda method, url, params=None, headers=None, timeout=None: responses[url]
+
+        response = self.app.get('/view-schedule')
+        self.assertEqual(response.status_code, 200)
+
+        data = json.loads(response.data)
+        self.assertEqual(data['public_holidays'][0]['event_name'], 'New Year Day')
+        self.assertEqual(data['profiles'][0]['staff_id'], 1)
+        self.assertEqual(data['requests'][0]['request_id'], 1)
+        self.assertNotIn('errors', data)
+
+    @patch('http_client.requests.Session.request')
+    def test_get_schedule_partial_failure(self, mock_get):
+        def fake_get(method, url, params=None, headers=None, timeout=None):
+            if url == request_url:
+                raise requests.Timeout("read timed out")
+            return mock_response(200, [])
+        mock_get.side_effect = fake_get
+
+        response = self.app.get('/view-schedule')
+        self.assertEqual(response.status_code, 200)
+
+        data = json.loads(response.data)
+        self.assertEqual(data['profiles'], [])
+        self.assertIsNone(data['requests'])
+        self.assertIn('requests', data['errors'])
+
+    @patch('http_client.requests.Session.request')
+    def test_get_schedule_all_upstreams_down(self, mock_get):
+        mock_get.return_value = mock_response(503)
+
+        response = self.app.get('/view-schedule')
+        self.assertEqual(response.status_code, 500)
+
+        data = json.loads(response.data)
+        self.assertEqual(len(data['errors']), 3)
+
+    @patch('http_client.requests.Session.request')
+    def test_get_joined_schedule(self, mock_get):
+        responses = {
+            event_url: mock_response(200, [{"department": "IT", "event_name": "New Year Day", "event_date": "01-01-2024"}]),
+            profile_url: mock_response(200, [
+                {"staff_id": 1, "staff_fname": "John", "staff_lname": "Doe", "department": "IT"},
+                {"staff_id": 2, "staff_fname": "Jane", "staff_lname": "Smith", "department": "IT"},
+            ]),
+            # Staff 2 works from home every Tuesday and Thursday: a recurring series, one row per day
+            occurrence_url: mock_response(200, [
+                {"request_id": 1, "staff_id": 2, "occurrence_date": "2024-01-02", "status": "Approved"},
+                {"request_id": 1, "staff_id": 2, "occurrence_date": "2024-01-04", "status": "Approved"},
+            ]),
+        }
+        mock_get.side_effect = lambda method, url, params=None, headers=None, timeout=None: responses[url]
+
+        response = self.app.get('/view-schedule?department=IT&start=2024-01-01&end=2024-01-04')
+        self.assertEqual(response.status_code, 200)
+
+        # Each upstream is asked only for the requested slice
+        params = {call.args[1]: call.kwargs['params'] for call in mock_get.call_args_list}
+        self.assertEqual(params[profile_url], {"department": "IT"})
+        self.assertEqual(params[occurrence_url], {"department": "IT", "start": "2024-01-01", "end": "2024-01-04", "status": "approved"})
+        self.assertNotIn(request_url, params)
+
+        data = json.loads(response.data)
+        self.assertEqual(data['dates'], ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04'])
+        self.assertEqual(data['schedule'][0]['days'], {'2024-01-01': 'holiday', '2024-01-02': 'office', '2024-01-03': 'office', '2024-01-04': 'office'})
+        self.assertEqual(data['schedule'][1]['days'], {'2024-01-01': 'holiday', '2024-01-02': 'wfh', '2024-01-03': 'office', '2024-01-04': 'wfh'})
+
+    @patch('http_client.requests.Session.request')
+    def test_get_joined_schedule_with_http_dates(self, mock_get):
+        # What Flask 3 jsonify makes of a PostgreSQL DATE column
+        responses = {
+            event_url: mock_response(200, [{"department": "IT", "event_name": "Holiday", "event_date": "Wed, 03 Jan 2024 00:00:00 GMT"}]),
+            profile_url: mock_response(200, [{"staff_id": 2, "staff_fname": "Jane", "staff_lname": "Smith", "department": "IT"}]),
+            occurrence_url: mock_response(200, [
+                {"request_id": 1, "staff_id": 2, "occurrence_date": "Tue, 02 Jan 2024 00:00:00 GMT", "status": "Approved"},
+            ]),
+        }
+        mock_get.side_effect = lambda method, url, params=None, headers=None, timeout=None: responses[url]
+
+        data = json.loads(self.app.get('/view-schedule?department=IT&start=2024-01-01&end=2024-01-03').data)
+        self.assertEqual(data['schedule'][0]['days'], {'2024-01-01': 'office', '2024-01-02': 'wfh', '2024-01-03': 'holiday'})
+
+    def test_parse_date_formats(self):
+        for value in ("2024-03-01", "01-03-2024", "Fri, 01 Mar 2024 00:00:00 GMT"):
+            self.assertEqual(parse_date(value).isoformat(), "2024-03-01")
+        self.assertIsNone(parse_date("March 1st"))
+        self.assertIsNone(parse_date(None))
+
+    def test_get_joined_schedule_requires_dates(self):
+        response = self.app.get('/view-schedule?department=IT')
+        self.assertEqual(response.status_code, 400)
+
+    @patch('http_client.requests.Session.request')
+    def test_get_schedule_served_from_snapshot(self, mock_get):
+        mock_get.return_value = mock_response(200, [])
+
+        first = self.app.get('/view-schedule')
+        second = self.app.get('/view-schedule')
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'FRESH')
+        self.assertIn('Age', second.headers)
+        # Only the first request reached the upstreams
+        self.assertEqual(mock_get.call_count, 3)
+
+        metrics = self.app.get('/metrics').data.decode()
+        self.assertIn('view_schedule_snapshot_hit_total 3', metrics)
+        self.assertIn('view_schedule_snapshot_miss_total 3', metrics)
+
+    @patch('http_client.requests.Session.request')
+    def test_refresh_revalidates_with_etag(self, mock_get):
+        mock_get.return_value = mock_response(200, [{"staff_id": 1}])
+        self.app.get('/view-schedule')
+
+        mock_get.reset_mock()
+        mock_get.return_value = mock_response(304)
+        snapshot_cache.refresh(snapshot_cache.key("profiles", None))
+
+        self.assertEqual(mock_get.call_args.kwargs['headers'], {"If-None-Match": '"v1"'})
+        data, error, age, state = snapshot_cache.get("profiles")
+        self.assertEqual(data, [{"staff_id": 1}])
+        self.assertEqual(state, "fresh")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,275 @@
+# long-lived RabbitMQ publisher shared by the whole process
+# NOTE: each service is built from its own folder, so this file is kept identical in
+# micro_notification/ and micro_approval/ -- change both together.
+from collections import deque
+import atexit
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import pika
+from pika.exceptions import AMQPError, UnroutableError
+
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT') or 5672)
+RABBITMQ_HEARTBEAT = int(os.getenv('RABBITMQ_HEARTBEAT') or 30)  # seconds
+PUBLISH_BUFFER_SIZE = int(os.getenv('PUBLISH_BUFFER_SIZE') or 1000)  # messages held while the broker is away
+PUBLISH_BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE') or 100)
+PUBLISH_MAX_BACKOFF = float(os.getenv('PUBLISH_MAX_BACKOFF') or 30)  # seconds between reconnect attempts
+EMAIL_QUEUE_PARTITIONS = int(os.getenv('EMAIL_QUEUE_PARTITIONS') or 1)  # 1 keeps the single email_queue
+PARTITION_QUEUE = re.compile(r'\.\d+$')
+
+MSG_PROPERTIES = pika.BasicProperties(delivery_mode=2)  # persistent
+
+
+class PublishBufferFull(Exception):
+    """The broker has been unreachable long enough for the local buffer to fill up."""
+
+
+def connection_parameters(host=None, port=None, heartbeat=None):
+    return pika.ConnectionParameters(
+        host=host or RABBITMQ_HOST,
+        port=port or RABBITMQ_PORT,
+        credentials=pika.PlainCredentials('guest', 'guest'),
+        heartbeat=heartbeat or RABBITMQ_HEARTBEAT,
+        blocked_connection_timeout=heartbeat or RABBITMQ_HEARTBEAT,
+    )
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash (Lamping & Veach): the bucket in [0, buckets) for a 64-bit key.
+
+    Going from n to n + 1 buckets moves only 1/(n + 1) of the keys, all to the new bucket.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def partition_queues(queue='email_queue', partitions=None):
+    """The queues a logical queue is split into: queue.0 .. queue.<n-1>, or just queue when n is 1."""
+    partitions = partitions or EMAIL_QUEUE_PARTITIONS
+    return [queue] if partitions == 1 else [f'{queue}.{i}' for i in range(partitions)]
+
+
+def partition_queue(key, queue='email_queue', partitions=None):
+    """The partition that carries every message for key (e.g. a requester email), so they stay in order."""
+    queues = partition_queues(queue, partitions)
+    if len(queues) == 1:
+        return queues[0]
+    # A stable hash: Python's hash() differs between processes
+    digest = hashlib.blake2b(key.strip().lower().encode('utf-8'), digest_size=8).digest()
+    return queues[jump_hash(int.from_bytes(digest, 'big'), len(queues))]
+
+
+def queue_arguments(queue):
+    """Declare arguments for a queue; producers and consumers must use the same ones.
+
+    Partition queues allow a single active consumer, so a partition is never consumed by
+    two workers at once (e.g. while a replacement starts) and its order is kept.
+    """
+    return {'x-single-active-consumer': True} if PARTITION_QUEUE.search(queue) else None
+
+
+class Publisher:
+    """Publishes to one durable queue over a connection that stays open.
+
+    pika's BlockingConnection must only be used from the thread that created it, so a
+    single background thread owns the connection and its confirm-mode channel; publish()
+    only appends to a bounded in-memory buffer and returns. The thread sends the buffer
+    in batches, keeps the connection alive with heartbeats and reconnects with backoff.
+    Messages are removed from the buffer only after the broker confirms them, so a
+    dropped connection can lead to a resend (at-least-once), never to a silent loss.
+    """
+
+    def __init__(self, queue='email_queue', parameters=None, buffer_size=None, batch_size=None,
+                 connection_factory=pika.BlockingConnection):
+        self.queue = queue
+        self.parameters = parameters or connection_parameters()
+        self.buffer_size = buffer_size or PUBLISH_BUFFER_SIZE
+        self.batch_size = batch_size or PUBLISH_BATCH_SIZE
+        self.connection_factory = connection_factory
+        self.buffer = deque()
+        self.lock = threading.Condition()
+        self.connection = None
+        self.channel = None
+        self.thread = None
+        self.stopping = False
+        self.in_flight = 0
+        self.counters = {'published': 0, 'reconnects': 0, 'failures': 0, 'unroutable': 0}
+
+    # ---- called from any thread ----
+
+    def publish(self, message):
+        """Queue one message (a dict is sent as JSON). Raises PublishBufferFull when the buffer is full."""
+        self.publish_many([message])
+
+    def publish_many(self, messages):
+        bodies = [json.dumps(m) if isinstance(m, (dict, list)) else m for m in messages]
+        if not bodies:
+            return
+        with self.lock:
+            if len(self.buffer) + len(bodies) > self.buffer_size:
+                raise PublishBufferFull(f'{len(self.buffer)} messages are already waiting for {self.queue}')
+            self.buffer.extend(bodies)
+            self.start()
+            self.lock.notify()
+
+    def flush(self, timeout=5):
+        """Wait until every queued message has been confirmed. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.buffer or self.in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def close(self, timeout=5):
+        """Flush what can be flushed, then stop the I/O thread and close the connection."""
+        self.flush(timeout)
+        with self.lock:
+            self.stopping = True
+            self.lock.notify()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def start(self):
+        # Caller holds self.lock
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run, name=f'publisher-{self.queue}', daemon=True)
+            self.thread.start()
+
+    def metrics(self):
+        """Prometheus text lines for the publisher."""
+        with self.lock:
+            buffered = len(self.buffer) + self.in_flight
+            counters = dict(self.counters)
+        lines = [
+            '# TYPE amqp_publish_buffered gauge',
+            f'amqp_publish_buffered{{queue="{self.queue}"}} {buffered}',
+            '# TYPE amqp_publish_connected gauge',
+            f'amqp_publish_connected{{queue="{self.queue}"}} {int(self.channel is not None)}',
+        ]
+        for name, value in counters.items():
+            lines.append(f'# TYPE amqp_publish_{name}_total counter')
+            lines.append(f'amqp_publish_{name}_total{{queue="{self.queue}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    # ---- I/O thread only ----
+
+    def connect(self):
+        self.connection = self.connection_factory(self.parameters)
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=self.queue, durable=True, arguments=queue_arguments(self.queue))
+        self.channel.confirm_delivery()
+
+    def disconnect(self):
+        connection, self.connection, self.channel = self.connection, None, None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def take_batch(self):
+        with self.lock:
+            while not self.buffer and not self.stopping:
+                self.lock.wait(1)
+                if self.connection is not None and not self.buffer:
+                    # Idle: let pika answer heartbeats so the broker keeps the connection open
+                    self.lock.release()
+                    try:
+                        self.connection.process_data_events(0)
+                    except AMQPError:
+                        self.disconnect()
+                    finally:
+                        self.lock.acquire()
+            batch = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+            self.in_flight = len(batch)
+            return batch
+
+    def run(self):
+        failures = 0
+        while True:
+            batch = self.take_batch()
+            if not batch:
+                self.disconnect()
+                return
+            sent = 0
+            try:
+                if self.channel is None:
+                    self.connect()
+                    if failures:
+                        self.counters['reconnects'] += 1
+                for body in batch:
+                    # In confirm mode basic_publish returns once the broker has taken the message
+                    try:
+                        self.channel.basic_publish(exchange='', routing_key=self.queue, body=body,
+                                                   properties=MSG_PROPERTIES, mandatory=True)
+                    except UnroutableError:
+                        # The broker will never route it; retrying would only hold up the rest
+                        logging.error(f'Dropping unroutable message for {self.queue}')
+                        self.counters['unroutable'] += 1
+                    sent += 1
+                failures = 0
+            except Exception as e:
+                failures += 1
+                self.counters['failures'] += 1
+                logging.warning(f'Publishing to {self.queue} failed ({e}), retrying')
+                self.disconnect()
+            finally:
+                with self.lock:
+                    # Unconfirmed messages go back to the front, in order
+                    self.buffer.extendleft(reversed(batch[sent:]))
+                    self.counters['published'] += sent
+                    self.in_flight = 0
+                    self.lock.notify_all()
+            if failures:
+                with self.lock:
+                    if self.stopping:
+                        return
+                    self.lock.wait(random.uniform(0, min(PUBLISH_MAX_BACKOFF, 0.5 * 2 ** failures)))
+
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(queue='email_queue'):
+    """The process-wide publisher for a queue, created on first use."""
+    with _publishers_lock:
+        if queue not in _publishers:
+            _publishers[queue] = Publisher(queue)
+        return _publishers[queue]
+
+
+def publish_by_key(messages, key, queue='email_queue'):
+    """Publish messages across queue's partitions, routing each by key(message).
+
+    Messages with the same key go to the same partition in the order given.
+    """
+    batches = {}
+    for message in messages:
+        batches.setdefault(partition_queue(key(message), queue), []).append(message)
+    for partition, batch in batches.items():
+        get_publisher(partition).publish_many(batch)
+
+
+@atexit.register
+def close_publishers(timeout=5):
+    """Give buffered messages a chance to reach the broker before the process exits."""
+    with _publishers_lock:
+        publishers = list(_publishers.values())
+    for publisher in publishers:
+        publisher.close(timeout)
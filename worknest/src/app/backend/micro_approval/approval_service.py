@@ -1,20 +1,26 @@
 # handles the logic for approval/rejection + audit log 
-from flask import Flask, request, jsonify
-import pika
+from flask import Flask, request, jsonify, Response, stream_with_context
 import json
 import logging
 from flask_cors import CORS
 import os
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, date, timedelta
+import base64
+import csv
+import io
+import zlib
+from collections import Counter
+from sqlalchemy.dialects import postgresql, sqlite
+from amqp_publisher import publish_by_key
 
 load_dotenv()  # Load environment variables from .env file
 
 logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
-CORS(app, supports_credentials=True, origins=["http://localhost:3000"])  
+CORS(app, supports_credentials=True, origins=["http://localhost:3000"], expose_headers=['X-Next-Cursor'])  
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')  # This should read from your .env file
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.secret_key = os.getenv('SECRET_KEY')  # Replace with a secure key
@@ -74,7 +80,8 @@ class AuditLogModel(db.Model):
     __tablename__ = 'audit_log'
 
     log_id = db.Column(db.Integer, primary_key=True)  # Primary key
-    request_id = db.Column(db.Integer, nullable=False, unique=True)  # Foreign key to the request table
+    # Not unique: audit_log is partitioned by month (V007), so apply_decisions keeps it to one row per request
+    request_id = db.Column(db.Integer, nullable=False, index=True)  # Foreign key to the request table
     requester_email = db.Column(db.String(50), nullable = False)
     action = db.Column(db.String(50), nullable=False)  # Action performed (e.g., 'approved' or 'rejected')
     reporting_manager_id = db.Column(db.Integer, nullable=False)  # ID of the approver
@@ -85,6 +92,14 @@ class AuditLogModel(db.Model):
     department = db.Column(db.String(50), nullable=False)
     approver_comment = db.Column(db.String(50))
 
+    # Every filter of GET /audit_log is backed by an index ending in the keyset columns
+    __table_args__ = (
+        db.Index('ix_audit_log_timestamp', 'action_timestamp', 'log_id'),
+        db.Index('ix_audit_log_department_timestamp', 'department', 'action_timestamp', 'log_id'),
+        db.Index('ix_audit_log_manager_timestamp', 'reporting_manager_id', 'action_timestamp', 'log_id'),
+        db.Index('ix_audit_log_requester_timestamp', 'requester_email', 'action_timestamp', 'log_id'),
+    )
+
     def __init__(self, request_id, requester_email, action, reporting_manager_id, reporting_manager_email, start_date, duration, department, approver_comment):
         self.request_id = request_id
         self.requester_email = requester_email
@@ -116,6 +131,35 @@ class AuditLogModel(db.Model):
 
         }
     
+class OccurrenceModel(db.Model):
+    __tablename__ = 'request_occurrence'
+
+    occurrence_id = db.Column(db.Integer, primary_key=True)
+    request_id = db.Column(db.Integer, nullable=False)  # One row per day covered by the request
+    staff_id = db.Column(db.Integer, nullable=False)
+    department = db.Column(db.String(50), nullable=False)
+    occurrence_date = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(50), nullable=False)
+
+class DepartmentCapacityModel(db.Model):
+    __tablename__ = 'department_daily_capacity'
+
+    department = db.Column(db.String(50), primary_key=True)
+    capacity_date = db.Column(db.Date, primary_key=True)
+    approved_count = db.Column(db.Integer, nullable=False, default=0)
+    pending_count = db.Column(db.Integer, nullable=False, default=0)
+
+class DepartmentWfhLimitModel(db.Model):
+    __tablename__ = 'department_wfh_limit'
+
+    department = db.Column(db.String(50), primary_key=True)
+    headcount = db.Column(db.Integer, nullable=False)
+    max_ratio = db.Column(db.Float, nullable=False, default=0.5)
+
+    @property
+    def limit(self):
+        return max(1, int(self.headcount * self.max_ratio))
+
 class ScheduleModel(db.Model):
     __tablename__ = 'schedule'
     
@@ -134,40 +178,197 @@ class ScheduleModel(db.Model):
         db.session.add(self)
         db.session.commit()
  
-def send_rabbitmq_message(action, requester_email, reporting_manager_email, start_date, approver_comment, duration):
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
-    channel = connection.channel()
-    
-    # Declare a queue for notifications
-    channel.queue_declare(queue='email_queue', durable=True)
-    
-    # Create the message data
-    message = {
-        'action': action,
-        'email': requester_email,
-        'reporting_manager_email': reporting_manager_email,
-        'start_date': start_date,
-        'approver_comment': approver_comment, 
-        'duration': duration
-    }
-    
-    # Publish the message to the queue
-    channel.basic_publish(
-        exchange='',
-        routing_key='email_queue',
-        body=json.dumps(message),
-        properties=pika.BasicProperties(
-            delivery_mode=2,  # Make the message persistent
+def publish_messages(messages):
+    """Hand notification messages to the process-wide email_queue publishers.
+
+    Returns straight away; the publishers' own threads deliver them over connections
+    that stay open. With EMAIL_QUEUE_PARTITIONS > 1 each message goes to the partition
+    for its requester, so one person's emails stay in order. Raises PublishBufferFull if
+    RabbitMQ has been down long enough to fill the local buffer.
+    """
+    publish_by_key(messages, key=lambda message: message['email'], queue='email_queue')
+
+def dialect_insert(model):
+    """INSERT supporting on_conflict_do_update on both PostgreSQL and SQLite (used in tests)."""
+    dialect = postgresql if db.session.get_bind().dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model)
+
+def to_date(value):
+    return value if isinstance(value, date) else datetime.strptime(str(value), '%Y-%m-%d').date()
+
+##### Department Capacity #####
+# Same counters micro_request maintains; see department_daily_capacity in migrations/V005
+
+CAPACITY_COLUMNS = {'approved': 'approved_count', 'pending': 'pending_count'}
+
+def capacity_deltas(days, new_status):
+    """Counter changes for moving every day of a request to new_status."""
+    deltas = Counter()
+    for department, occurrence_date, status in days:
+        for column, sign in ((CAPACITY_COLUMNS.get(str(status).lower()), -1), (CAPACITY_COLUMNS.get(new_status.lower()), 1)):
+            if column:
+                deltas[(department, occurrence_date, column)] += sign
+    return deltas
+
+def adjust_capacity(deltas):
+    """Apply counter changes with one multi-row upsert (caller commits)."""
+    days = {}
+    for (department, capacity_date, column), change in deltas.items():
+        if change:
+            day = days.setdefault((department, capacity_date), {
+                'department': department, 'capacity_date': capacity_date, 'approved_count': 0, 'pending_count': 0
+            })
+            day[column] += change
+    if not days:
+        return
+    statement = dialect_insert(DepartmentCapacityModel).values(list(days.values()))
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['department', 'capacity_date'],
+        set_={
+            'approved_count': DepartmentCapacityModel.approved_count + statement.excluded.approved_count,
+            'pending_count': DepartmentCapacityModel.pending_count + statement.excluded.pending_count,
+        }
+    ))
+
+def remaining_capacity(days):
+    """{(department, date): approvals still allowed} for the days whose department has a limit.
+
+    The counter rows are created if missing and locked FOR UPDATE until the caller commits,
+    so a concurrent approval of the same days waits here and then sees this one's
+    increment: checking and incrementing are one atomic step. Rows are locked in key order
+    so two batches touching the same days cannot deadlock.
+    """
+    departments = {department for department, _ in days}
+    limits = {limit.department: limit.limit for limit in
+              DepartmentWfhLimitModel.query.filter(DepartmentWfhLimitModel.department.in_(departments))}
+    days = sorted(day for day in days if day[0] in limits)
+    if not days:
+        return {}
+    db.session.execute(dialect_insert(DepartmentCapacityModel).values([
+        {'department': department, 'capacity_date': capacity_date, 'approved_count': 0, 'pending_count': 0}
+        for department, capacity_date in days
+    ]).on_conflict_do_nothing(index_elements=['department', 'capacity_date']))
+    approved = {(counter.department, counter.capacity_date): counter.approved_count for counter in
+                DepartmentCapacityModel.query.filter(
+                    db.tuple_(DepartmentCapacityModel.department, DepartmentCapacityModel.capacity_date).in_(days))
+                .order_by(DepartmentCapacityModel.department, DepartmentCapacityModel.capacity_date)
+                .with_for_update()}
+    return {day: limits[day[0]] - approved.get(day, 0) for day in days}
+
+##### Approve / Reject #####
+
+def apply_decisions(request_ids, new_status, reporting_manager_id, approver_comment):
+    """Move pending requests to new_status in one transaction.
+
+    The request rows change through a single conditional UPDATE ... WHERE status = 'pending'
+    RETURNING, so two managers deciding the same request at once cannot both succeed and
+    no row lock is held while the handler runs. Occurrences, capacity counters, the audit
+    log and the schedule are written by set-based statements in the same commit.
+
+    Returns ([{'request_id', 'status'[, 'full_dates']}], [notification messages to publish]).
+    """
+    outcomes = {}
+
+    # Days still pending per request (a recurring series has several)
+    days = {}
+    for occurrence in db.session.query(OccurrenceModel.request_id, OccurrenceModel.department,
+                                       OccurrenceModel.occurrence_date, OccurrenceModel.status)\
+            .filter(OccurrenceModel.request_id.in_(request_ids), db.func.lower(OccurrenceModel.status) == 'pending'):
+        days.setdefault(occurrence.request_id, []).append(
+            (occurrence.department, occurrence.occurrence_date, occurrence.status))
+
+    if new_status == 'Approved':
+        # Approvals earlier in the batch use up capacity for the ones after them
+        remaining = remaining_capacity({day[:2] for request_id in request_ids for day in days.get(request_id, [])})
+        for request_id in request_ids:
+            needed = Counter(day[:2] for day in days.get(request_id, []))
+            full = sorted(day for day, count in needed.items() if remaining.get(day, count) < count)
+            if full:
+                outcomes[request_id] = {'status': 'capacity_full', 'full_dates': [d.isoformat() for _, d in full]}
+                continue
+            for day, count in needed.items():
+                if day in remaining:
+                    remaining[day] -= count
+    candidates = [request_id for request_id in request_ids if request_id not in outcomes]
+
+    records = {}
+    if candidates:
+        records = {row.request_id: row for row in db.session.execute(
+            db.update(RequestModel)
+            .where(RequestModel.request_id.in_(candidates), db.func.lower(RequestModel.status) == 'pending')
+            .values(status=new_status, reporting_manager_id=reporting_manager_id, approver_comment=approver_comment)
+            .returning(RequestModel.request_id, RequestModel.staff_id, RequestModel.department,
+                       RequestModel.start_date, RequestModel.duration, RequestModel.requester_email,
+                       RequestModel.reporting_manager_email)
+        )}
+    missing = [request_id for request_id in candidates if request_id not in records]
+    if missing:
+        # Only on the unhappy path: tell "already decided" apart from "no such request"
+        existing = set(db.session.scalars(db.select(RequestModel.request_id).where(RequestModel.request_id.in_(missing))))
+        for request_id in missing:
+            outcomes[request_id] = {'status': 'not_pending' if request_id in existing else 'not_found'}
+    applied = [request_id for request_id in candidates if request_id in records]
+    for request_id in applied:
+        outcomes[request_id] = {'status': new_status}
+
+    messages = []
+    if applied:
+        deltas = Counter()
+        for request_id in applied:
+            deltas.update(capacity_deltas(days.get(request_id, []), new_status))
+        db.session.execute(
+            db.update(OccurrenceModel).where(OccurrenceModel.request_id.in_(applied)).values(status=new_status)
         )
-    )
-    
-    connection.close()
+        adjust_capacity(deltas)
+
+        # The conditional UPDATE already lets only one decision through per pending request;
+        # a request that went back to pending and is decided again keeps its first log row
+        logged = set(db.session.scalars(
+            db.select(AuditLogModel.request_id).where(AuditLogModel.request_id.in_(applied))
+        ))
+        unlogged = [request_id for request_id in applied if request_id not in logged]
+        if unlogged:
+            db.session.execute(db.insert(AuditLogModel), [{
+                'request_id': request_id,
+                'requester_email': records[request_id].requester_email,
+                'action': new_status,
+                'reporting_manager_id': reporting_manager_id,
+                'reporting_manager_email': records[request_id].reporting_manager_email,
+                'start_date': to_date(records[request_id].start_date),
+                'duration': records[request_id].duration,
+                'department': records[request_id].department,
+                'approver_comment': approver_comment
+            } for request_id in unlogged])
+
+        if new_status == 'Approved':
+            # schedule holds one row per staff member, so the last approval in the batch wins
+            schedule_rows = {records[request_id].staff_id: {
+                'staff_id': records[request_id].staff_id,
+                'date': to_date(records[request_id].start_date),
+                'department': records[request_id].department,
+                'status': new_status
+            } for request_id in applied}
+            statement = dialect_insert(ScheduleModel).values(list(schedule_rows.values()))
+            db.session.execute(statement.on_conflict_do_update(
+                index_elements=['staff_id'],
+                set_={'date': statement.excluded.date, 'department': statement.excluded.department,
+                      'status': statement.excluded.status}
+            ))
+
+        messages = [{
+            'action': new_status,
+            'email': records[request_id].requester_email,
+            'reporting_manager_email': records[request_id].reporting_manager_email,
+            'start_date': to_date(records[request_id].start_date).isoformat(),
+            'approver_comment': approver_comment,
+            'duration': records[request_id].duration
+        } for request_id in applied]
+    db.session.commit()
 
-##### Approve Request #####
+    return [{'request_id': request_id, **outcomes[request_id]} for request_id in request_ids], messages
 
-@app.route('/approve_request', methods=['POST'])
-def approve_request():
-    logging.info("Received POST request on /approve_request")
+def decide_request(new_status, done_message):
+    """Shared body of /approve_request and /reject_request."""
     data = request.json
     
     # Extract required data from the request
@@ -175,116 +376,257 @@ def approve_request():
     reporting_manager_id = data['reporting_manager_id']
     approver_comment = data.get('approver_comment', '')
 
-    # Fetch the request from the database
-    request_record = RequestModel.query.filter_by(request_id=request_id).first()
-    if not request_record:
+    try:
+        (outcome,), messages = apply_decisions([request_id], new_status, reporting_manager_id, approver_comment)
+    except Exception as e:
+        db.session.rollback()
+        logging.exception(f"Could not record decision for request {request_id}")
+        return jsonify({'status': f'Error updating request: {str(e)}'}), 500
+
+    if outcome['status'] == 'not_found':
         return jsonify({'status': 'Request not found'}), 404
+    if outcome['status'] == 'not_pending':
+        return jsonify({'status': 'Request is no longer pending'}), 409
+    if outcome['status'] == 'capacity_full':
+        return jsonify({'status': 'Department WFH capacity reached', 'full_dates': outcome['full_dates']}), 409
 
-    # Update the status to "Approved" and set the approver's comment and duration
-    recurring_days = request_record.recurring_days
-    if recurring_days:
-        for day in recurring_days:
-            logging.info(f"Approving recurring request for day: {day}")
-            update_request_status(request_id, 'Approved', reporting_manager_id, approver_comment)
-    else:
-        update_request_status(request_id, 'Approved', reporting_manager_id, approver_comment)
-
-    # Log the approval in the audit log
-    create_audit_log(request_id, request_record.requester_email, 'Approved', reporting_manager_id, request_record.reporting_manager_email, request_record.start_date.isoformat(), request_record.duration, request_record.department, approver_comment)
-
-    # Send RabbitMQ messages
-    send_rabbitmq_message('Approved', request_record.requester_email, request_record.reporting_manager_email, request_record.start_date.isoformat(), approver_comment, request_record.duration)
-       # Create a new entry in the schedule table
-    new_schedule_entry = ScheduleModel(
-        staff_id=request_record.staff_id,
-        date=request_record.start_date,
-        department=request_record.department,
-        status="Approved"
-    )
-    db.session.add(new_schedule_entry)
-    db.session.commit()
+    # Send RabbitMQ messages; the decision is already committed
+    try:
+        publish_messages(messages)
+    except Exception:
+        logging.exception(f"Could not publish notification for request {request_id}")
 
-    return jsonify({'status': 'Request approved'}), 200
+    return jsonify({'status': done_message}), 200
 
-##### Reject Request #####
+@app.route('/approve_request', methods=['POST'])
+def approve_request():
+    logging.info("Received POST request on /approve_request")
+    return decide_request('Approved', 'Request approved')
 
 @app.route('/reject_request', methods=['POST'])
 def reject_request():
     logging.info("Received POST request on /reject_request")
-    data = request.json
-    
-    # Extract required data from the request
-    request_id = data['request_id']
-    reporting_manager_id = data['reporting_manager_id']
-    approver_comment = data.get('approver_comment', '')
-
-    # Fetch the request from the database
-    request_record = RequestModel.query.filter_by(request_id=request_id).first()
-    if not request_record:
-        return jsonify({'status': 'Request not found'}), 404
-
-    # Update the status to "Rejected"
-    update_request_status(request_id, 'Rejected', reporting_manager_id, approver_comment)
-
-    # Log the rejection in the audit log
-    create_audit_log(request_id, request_record.requester_email, 'Rejected', reporting_manager_id, request_record.reporting_manager_email, request_record.start_date.isoformat(), request_record.duration, request_record.department, approver_comment)
-
-    # Send RabbitMQ messages
-    send_rabbitmq_message('Rejected', request_record.requester_email, request_record.reporting_manager_email, request_record.start_date.isoformat(), approver_comment, request_record.duration)
-
-    return jsonify({'status': 'Request rejected'}), 200
-
-def update_request_status(request_id, new_status, reporting_manager_id, approver_comment, duration=None):
-    # Query the request by request_id
-    request_record = RequestModel.query.filter_by(request_id=request_id).first()
-
-    if request_record:
-        # Update the fields
-        request_record.status = new_status
-        request_record.reporting_manager_id = reporting_manager_id
-        request_record.approver_comment = approver_comment
-        
-        # Update the duration only if provided
-        if duration is not None:
-            request_record.duration = duration  # Adjust the duration if needed
-
-        # Handle recurring days if they exist
-        recurring_days = request_record.recurring_days
-        if recurring_days:
-            # Example: Update recurring days logic (this could vary based on your requirements)
-            # Here we are just logging the recurring days for demonstration
-            logging.info(f"Updating recurring request for days: {recurring_days}")
-            # You might want to implement specific logic to handle the recurring days
-
-        # Commit the changes
-        db.session.commit()
-        return True
-    else:
-        return False
-
-
-
-def create_audit_log(request_id, requester_email, action, reporting_manager_id, reporting_manager_email, start_date, duration, department, approver_comment):
-    new_log = AuditLogModel(
-        request_id=request_id,
-        requester_email=requester_email,
-        action=action,
-        reporting_manager_id=reporting_manager_id,
-        reporting_manager_email=reporting_manager_email,
-        start_date=start_date,  # Log the specific WFH start date
-        duration=duration,  # Log the duration of the WFH request
-        department = department,
-        approver_comment=approver_comment
-    )
-    db.session.add(new_log)
-    db.session.commit()
-
+    return decide_request('Rejected', 'Request rejected')
+
+##### Batch Approve / Reject #####
+
+MAX_DECISION_BATCH = 200
+DECISIONS = {'approve': 'Approved', 'reject': 'Rejected'}
+
+@app.route('/decide_requests', methods=['POST'])
+def decide_requests():
+    """Approve or reject many pending requests at once.
+
+    Body: {"request_ids": [...], "decision": "approve" | "reject", "reporting_manager_id": ..., "approver_comment": ...}
+    Every decision is applied in one transaction and the emails are handed to the
+    publisher in one call afterwards. Returns one outcome per id: the new status, or not_found / not_pending /
+    capacity_full when the request was left alone.
+    """
+    logging.info("Received POST request on /decide_requests")
+    data = request.get_json(silent=True) or {}
+    request_ids = data.get('request_ids')
+    new_status = DECISIONS.get(str(data.get('decision')).lower())
+
+    if not isinstance(request_ids, list) or not request_ids or not all(isinstance(i, int) for i in request_ids):
+        return jsonify({'status': 'request_ids must be a non-empty list of integers'}), 400
+    if len(request_ids) > MAX_DECISION_BATCH:
+        return jsonify({'status': f'A batch cannot contain more than {MAX_DECISION_BATCH} requests'}), 400
+    if not new_status:
+        return jsonify({'status': 'decision must be approve or reject'}), 400
+    if data.get('reporting_manager_id') is None:
+        return jsonify({'status': 'reporting_manager_id is required'}), 400
+
+    try:
+        outcomes, messages = apply_decisions(list(dict.fromkeys(request_ids)), new_status,
+                                             data['reporting_manager_id'], data.get('approver_comment', ''))
+    except Exception as e:
+        db.session.rollback()
+        logging.exception("Batch decision failed")
+        return jsonify({'status': f'Error applying decisions: {str(e)}'}), 500
+
+    # The decisions are committed by now; a full publish buffer is reported, not rolled back
+    try:
+        publish_messages(messages)
+        notified = True
+    except Exception:
+        logging.exception("Could not publish batch decision notifications")
+        notified = False
+
+    return jsonify({'results': outcomes, 'notified': notified}), 200
+
+##### Audit Log #####
+
+AUDIT_FILTERS = ('department', 'reporting_manager_id', 'requester_email', 'action', 'from', 'to',
+                 'limit', 'cursor', 'count')
+MAX_AUDIT_PAGE_SIZE = 500
+
+def parse_timestamp(value, end=False):
+    """Accept YYYY-MM-DD or an ISO timestamp; a bare end date covers that whole day."""
+    parsed = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        timestamp, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(timestamp), int(log_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+def keyset_timestamp():
+    """action_timestamp as the /audit_log keyset sorts and compares it.
+
+    SQLite keeps timestamps as text: "YYYY-MM-DD HH:MM:SS" when CURRENT_TIMESTAMP wrote
+    them, "YYYY-MM-DD HH:MM:SS.ffffff" for a datetime from Python, so raw values neither
+    sort nor compare as times there. Both sides are put in one text form instead.
+    """
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return db.func.strftime('%Y-%m-%d %H:%M:%f', AuditLogModel.action_timestamp)
+    return AuditLogModel.action_timestamp
+
+def after_cursor(timestamp, log_id):
+    """Rows that come after the cursor in newest-first order."""
+    if db.session.get_bind().dialect.name == 'sqlite':
+        timestamp = timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    return db.tuple_(keyset_timestamp(), AuditLogModel.log_id) < db.tuple_(db.literal(timestamp), db.literal(log_id))
+
+def audit_log_query(args):
+    """AuditLogModel query for the filters in args; raises ValueError on bad input."""
+    query = AuditLogModel.query
+    if args.get('department'):
+        query = query.filter(AuditLogModel.department == args['department'])
+    if args.get('reporting_manager_id'):
+        try:
+            query = query.filter(AuditLogModel.reporting_manager_id == int(args['reporting_manager_id']))
+        except ValueError:
+            raise ValueError('reporting_manager_id must be an integer')
+    if args.get('requester_email'):
+        query = query.filter(AuditLogModel.requester_email == args['requester_email'])
+    if args.get('action'):
+        query = query.filter(db.func.lower(AuditLogModel.action) == args['action'].lower())
+    try:
+        if args.get('from'):
+            query = query.filter(AuditLogModel.action_timestamp >= parse_timestamp(args['from']))
+        if args.get('to'):
+            query = query.filter(AuditLogModel.action_timestamp < parse_timestamp(args['to'], end=True))
+    except ValueError:
+        raise ValueError('from and to must be YYYY-MM-DD or ISO timestamps')
+    return query
 
 @app.route('/audit_log', methods=['GET'])
 def get_audit_log():
-    logs = AuditLogModel.query.all()
-    log_list = [log.to_dict() for log in logs]
-    return jsonify(log_list), 200
+    """Audit log entries, newest first.
+
+    Filters: department, reporting_manager_id, requester_email, action, from, to (to is
+    inclusive for a bare date, so from=2024-03-01&to=2024-03-31 is the month of March).
+    ?count=1 returns {"count": n} only. ?limit= pages by keyset on (action_timestamp,
+    log_id); pass the X-Next-Cursor response header back as ?cursor= for the next page.
+    Without any of these the full log is returned as before.
+    """
+    if not any(arg in request.args for arg in AUDIT_FILTERS):
+        logs = AuditLogModel.query.all()
+        log_list = [log.to_dict() for log in logs]
+        return jsonify(log_list), 200
+
+    try:
+        query = audit_log_query(request.args)
+
+        if request.args.get('count') in ('1', 'true'):
+            return jsonify({'count': query.order_by(None).count()}), 200
+
+        if request.args.get('cursor'):
+            query = query.filter(after_cursor(*decode_cursor(request.args['cursor'])))
+        query = query.order_by(keyset_timestamp().desc(), AuditLogModel.log_id.desc())
+
+        limit = request.args.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise ValueError('limit must be an integer')
+            if not 1 <= limit <= MAX_AUDIT_PAGE_SIZE:
+                raise ValueError(f'limit must be between 1 and {MAX_AUDIT_PAGE_SIZE}')
+            query = query.limit(limit + 1)
+    except ValueError as e:
+        return jsonify({'status': str(e)}), 400
+
+    logs = query.all()
+    next_cursor = None
+    if limit is not None and len(logs) > limit:
+        logs = logs[:limit]
+        next_cursor = encode_cursor([logs[-1].action_timestamp, logs[-1].log_id])
+
+    response = jsonify([log.to_dict() for log in logs])
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
+
+##### Audit Export #####
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+@app.route('/audit_log/export', methods=['GET'])
+def export_audit_log():
+    """Stream the audit log, oldest first, as CSV (default) or NDJSON.
+
+    Takes the same filters as /audit_log (department, from, to, ...). ?gzip=1 compresses
+    on the fly into a .gz download. Rows are read EXPORT_BATCH_SIZE at a time through a
+    server-side cursor and written out batch by batch, so memory stays flat however
+    large the export and the first bytes leave before the query has finished.
+    """
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'status': f"format must be one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    compress = request.args.get('gzip') in ('1', 'true')
+    try:
+        query = audit_log_query(request.args)
+    except ValueError as e:
+        return jsonify({'status': str(e)}), 400
+
+    table = AuditLogModel.__table__
+    columns = [column.name for column in table.columns]
+    statement = query.with_entities(*table.c)\
+        .order_by(AuditLogModel.action_timestamp, AuditLogModel.log_id)\
+        .statement.execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+    def batches():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+            yield buffer.getvalue()
+        for rows in db.session.execute(statement).partitions():
+            buffer.seek(0)
+            buffer.truncate()
+            for row in rows:
+                if export_format == 'csv':
+                    writer.writerow([value.isoformat() if isinstance(value, (date, datetime)) else value for value in row])
+                else:
+                    buffer.write(json.dumps(dict(row._mapping), default=str) + '\n')
+            yield buffer.getvalue()
+
+    def generate():
+        # wbits=31 writes a gzip header; a sync flush per batch keeps the download moving
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        for chunk in batches():
+            if compressor:
+                yield compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            elif chunk:
+                yield chunk.encode()
+        if compressor:
+            yield compressor.flush()
+
+    filename = f"audit_log_{datetime.now().strftime('%Y%m%d')}.{export_format}" + ('.gz' if compress else '')
+    response = Response(stream_with_context(generate()),
+                        mimetype='application/gzip' if compress else EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True) 
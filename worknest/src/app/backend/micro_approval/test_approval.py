@@ -1,57 +1,274 @@
 import unittest
+import csv
+import gzip
+import io
 import json
-from app import app  # Assuming your Flask app is named `app` in app.py
+from datetime import date, datetime
+from unittest.mock import patch
+from approval_service import (app, db, apply_decisions, AuditLogModel, DepartmentCapacityModel,
+                              DepartmentWfhLimitModel, OccurrenceModel, RequestModel, ScheduleModel, MAX_DECISION_BATCH)
 
 class ApprovalTestCase(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
         self.app.testing = True
+        with app.app_context():
+            db.create_all()
+            # Pending one-day requests of staff 7, 8 and 9 on 4 March, and a two-day one of staff 7 from 5 March
+            for request_id, staff_id, day, duration in ((1, 7, 4, 1), (2, 8, 4, 1), (3, 9, 4, 1), (4, 7, 5, 2)):
+                self.add_request(request_id, staff_id, day, duration)
+            db.session.commit()
 
-    # Test for approving a request
-    def test_approve_request(self):
-        # Prepare request data
-        data = {
-            "request_id": 1,
-            "reporting_manager_id": 2003,
-            "approver_comment": "Approved for the scheduled work."
-        }
+        # Notifications are handed to RabbitMQ after the commit; nothing to send them to here
+        publisher = patch('approval_service.publish_messages')
+        self.publish = publisher.start()
+        self.addCleanup(publisher.stop)
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def add_request(self, request_id, staff_id, day, duration, status='pending'):
+        db.session.add(RequestModel(request_id, staff_id, 'IT', date(2024, 3, day).isoformat(), 'WFH', duration, status,
+                                    2003, 'Manager', 'manager@allinone.com.sg', f'staff{staff_id}@allinone.com.sg',
+                                    None, None, None))
+        for offset in range(duration):
+            db.session.add(OccurrenceModel(request_id=request_id, staff_id=staff_id, department='IT',
+                                           occurrence_date=date(2024, 3, day + offset), status=status))
+            counter = db.session.get(DepartmentCapacityModel, ('IT', date(2024, 3, day + offset)))
+            if counter is None:
+                counter = DepartmentCapacityModel(department='IT', capacity_date=date(2024, 3, day + offset),
+                                                  approved_count=0, pending_count=0)
+                db.session.add(counter)
+            counter.pending_count += 1
 
-        # Send POST request to the approve endpoint
-        response = self.app.post(
-            '/approve_request',
-            data=json.dumps(data),
-            content_type='application/json'
-        )
+    def set_limit(self, headcount):
+        with app.app_context():
+            db.session.add(DepartmentWfhLimitModel(department='IT', headcount=headcount, max_ratio=0.5))
+            db.session.commit()
 
-        # Assert the response status code
+    def counters(self):
+        with app.app_context():
+            return {counter.capacity_date.day: (counter.approved_count, counter.pending_count)
+                    for counter in DepartmentCapacityModel.query}
+
+    def decide(self, path, request_id):
+        return self.app.post(path, data=json.dumps({
+            "request_id": request_id,
+            "reporting_manager_id": 2003,
+            "approver_comment": "Noted."
+        }), content_type='application/json')
+
+    # Test for approving a request
+    def test_approve_request(self):
+        response = self.decide('/approve_request', 4)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['status'], 'Request approved')
 
-        # Assert the response data
-        response_data = json.loads(response.data)
-        self.assertEqual(response_data['status'], 'Request approved')
+        with app.app_context():
+            self.assertEqual(db.session.get(RequestModel, 4).status, 'Approved')
+            self.assertEqual([o.status for o in OccurrenceModel.query.filter_by(request_id=4)], ['Approved', 'Approved'])
+            log = AuditLogModel.query.filter_by(request_id=4).one()
+            self.assertEqual((log.action, log.start_date, log.duration), ('Approved', date(2024, 3, 5), 2))
+            schedule = db.session.get(ScheduleModel, 7)
+            self.assertEqual((schedule.date, schedule.status), (date(2024, 3, 5), 'Approved'))
+        self.assertEqual(self.counters()[5], (1, 0))
+        self.assertEqual(self.counters()[6], (1, 0))
+
+        (message,), = self.publish.call_args.args
+        self.assertEqual((message['email'], message['start_date'], message['action']),
+                         ('staff7@allinone.com.sg', '2024-03-05', 'Approved'))
 
     # Test for rejecting a request
     def test_reject_request(self):
-        # Prepare request data
-        data = {
-            "request_id": 1,
-            "reporting_manager_id": 2003,
-            "approver_comment": "Rejected due to schedule conflicts."
-        }
+        response = self.decide('/reject_request', 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['status'], 'Request rejected')
+
+        with app.app_context():
+            self.assertEqual(db.session.get(RequestModel, 1).status, 'Rejected')
+            self.assertIsNone(db.session.get(ScheduleModel, 7))
+        self.assertEqual(self.counters()[4], (0, 2))
+
+    def test_second_decision_is_refused(self):
+        self.assertEqual(self.decide('/approve_request', 1).status_code, 200)
+
+        for path in ('/approve_request', '/reject_request'):
+            response = self.decide(path, 1)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(json.loads(response.data)['status'], 'Request is no longer pending')
+        with app.app_context():
+            self.assertEqual(AuditLogModel.query.filter_by(request_id=1).count(), 1)
+        self.assertEqual(self.publish.call_count, 1)
+
+    def test_request_back_to_pending_keeps_one_audit_row(self):
+        self.assertEqual(self.decide('/reject_request', 1).status_code, 200)
+        with app.app_context():
+            # micro_request moves an edited request back to pending
+            db.session.get(RequestModel, 1).status = 'pending'
+            OccurrenceModel.query.filter_by(request_id=1).update({'status': 'pending'})
+            db.session.commit()
+
+        self.assertEqual(self.decide('/approve_request', 1).status_code, 200)
+        with app.app_context():
+            self.assertEqual(db.session.get(RequestModel, 1).status, 'Approved')
+            self.assertEqual([log.action for log in AuditLogModel.query.filter_by(request_id=1)], ['Rejected'])
+        self.assertFalse(any(column.unique for column in AuditLogModel.__table__.c))
+
+    def test_unknown_request(self):
+        response = self.decide('/approve_request', 42)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.data)['status'], 'Request not found')
+        self.publish.assert_not_called()
 
-        # Send POST request to the reject endpoint
-        response = self.app.post(
-            '/reject_request',
-            data=json.dumps(data),
-            content_type='application/json'
-        )
+    def test_decide_requests_reports_each_outcome(self):
+        with app.app_context():
+            self.add_request(5, 10, 8, 1, status='Rejected')
+            db.session.commit()
 
-        # Assert the response status code
+        response = self.app.post('/decide_requests', json={
+            'request_ids': [1, 2, 5, 99, 1], 'decision': 'approve', 'reporting_manager_id': 2003
+        })
         self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        # Duplicate ids are decided once
+        self.assertEqual(data['results'], [
+            {'request_id': 1, 'status': 'Approved'},
+            {'request_id': 2, 'status': 'Approved'},
+            {'request_id': 5, 'status': 'not_pending'},
+            {'request_id': 99, 'status': 'not_found'},
+        ])
+        self.assertTrue(data['notified'])
+        self.assertEqual([m['email'] for m in self.publish.call_args.args[0]],
+                         ['staff7@allinone.com.sg', 'staff8@allinone.com.sg'])
+        self.assertEqual(self.counters()[4], (2, 1))
+
+    def test_decide_requests_validation(self):
+        batch = {'request_ids': [1], 'decision': 'approve', 'reporting_manager_id': 2003}
+        self.assertEqual(self.app.post('/decide_requests', json={**batch, 'request_ids': []}).status_code, 400)
+        self.assertEqual(self.app.post('/decide_requests', json={**batch, 'request_ids': ['1']}).status_code, 400)
+        self.assertEqual(self.app.post('/decide_requests', json={**batch, 'decision': 'maybe'}).status_code, 400)
+        self.assertEqual(self.app.post('/decide_requests', json={**batch, 'reporting_manager_id': None}).status_code, 400)
+
+        too_many = list(range(1, MAX_DECISION_BATCH + 2))
+        response = self.app.post('/decide_requests', json={**batch, 'request_ids': too_many})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(str(MAX_DECISION_BATCH), json.loads(response.data)['status'])
+        response = self.app.post('/decide_requests', json={**batch, 'request_ids': too_many[:-1]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_capacity_limit_holds_within_a_batch(self):
+        self.set_limit(headcount=4)  # two of IT may work from home on the same day
+
+        response = self.app.post('/decide_requests', json={
+            'request_ids': [1, 2, 3], 'decision': 'approve', 'reporting_manager_id': 2003
+        })
+        self.assertEqual([r['status'] for r in json.loads(response.data)['results']], ['Approved', 'Approved', 'capacity_full'])
+        self.assertEqual(json.loads(response.data)['results'][2]['full_dates'], ['2024-03-04'])
+        self.assertEqual(self.counters()[4], (2, 1))
+
+        response = self.decide('/approve_request', 3)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)['full_dates'], ['2024-03-04'])
+        # Rejecting is never limited
+        self.assertEqual(self.decide('/reject_request', 3).status_code, 200)
+
+    def test_apply_decisions(self):
+        self.set_limit(headcount=2)  # one of IT a day
+        with app.app_context():
+            outcomes, messages = apply_decisions([4, 1, 2], 'Approved', 2003, 'Enjoy')
+            self.assertEqual(outcomes, [
+                {'request_id': 4, 'status': 'Approved'},
+                {'request_id': 1, 'status': 'Approved'},
+                {'request_id': 2, 'status': 'capacity_full', 'full_dates': ['2024-03-04']},
+            ])
+            self.assertEqual([m['start_date'] for m in messages], ['2024-03-05', '2024-03-04'])
+            self.assertEqual(sorted(log.request_id for log in AuditLogModel.query), [1, 4])
+            # staff 7 had two approvals in the batch; schedule keeps one row per staff member
+            self.assertEqual(ScheduleModel.query.count(), 1)
+
+            outcomes, messages = apply_decisions([2], 'Rejected', 2003, '')
+            self.assertEqual(outcomes, [{'request_id': 2, 'status': 'Rejected'}])
+        # Request 3 is still pending on the 4th
+        self.assertEqual(self.counters(), {4: (1, 1), 5: (1, 0), 6: (1, 0)})
+
+class AuditLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        with app.app_context():
+            db.create_all()
+            for request_id in range(1, 31):
+                log = AuditLogModel(request_id, f'staff{request_id % 4}@allinone.com.sg',
+                                    'Approved' if request_id % 3 else 'Rejected', 2003 + request_id % 2,
+                                    'manager@allinone.com.sg', date(2024, 3, 1 + request_id % 28), 1,
+                                    'IT' if request_id % 2 else 'Sales', '')
+                # Half logged by CURRENT_TIMESTAMP, most within the same second, half at set times
+                if request_id > 15:
+                    log.action_timestamp = datetime(2024, 3, 1 + request_id % 5, 9, 30, 0, request_id * 1000)
+                db.session.add(log)
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def pages(self, query, limit):
+        """Follow X-Next-Cursor from the first page to the last; returns the log ids in order."""
+        ids, cursor = [], None
+        while True:
+            response = self.app.get(f'/audit_log?{query}&limit={limit}' + (f'&cursor={cursor}' if cursor else ''))
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.data)
+            self.assertLessEqual(len(page), limit)
+            ids += [log['log_id'] for log in page]
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                return ids
+
+    def test_keyset_pages_cover_every_row_once(self):
+        everything = [log['log_id'] for log in json.loads(self.app.get('/audit_log').data)]
+        for limit in (1, 4, 7, 30, 50):
+            with self.subTest(limit=limit):
+                ids = self.pages('department=', limit)
+                self.assertEqual(len(ids), len(set(ids)))
+                self.assertEqual(sorted(ids), sorted(everything))
+
+        # Newest first: the set timestamps are all older than the ones the database wrote just now
+        ids = self.pages('department=', 4)
+        self.assertEqual(sorted(ids[:15]), list(range(1, 16)))
+
+    def test_filters_and_count(self):
+        for query in ('department=IT', 'reporting_manager_id=2004&action=rejected', 'requester_email=staff1@allinone.com.sg',
+                      'from=2024-03-02&to=2024-03-03', 'department=Sales&to=2024-03-02'):
+            with self.subTest(query=query):
+                ids = self.pages(query, 3)
+                self.assertEqual(len(ids), len(set(ids)))
+                count = json.loads(self.app.get(f'/audit_log?{query}&count=1').data)['count']
+                self.assertEqual(count, len(ids))
+        self.assertEqual(self.app.get('/audit_log?from=yesterday').status_code, 400)
+        self.assertEqual(self.app.get('/audit_log?limit=0').status_code, 400)
+        self.assertEqual(self.app.get('/audit_log?limit=5&cursor=nonsense').status_code, 400)
+
+    def test_export_csv_ndjson_and_gzip(self):
+        plain = self.app.get('/audit_log/export?department=IT')
+        self.assertEqual(plain.mimetype, 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(plain.data.decode())))
+        self.assertEqual(len(rows), json.loads(self.app.get('/audit_log?department=IT&count=1').data)['count'])
+        self.assertEqual({row['department'] for row in rows}, {'IT'})
+
+        compressed = self.app.get('/audit_log/export?department=IT&gzip=1')
+        self.assertEqual(compressed.mimetype, 'application/gzip')
+        self.assertIn('.csv.gz', compressed.headers['Content-Disposition'])
+        self.assertEqual(gzip.decompress(compressed.data), plain.data)
 
-        # Assert the response data
-        response_data = json.loads(response.data)
-        self.assertEqual(response_data['status'], 'Request rejected')
+        ndjson = self.app.get('/audit_log/export?format=ndjson&gzip=1')
+        lines = gzip.decompress(ndjson.data).decode().splitlines()
+        self.assertEqual(len(lines), 30)
+        self.assertEqual(gzip.decompress(ndjson.data), self.app.get('/audit_log/export?format=ndjson').data)
+        self.assertEqual(self.app.get('/audit_log/export?format=xml').status_code, 400)
 
 if __name__ == '__main__':
     unittest.main()
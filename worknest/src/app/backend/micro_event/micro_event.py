@@ -37,10 +37,31 @@ class event(db.Model):
             'event_date': self.event_date.strftime('%d-%m-%Y') 
         }
 
+@app.after_request
+def add_etag(response):
+    if request.method == 'GET' and response.status_code == 200:
+        response.add_etag()
+    return response.make_conditional(request)
+
+
 #Route to get all events
 @app.route('/event/public-holiday', methods=['GET'])
 def get_all_events():
-    events = event.query.all()
+    # Optional filters: ?department=IT&start=2024-01-01&end=2024-03-31 (dates stored as YYYY-MM-DD)
+    department = request.args.get('department')
+    start = request.args.get('start')
+    end = request.args.get('end')
+    if not department and not start and not end:
+        events = event.query.all()
+    else:
+        query = event.query
+        if department:
+            query = query.filter_by(department=department)
+        if start:
+            query = query.filter(event.event_date >= start)
+        if end:
+            query = query.filter(event.event_date <= end)
+        events = query.all()
     return jsonify([event.to_dict() for event in events])
 
 if __name__ == '__main__':
@@ -39,5 +39,9 @@ class EventTestCase(unittest.TestCase):
         self.assertEqual(data[0]['event_name'], 'Public Holiday')
         self.assertEqual(data[0]['event_date'], '01-01-2024')  # Checking DD-MM-YYYY format
 
+        # Same body again: a revalidation with its ETag is answered 304
+        again = self.app.get('/event/public-holiday', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
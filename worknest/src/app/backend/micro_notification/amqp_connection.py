@@ -1,25 +1,24 @@
 # rabbitmq connection setup
 import pika
-import os
+from amqp_publisher import connection_parameters, partition_queue, partition_queues, queue_arguments
 
 def setup_rabbitmq_connection():
-    """Establish a connection to RabbitMQ and declare the email queue."""
-    rabbitmq_host = os.getenv('RABBITMQ_HOST', 'rabbitmq')  # Fallback to localhost if not set
-    credentials = pika.PlainCredentials('guest', 'guest')  # Replace with actual credentials
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host, credentials=credentials))
+    """Establish a connection to RabbitMQ and declare the email queue (or each of its partitions)."""
+    connection = pika.BlockingConnection(connection_parameters())  # RABBITMQ_HOST, heartbeats
     channel = connection.channel()
     
-    # Declare a durable queue, ensuring it survives RabbitMQ restarts
-    channel.queue_declare(queue='email_queue', durable=True)
+    # Declare durable queues, ensuring they survive RabbitMQ restarts
+    for queue in partition_queues('email_queue'):
+        channel.queue_declare(queue=queue, durable=True, arguments=queue_arguments(queue))
     
     return connection, channel  # Return both connection and channel
 
 MSG_PROPERTIES = pika.BasicProperties(delivery_mode=2)
-def publish_message(channel, message):
-    """Publish a message to the email_queue."""
+def publish_message(channel, message, key=None):
+    """Publish a message to the email_queue, or to the partition for key (the requester email)."""
     channel.basic_publish(
         exchange='',
-        routing_key='email_queue',
+        routing_key=partition_queue(key or '', 'email_queue'),
         body=message,
         properties=MSG_PROPERTIES,
         mandatory=True
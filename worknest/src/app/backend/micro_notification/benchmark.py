@@ -0,0 +1,180 @@
+# floods email_queue through an in-process broker and reports throughput and latency per worker configuration
+#   python benchmark.py --messages 2000 --send-latency 0.05 --configs 1x1 20x8 50x32 20x8+digest
+import argparse
+from collections import deque
+import json
+import logging
+import threading
+import time
+
+from notification import EmailWorker
+from transports import MemoryTransport, get_transport
+
+
+class LocalBroker:
+    """Stands in for a RabbitMQ queue and pika.BlockingConnection, with just what EmailWorker uses.
+
+    Like the real broker it hands the consumer at most prefetch_count unacked messages,
+    and it records for each message the time from publish to ack (end-to-end latency).
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.ready = deque()  # (published at, body)
+        self.unacked = {}
+        self.callbacks = deque()
+        self.latencies = []
+        self.parked = []
+        self.on_message = None
+        self.prefetch_count = 0
+        self.next_tag = 0
+        self.is_open = True
+
+    def publish(self, body):
+        with self.lock:
+            self.ready.append((time.perf_counter(), body))
+            self.lock.notify()
+
+    # ---- pika.BlockingConnection / BlockingChannel ----
+
+    def __call__(self, parameters):
+        return self
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue, durable, arguments=None):
+        pass
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.parked.append((routing_key, body))  # retries and dead letters leave the benchmark
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        self.on_message = on_message_callback
+        return 'benchmark'
+
+    def basic_cancel(self, consumer_tag):
+        self.on_message = None
+        return []
+
+    def basic_ack(self, delivery_tag):
+        published_at, _ = self.unacked.pop(delivery_tag)
+        self.latencies.append(time.perf_counter() - published_at)
+
+    def basic_nack(self, delivery_tag, requeue):
+        message = self.unacked.pop(delivery_tag)
+        if requeue:
+            with self.lock:
+                self.ready.appendleft(message)
+
+    def add_callback_threadsafe(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+            self.lock.notify()
+
+    def deliverable(self):
+        return self.on_message is not None and self.ready and len(self.unacked) < self.prefetch_count
+
+    def process_data_events(self, time_limit=0):
+        with self.lock:
+            self.lock.wait_for(lambda: self.callbacks or self.deliverable(), timeout=time_limit)
+            callbacks, self.callbacks = self.callbacks, deque()
+        for callback in callbacks:
+            callback()
+        while True:
+            with self.lock:
+                if not self.deliverable():
+                    return
+                self.next_tag += 1
+                self.unacked[self.next_tag] = message = self.ready.popleft()
+            self.on_message(self, Delivery(self.next_tag), None, message[1])
+
+    def close(self):
+        self.is_open = False
+
+
+class Delivery:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+def parse_config(config):
+    """'20x8' is prefetch 20 with 8 send threads; a '+digest' suffix turns on a 1 second digest window."""
+    sizes, _, mode = config.partition('+')
+    prefetch, threads = (int(n) for n in sizes.split('x'))
+    return {'prefetch_count': prefetch, 'send_threads': threads, 'digest_window': 1 if mode == 'digest' else 0}
+
+
+def decision_message(i, managers=20):
+    return json.dumps({'action': 'Approved' if i % 3 else 'Rejected', 'email': f'staff{i}@allinone.com.sg',
+                       'reporting_manager_email': f'manager{i % managers}@allinone.com.sg',
+                       'start_date': '2024-01-15', 'approver_comment': '', 'duration': 1})
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def run_benchmark(config, messages=1000, transport=None, rate=0, timeout=300):
+    """Push messages through one worker configuration; returns throughput and latency figures."""
+    broker = LocalBroker()
+    transport = transport or MemoryTransport()
+    worker = EmailWorker(parameters=object(), connection_factory=broker, send=transport.send, **parse_config(config))
+    thread = threading.Thread(target=worker.run, name=f'benchmark-{config}')
+    thread.start()
+
+    started = time.perf_counter()
+    for i in range(messages):
+        if rate:
+            time.sleep(max(0, started + i / rate - time.perf_counter()))
+        broker.publish(decision_message(i))
+    deadline = time.monotonic() + timeout
+    while len(broker.latencies) < messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    worker.stop()
+    thread.join()
+    transport.close()
+
+    done = len(broker.latencies)
+    return {
+        'config': config,
+        'messages': done,
+        'seconds': elapsed,
+        'per_second': done / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(broker.latencies, 0.5) * 1000,
+        'p99_ms': percentile(broker.latencies, 0.99) * 1000,
+        'emails': len(transport.sent) if isinstance(transport, MemoryTransport) else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the email worker against an in-process broker.')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--configs', nargs='+', default=['1x1', '20x8', '50x32', '20x8+digest'],
+                        help='PREFETCHxTHREADS[+digest]; 1x1 is the old one-at-a-time consumer')
+    parser.add_argument('--transport', choices=['memory', 'smtp', 'file'], default='memory')
+    parser.add_argument('--send-latency', type=float, default=0.05,
+                        help='seconds each send takes with the memory transport (a Gmail API call is ~0.05-0.3)')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second to publish; 0 floods the queue')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(f"{'config':<14}{'messages':>10}{'emails':>8}{'msg/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for config in args.configs:
+        transport = MemoryTransport(args.send_latency) if args.transport == 'memory' else get_transport(args.transport)
+        result = run_benchmark(config, args.messages, transport, args.rate)
+        emails = '-' if result['emails'] is None else result['emails']
+        print(f"{config:<14}{result['messages']:>10}{emails:>8}{result['per_second']:>10.1f}"
+              f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
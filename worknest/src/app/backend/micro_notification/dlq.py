@@ -0,0 +1,92 @@
+# inspect, replay or purge the email dead-letter queue
+#   python dlq.py list [--limit 20]
+#   python dlq.py replay [--limit 100]
+#   python dlq.py purge
+# With EMAIL_QUEUE_PARTITIONS > 1 every partition's dead-letter queue is covered;
+# --queue email_queue.3 narrows a command to one partition.
+import argparse
+import json
+
+import pika
+from amqp_publisher import PARTITION_QUEUE, connection_parameters, partition_queues, queue_arguments
+from notification import EMAIL_QUEUE, dead_letter_queue, declare_retry_topology
+
+
+def peek(channel, queue, limit):
+    """Up to limit dead letters as (delivery tag, headers, body), left unacked."""
+    messages = []
+    while len(messages) < limit:
+        method, properties, body = channel.basic_get(queue=queue, auto_ack=False)
+        if method is None:
+            break
+        messages.append((method.delivery_tag, properties.headers or {}, body))
+    return messages
+
+
+def list_dead_letters(channel, queue, limit):
+    messages = peek(channel, queue, limit)
+    for delivery_tag, headers, body in messages:
+        try:
+            summary = json.loads(body)
+            summary = f"{summary.get('action')} {summary.get('email')} {summary.get('start_date')}"
+        except (ValueError, AttributeError):
+            summary = body[:80]
+        print(f"#{delivery_tag} attempts={headers.get('x-attempts', 0)} sent={headers.get('x-sent', [])} "
+              f"error={headers.get('x-last-error', '-')!r}: {summary}")
+    # Nothing was acked, so the broker puts them all back
+    if messages:
+        channel.basic_nack(delivery_tag=0, multiple=True, requeue=True)
+    return len(messages)
+
+
+def replay_dead_letters(channel, queue, limit):
+    """Move dead letters back onto queue with a fresh attempt count; already-sent emails stay skipped."""
+    channel.confirm_delivery()
+    replayed = 0
+    for delivery_tag, headers, body in peek(channel, dead_letter_queue(queue), limit):
+        headers = {key: value for key, value in headers.items() if key not in ('x-attempts', 'x-last-error', 'x-death')}
+        channel.basic_publish(exchange='', routing_key=queue, body=body,
+                              properties=pika.BasicProperties(delivery_mode=2, headers=headers))
+        channel.basic_ack(delivery_tag)
+        replayed += 1
+    return replayed
+
+
+def command_queues(queue):
+    """The queues a command covers: every partition of a logical queue, or the one partition named."""
+    return [queue] if PARTITION_QUEUE.search(queue) else partition_queues(queue)
+
+
+def declare(channel, queue):
+    """Declare queue with the arguments the workers use, or the broker refuses it, and its retry and dead queues."""
+    channel.queue_declare(queue=queue, durable=True, arguments=queue_arguments(queue))
+    declare_retry_topology(channel, queue)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect, replay or purge the email dead-letter queue.')
+    parser.add_argument('command', choices=['list', 'replay', 'purge'])
+    parser.add_argument('--queue', default=EMAIL_QUEUE)
+    parser.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    connection = pika.BlockingConnection(connection_parameters())
+    try:
+        channel = connection.channel()
+        for queue in command_queues(args.queue):
+            declare(channel, queue)
+            dead = dead_letter_queue(queue)
+            if args.command == 'list':
+                shown = list_dead_letters(channel, dead, args.limit)
+                depth = channel.queue_declare(queue=dead, durable=True, passive=True).method.message_count
+                print(f"{shown} shown, {depth} in {dead}")
+            elif args.command == 'replay':
+                print(f"Replayed {replay_dead_letters(channel, queue, args.limit)} messages onto {queue}")
+            else:
+                purged = channel.queue_purge(queue=dead).method.message_count
+                print(f"Purged {purged} messages from {dead}")
+    finally:
+        connection.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,27 @@
-# send email using gmail api 
+# send email using gmail api
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request  
+from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 import base64
 import os
+import threading
 
 # If modifying these SCOPES, delete the token.json file.
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
 
+# Credentials are read from token.json once per process and shared; each sending thread
+# gets its own service client because the underlying httplib2 connection is not thread-safe.
+_creds = None
+_creds_lock = threading.Lock()
+_local = threading.local()
+
 def gmail_authenticate():
     creds = None
     # The file token.json stores the user's access and refresh tokens
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    
+
     # If no valid credentials are available, raise an error
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -29,9 +36,34 @@ def gmail_authenticate():
 
     return creds
 
+def get_credentials():
+    """The process-wide credentials, loaded on first use and refreshed only once expired."""
+    global _creds
+    with _creds_lock:
+        if _creds is None:
+            _creds = gmail_authenticate()
+        elif not _creds.valid and _creds.refresh_token:
+            _creds.refresh(Request())
+        return _creds
+
+def get_service():
+    """This thread's Gmail client, built from the discovery document bundled with the library."""
+    creds = get_credentials()
+    service = getattr(_local, 'service', None)
+    if service is None or _local.creds is not creds:
+        service = build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
+        _local.service, _local.creds = service, creds
+    return service
+
+def reset_service():
+    """Forget the cached credentials and clients, e.g. after token.json was replaced."""
+    global _creds
+    with _creds_lock:
+        _creds = None
+    _local.__dict__.clear()
+
 def send_email_notification(to_email, subject, message_body):
-    creds = gmail_authenticate()
-    service = build('gmail', 'v1', credentials=creds)
+    service = get_service()
 
     message = create_message(to_email, subject, message_body)
     service.users().messages().send(userId="me", body=message).execute()
@@ -39,4 +71,4 @@ def send_email_notification(to_email, subject, message_body):
 def create_message(to_email, subject, message_body):
     message = f"To: {to_email}\nSubject: {subject}\n\n{message_body}"
     raw = base64.urlsafe_b64encode(message.encode('utf-8')).decode('utf-8')
-    return {'raw': raw}
\ No newline at end of file
+    return {'raw': raw}
@@ -1,16 +1,70 @@
 # consumes rabbitmq messages & triggers logic to send an email notifications
-import pika
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
 import json
-from email_notify import send_email_notification
 import logging
+import multiprocessing
+import os
+import random
+import signal
+import threading
+import time
+
+import pika
+from pika.exceptions import AMQPError
+from amqp_publisher import connection_parameters, partition_queues, queue_arguments
+from transports import send_email  # EMAIL_TRANSPORT: gmail by default
 
 logging.basicConfig(level=logging.INFO)
 
+EMAIL_QUEUE = os.getenv('EMAIL_QUEUE', 'email_queue')
+EMAIL_PREFETCH = int(os.getenv('EMAIL_PREFETCH') or 20)  # unacked messages the broker hands each worker
+EMAIL_SEND_THREADS = int(os.getenv('EMAIL_SEND_THREADS') or 8)  # concurrent sends per worker process
+EMAIL_WORKER_PROCESSES = int(os.getenv('EMAIL_WORKER_PROCESSES') or 1)
+# Consumer group over the EMAIL_QUEUE_PARTITIONS partitions: members share the partitions
+# out between them. GROUP_MEMBER is the index of this host's first worker process.
+EMAIL_GROUP_SIZE = int(os.getenv('EMAIL_GROUP_SIZE') or 0)  # 0: the worker processes on this host
+EMAIL_GROUP_MEMBER = int(os.getenv('EMAIL_GROUP_MEMBER') or 0)
+EMAIL_STATS_INTERVAL = float(os.getenv('EMAIL_STATS_INTERVAL') or 60)  # seconds between throughput log lines
+EMAIL_SHUTDOWN_TIMEOUT = float(os.getenv('EMAIL_SHUTDOWN_TIMEOUT') or 30)  # seconds to finish in-flight sends
+DIGEST_WINDOW_SECONDS = float(os.getenv('DIGEST_WINDOW_SECONDS') or 0)  # 0 sends approver confirmations one by one
+EMAIL_RETRY_DELAYS = [int(delay) for delay in (os.getenv('EMAIL_RETRY_DELAYS') or '5,30,120,600').split(',')]  # seconds
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS') or len(EMAIL_RETRY_DELAYS) + 1)
 
-def callback(ch, method, properties, body):
-    message = json.loads(body)
-    logging.info(f"Received message: {message}")
 
+def retry_queue(queue, delay):
+    return f'{queue}.retry.{delay}s'
+
+
+def dead_letter_queue(queue):
+    return f'{queue}.dead'
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the given number of failed attempts; the last delay repeats."""
+    return EMAIL_RETRY_DELAYS[min(attempts, len(EMAIL_RETRY_DELAYS)) - 1]
+
+
+def declare_retry_topology(channel, queue=None):
+    """Declare the delay queues and the dead-letter queue that go with queue.
+
+    Delay queues have no consumers: a message waits in one for the queue's TTL, then the
+    broker dead-letters it through the default exchange back onto queue. Failed messages
+    therefore wait on the broker instead of holding up a worker thread.
+    """
+    queue = queue or EMAIL_QUEUE
+    for delay in EMAIL_RETRY_DELAYS:
+        channel.queue_declare(queue=retry_queue(queue, delay), durable=True, arguments={
+            'x-message-ttl': delay * 1000,
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': queue,
+        })
+    channel.queue_declare(queue=dead_letter_queue(queue), durable=True)
+
+
+def build_emails(message):
+    """The (to, subject, body) of the requester and approver emails for one decision message."""
     # Extract details from the message
     action = message['action']
     requester_email = message['email']
@@ -18,7 +72,7 @@ def callback(ch, method, properties, body):
     start_date = message['start_date']
     approver_comment = message['approver_comment']
     duration = message['duration']
-    
+
     if action == 'Approved':
         requester_subject = "WFH Request Approved"
         requester_body = (
@@ -40,22 +94,347 @@ def callback(ch, method, properties, body):
         approver_subject = "Rejection Confirmation"
         approver_body = f"You have rejected the WFH request for {start_date} from the requester. Comments: {approver_comment}"
 
-    # Send email to requester
-    send_email_notification(requester_email, requester_subject, requester_body)
-    
-    # Send email to approver
-    send_email_notification(reporting_manager_email, approver_subject, approver_body)
+    return [
+        (requester_email, requester_subject, requester_body),
+        (reporting_manager_email, approver_subject, approver_body),
+    ]
+
+
+def digest_line(message):
+    """One decision as a line of an approver's summary email."""
+    action = 'Approved' if message['action'] == 'Approved' else 'Rejected'
+    return (f"{action}: WFH request from {message['email']} for {message['start_date']} "
+            f"({message['duration']} days). Comments: {message['approver_comment']}")
+
+
+def build_digest(lines):
+    """The (subject, body) of a summary email covering several decisions by one approver."""
+    subject = f"Confirmation of {len(lines)} WFH decision{'s' if len(lines) != 1 else ''}"
+    body = "You have made the following WFH decisions:\n\n" + "\n".join(f"- {line}" for line in lines)
+    return subject, body
+
+
+class ApproverDigest:
+    """Approver confirmations collected per manager until their window expires.
+
+    The window starts with a manager's first pending confirmation, so a manager gets
+    at most one summary email per window however many requests they decide.
+    """
+
+    def __init__(self, window=None):
+        self.window = DIGEST_WINDOW_SECONDS if window is None else window
+        self.lock = threading.Lock()
+        self.pending = {}  # manager email -> (window start, [lines])
+        self.counters = {'confirmations': 0, 'emails': 0}
+
+    def add(self, manager_email, line):
+        with self.lock:
+            started, lines = self.pending.setdefault(manager_email, (time.monotonic(), []))
+            lines.append(line)
+            self.counters['confirmations'] += 1
+
+    def restore(self, manager_email, lines):
+        """Put back the lines of a summary that could not be sent, ahead of newer ones."""
+        with self.lock:
+            started, pending = self.pending.get(manager_email, (time.monotonic(), []))
+            self.pending[manager_email] = (started, lines + pending)
+
+    def take(self, everything=False):
+        """Remove and return [(manager email, lines)] whose window has expired (or all of them)."""
+        now = time.monotonic()
+        with self.lock:
+            due = [email for email, (started, _) in self.pending.items() if everything or now - started >= self.window]
+            return [(email, self.pending.pop(email)[1]) for email in due]
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(lines) for _, lines in self.pending.values())
+
+
+def handle_message(body, send=send_email, digest=None, sent=None):
+    """Send both emails for a message. sent holds the indexes of emails already sent by an
+    earlier attempt, which are skipped, and is updated as each one goes out."""
+    sent = set() if sent is None else sent
+    message = json.loads(body)
+    logging.info(f"Received message: {message}")
+    requester, approver = build_emails(message)
+    # Send email to requester, then to approver unless the confirmation goes into a digest
+    if 0 not in sent:
+        send(*requester)
+        sent.add(0)
+    if 1 not in sent:
+        if digest is None:
+            send(*approver)
+        else:
+            digest.add(approver[0], digest_line(message))
+        sent.add(1)
+
+
+def assigned_queues(member, size, queue=None):
+    """The partitions of queue that consumer group member (0 .. size-1) consumes."""
+    return [partition for i, partition in enumerate(partition_queues(queue or EMAIL_QUEUE)) if i % size == member]
 
 
-def start_worker():
-    connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq', 5672))
-    channel = connection.channel()
-    channel.queue_declare(queue='email_queue', durable=True)  # Ensure queue is durable
-    channel.basic_consume(queue='email_queue', on_message_callback=callback, auto_ack=True)
-    print('Worker started, waiting for messages...')
-    channel.start_consuming()
+def callback(ch, method, properties, body):
+    handle_message(body)
+
+
+class EmailWorker:
+    """Consumes the email queue with manual acks and sends on a thread pool.
+
+    The broker hands the worker up to prefetch_count unacked messages; each one is sent
+    on the pool and acked only once both of its emails have gone out. pika's connection
+    belongs to the consuming thread, so pool threads hand their outcome back to it with
+    add_callback_threadsafe.
+
+    A failed send is republished to the delay queue for its attempt (see
+    declare_retry_topology) with x-attempts and x-sent headers, so the retry skips the
+    emails that did go out; after max_attempts, or straight away for a message that is
+    not valid JSON or lacks a field, it goes to the dead-letter queue (see dlq.py). The
+    original is acked only after the broker has confirmed the republish.
+
+    stop() (SIGTERM/SIGINT) cancels the consumer and waits for in-flight sends before
+    closing, so nothing is lost: anything unacked when the connection closes is
+    redelivered.
+
+    In ordered mode (the consumer group over partition queues) each queue is a lane: its
+    messages are sent one at a time, in delivery order, while different queues are sent
+    in parallel. As every message for a requester lands in the same partition, their
+    emails go out in order; only a message that has to be retried falls behind.
+
+    With a digest window the approver confirmation is not sent per message: the message
+    is acked once the requester email is out and its confirmation is queued, and each
+    manager gets one summary when their window expires or the worker shuts down. Queued
+    confirmations do not survive a crash, only a graceful stop.
+    """
+
+    def __init__(self, queue=None, prefetch_count=None, send_threads=None, parameters=None,
+                 connection_factory=pika.BlockingConnection, send=send_email, digest_window=None, max_attempts=None,
+                 queues=None, ordered=False):
+        self.queue = queue or EMAIL_QUEUE
+        self.queues = queues or [self.queue]
+        self.ordered = ordered
+        self.lanes = {}  # queue -> deliveries waiting, the first one being sent (ordered mode)
+        self.prefetch_count = prefetch_count or EMAIL_PREFETCH
+        self.send_threads = send_threads or EMAIL_SEND_THREADS
+        self.parameters = parameters or connection_parameters()
+        self.connection_factory = connection_factory
+        self.send = send
+        self.max_attempts = max_attempts or EMAIL_MAX_ATTEMPTS
+        window = DIGEST_WINDOW_SECONDS if digest_window is None else digest_window
+        self.digest = ApproverDigest(window) if window > 0 else None
+        self.connection = None
+        self.channel = None
+        self.consumer_tags = []
+        self.stopping = threading.Event()
+        self.in_flight = 0
+        self.counters = {'acked': 0, 'retried': 0, 'dead_lettered': 0}
+        self.started = time.monotonic()
+
+    def stop(self, *args):
+        self.stopping.set()
+
+    # ---- consuming thread ----
+
+    def connect(self):
+        self.connection = self.connection_factory(self.parameters)
+        self.channel = self.connection.channel()
+        for queue in self.queues:
+            self.channel.queue_declare(queue=queue, durable=True, arguments=queue_arguments(queue))
+            declare_retry_topology(self.channel, queue)
+        self.channel.confirm_delivery()
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.consumer_tags = [
+            self.channel.basic_consume(queue=queue, on_message_callback=functools.partial(self.on_message, queue),
+                                       auto_ack=False)
+            for queue in self.queues
+        ]
+
+    def disconnect(self):
+        connection, self.connection, self.channel = self.connection, None, None
+        self.in_flight = 0  # unacked deliveries on a closed connection are the broker's again
+        self.lanes = {}
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def on_message(self, queue, channel, method, properties, body):
+        self.in_flight += 1
+        delivery = (self.connection, channel, queue, method.delivery_tag, properties, body)
+        if not self.ordered:
+            self.pool.submit(self.process, *delivery)
+            return
+        lane = self.lanes.setdefault(queue, deque())
+        lane.append(delivery)
+        if len(lane) == 1:
+            self.pool.submit(self.process, *delivery)
+
+    def settle(self, channel, queue, delivery_tag, outcome, body=None, headers=None):
+        self.in_flight -= 1
+        if channel is not self.channel or not channel.is_open:
+            return  # the connection was lost; the broker redelivers the message
+        if outcome != 'acked':
+            target = (retry_queue(queue, retry_delay(headers['x-attempts'])) if outcome == 'retried'
+                      else dead_letter_queue(queue))
+            # In confirm mode this returns once the broker has the copy, so acking below cannot lose it
+            channel.basic_publish(exchange='', routing_key=target, body=body,
+                                  properties=pika.BasicProperties(delivery_mode=2, headers=headers))
+        channel.basic_ack(delivery_tag)
+        self.counters[outcome] += 1
+        lane = self.lanes.get(queue)
+        if lane:
+            # Ordered mode: start the next message of this queue now that this one is settled
+            lane.popleft()
+            if lane:
+                self.pool.submit(self.process, *lane[0])
+
+    def flush_digest(self, everything=False):
+        """Send the summaries that are due on the pool; returns their futures."""
+        if self.digest is None:
+            return []
+        return [self.pool.submit(self.send_digest, email, lines) for email, lines in self.digest.take(everything)]
+
+    def drain(self, timeout):
+        """Keep servicing the connection until every in-flight send has settled."""
+        deadline = time.monotonic() + timeout
+        while self.in_flight and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.1)
+
+    def run(self):
+        self.pool = ThreadPoolExecutor(max_workers=self.send_threads, thread_name_prefix='email-send')
+        failures = 0
+        last_report = time.monotonic()
+        logging.info(f'Worker {os.getpid()} consuming {", ".join(self.queues)} '
+                     f'(prefetch {self.prefetch_count}, {self.send_threads} send threads)')
+        try:
+            while not self.stopping.is_set():
+                try:
+                    if self.channel is None:
+                        self.connect()
+                        failures = 0
+                    self.connection.process_data_events(time_limit=1)
+                except AMQPError as e:
+                    failures += 1
+                    logging.warning(f'Lost connection to the broker ({e}), reconnecting')
+                    self.disconnect()
+                    self.stopping.wait(random.uniform(0, min(30, 0.5 * 2 ** failures)))
+                self.flush_digest()
+                if time.monotonic() - last_report >= EMAIL_STATS_INTERVAL:
+                    logging.info(self.throughput())
+                    last_report = time.monotonic()
+
+            if self.channel is not None:
+                for consumer_tag in self.consumer_tags:
+                    self.channel.basic_cancel(consumer_tag)
+                self.drain(EMAIL_SHUTDOWN_TIMEOUT)
+        finally:
+            # Confirmations still waiting for their window go out now rather than being lost
+            wait(self.flush_digest(everything=True), EMAIL_SHUTDOWN_TIMEOUT)
+            self.pool.shutdown(wait=True)
+            self.disconnect()
+            logging.info(f'Worker {os.getpid()} stopped: {self.throughput()}')
+
+    # ---- pool threads ----
+
+    def process(self, connection, channel, queue, delivery_tag, properties, body):
+        headers = dict(getattr(properties, 'headers', None) or {})
+        sent = set(headers.get('x-sent') or [])
+        attempts = int(headers.get('x-attempts') or 0)
+        try:
+            handle_message(body, self.send, self.digest, sent)
+            outcome = 'acked'
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f'Dead-lettering malformed message {body!r}: {e}')
+            outcome, error = 'dead_lettered', e
+        except Exception as e:
+            attempts += 1
+            outcome, error = ('retried' if attempts < self.max_attempts else 'dead_lettered'), e
+            logging.warning(f'Sending failed on attempt {attempts} ({e}), '
+                            + (f'retrying in {retry_delay(attempts)}s' if outcome == 'retried' else 'dead-lettering'))
+        if outcome != 'acked':
+            headers.update({'x-attempts': attempts, 'x-sent': sorted(sent), 'x-last-error': str(error)[:500]})
+        try:
+            connection.add_callback_threadsafe(functools.partial(self.settle, channel, queue, delivery_tag, outcome, body, headers))
+        except Exception:
+            pass  # connection already closed; the message will be redelivered
+
+    def send_digest(self, manager_email, lines):
+        try:
+            self.send(manager_email, *build_digest(lines))
+        except Exception as e:
+            if self.stopping.is_set():
+                logging.error(f'Sending the digest to {manager_email} failed ({e}); {len(lines)} confirmations not sent')
+            else:
+                logging.warning(f'Sending the digest to {manager_email} failed ({e}), keeping it for the next window')
+                self.digest.restore(manager_email, lines)
+            return
+        with self.digest.lock:
+            self.digest.counters['emails'] += 1
+
+    # ---- stats ----
+
+    def throughput(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f"{self.counters['acked']} messages sent ({self.counters['acked'] / elapsed:.2f}/s), "
+                f"{self.counters['retried']} retried, {self.counters['dead_lettered']} dead-lettered, {self.in_flight} in flight")
+
+    def metrics(self):
+        """Prometheus text lines for the worker."""
+        lines = ['# TYPE email_worker_in_flight gauge', f'email_worker_in_flight {self.in_flight}']
+        for name, value in self.counters.items():
+            lines.append(f'# TYPE email_worker_messages_{name}_total counter')
+            lines.append(f'email_worker_messages_{name}_total {value}')
+        if self.digest is not None:
+            lines += ['# TYPE email_worker_digest_pending gauge', f'email_worker_digest_pending {len(self.digest)}']
+            for name, value in self.digest.counters.items():
+                lines.append(f'# TYPE email_worker_digest_{name}_total counter')
+                lines.append(f'email_worker_digest_{name}_total {value}')
+        return "\n".join(lines) + "\n"
+
+
+def run_worker(member=None, size=None):
+    """One worker process; given a consumer group member it consumes that member's partitions in order."""
+    if member is None:
+        worker = EmailWorker()
+    else:
+        worker = EmailWorker(queues=assigned_queues(member, size), ordered=True)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+def start_worker(processes=None):
+    """Run EMAIL_WORKER_PROCESSES worker processes (each with its own connection) until SIGTERM/SIGINT.
+
+    With EMAIL_QUEUE_PARTITIONS > 1 the processes are members of a consumer group of
+    EMAIL_GROUP_SIZE (default: this host's processes), numbered from EMAIL_GROUP_MEMBER.
+    """
+    processes = processes or EMAIL_WORKER_PROCESSES
+    grouped = len(partition_queues(EMAIL_QUEUE)) > 1
+    size = EMAIL_GROUP_SIZE or processes
+    members = [EMAIL_GROUP_MEMBER + i if grouped else None for i in range(processes)]
+    if processes == 1:
+        run_worker(members[0], size)
+        return
+
+    workers = [multiprocessing.Process(target=run_worker, args=(member, size), name=f'email-worker-{i}')
+               for i, member in enumerate(members)]
+    for worker in workers:
+        worker.start()
+
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    print(f'Started {processes} workers, waiting for messages...')
+    for worker in workers:
+        worker.join()
 
 
 if __name__ == "__main__":
     start_worker()
-
@@ -0,0 +1,141 @@
+import json
+import unittest
+from pika.exceptions import AMQPConnectionError, UnroutableError
+from collections import Counter
+from unittest.mock import patch
+from amqp_publisher import Publisher, PublishBufferFull, jump_hash, partition_queue, publish_by_key
+
+
+class FakeChannel:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def queue_declare(self, queue, durable, arguments=None):
+        self.broker.declared.append(queue)
+
+    def confirm_delivery(self):
+        self.broker.confirms = True
+
+    def basic_publish(self, exchange, routing_key, body, properties, mandatory):
+        if self.broker.fail_after is not None and len(self.broker.published) >= self.broker.fail_after:
+            self.broker.fail_after = None
+            raise AMQPConnectionError('connection reset')
+        if body == 'unroutable':
+            raise UnroutableError([])
+        self.broker.published.append(body)
+
+
+class FakeBroker:
+    """Stands in for pika.BlockingConnection: each call opens a new 'connection'."""
+
+    def __init__(self, down_for=0, fail_after=None):
+        self.down_for = down_for
+        self.fail_after = fail_after
+        self.connections = 0
+        self.declared = []
+        self.published = []
+        self.confirms = False
+
+    def __call__(self, parameters):
+        self.connections += 1
+        if self.connections <= self.down_for:
+            raise AMQPConnectionError('broker unavailable')
+        return self
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def process_data_events(self, time_limit):
+        pass
+
+    def close(self):
+        pass
+
+
+class PublisherTestCase(unittest.TestCase):
+    def make_publisher(self, broker, **kwargs):
+        publisher = Publisher('email_queue', parameters=object(), connection_factory=broker, **kwargs)
+        self.addCleanup(publisher.close, 1)
+        return publisher
+
+    def test_reuses_one_connection(self):
+        broker = FakeBroker()
+        publisher = self.make_publisher(broker)
+
+        for i in range(5):
+            publisher.publish({'n': i})
+        self.assertTrue(publisher.flush())
+
+        self.assertEqual([json.loads(body)['n'] for body in broker.published], [0, 1, 2, 3, 4])
+        self.assertEqual(broker.connections, 1)
+        self.assertTrue(broker.confirms)
+        self.assertEqual(broker.declared, ['email_queue'])
+
+    def test_buffers_until_broker_is_back(self):
+        broker = FakeBroker(down_for=2)
+        publisher = self.make_publisher(broker)
+
+        publisher.publish_many(['a', 'b', 'c'])
+        self.assertTrue(publisher.flush(timeout=10))
+
+        self.assertEqual(broker.published, ['a', 'b', 'c'])
+        self.assertIn('amqp_publish_reconnects_total{queue="email_queue"} 1', publisher.metrics())
+
+    def test_resends_unconfirmed_messages_in_order(self):
+        broker = FakeBroker(fail_after=1)
+        publisher = self.make_publisher(broker)
+
+        publisher.publish_many(['a', 'b', 'c'])
+        self.assertTrue(publisher.flush(timeout=10))
+
+        self.assertEqual(broker.published, ['a', 'b', 'c'])
+        self.assertEqual(broker.connections, 2)
+
+    def test_unroutable_messages_are_dropped(self):
+        broker = FakeBroker()
+        publisher = self.make_publisher(broker)
+
+        publisher.publish_many(['unroutable', 'ok'])
+        self.assertTrue(publisher.flush())
+        self.assertEqual(broker.published, ['ok'])
+
+    def test_buffer_is_bounded(self):
+        publisher = self.make_publisher(FakeBroker(down_for=1000), buffer_size=2)
+        publisher.publish_many(['a', 'b'])
+        with self.assertRaises(PublishBufferFull):
+            publisher.publish('c')
+
+class PartitionTestCase(unittest.TestCase):
+    def test_jump_hash_moves_few_keys_when_growing(self):
+        keys = range(1, 10001)
+        before = [jump_hash(key * 0x9E3779B97F4A7C15, 4) for key in keys]
+        after = [jump_hash(key * 0x9E3779B97F4A7C15, 5) for key in keys]
+
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        self.assertTrue(all(a == 4 for _, a in moved))
+        self.assertAlmostEqual(len(moved) / len(keys), 1 / 5, delta=0.03)
+        self.assertTrue(all(1800 < count < 2200 for count in Counter(after).values()))
+
+    def test_partition_queue_is_stable_per_requester(self):
+        queue = partition_queue('Staff@AllInOne.com.sg', partitions=8)
+        self.assertRegex(queue, r'^email_queue\.[0-7]$')
+        self.assertEqual(partition_queue(' staff@allinone.com.sg', partitions=8), queue)
+        self.assertEqual(partition_queue('staff@allinone.com.sg', partitions=1), 'email_queue')
+
+    @patch('amqp_publisher.EMAIL_QUEUE_PARTITIONS', 4)
+    @patch('amqp_publisher.get_publisher')
+    def test_publish_by_key_keeps_order_within_a_partition(self, mock_get_publisher):
+        messages = [{'email': f'staff{i % 3}@allinone.com.sg', 'n': i} for i in range(9)]
+        publish_by_key(messages, key=lambda message: message['email'])
+
+        published = [message for call in mock_get_publisher.return_value.publish_many.call_args_list
+                     for message in call.args[0]]
+        self.assertEqual(sorted(m['n'] for m in published), list(range(9)))
+        for email in {m['email'] for m in messages}:
+            self.assertEqual([m['n'] for m in published if m['email'] == email],
+                             [m['n'] for m in messages if m['email'] == email])
+        for call in mock_get_publisher.call_args_list:
+            self.assertRegex(call.args[0], r'^email_queue\.[0-3]$')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+import email_notify
+
+
+class EmailNotifyTestCase(unittest.TestCase):
+    def setUp(self):
+        email_notify.reset_service()
+        self.addCleanup(email_notify.reset_service)
+
+    @patch('email_notify.build')
+    @patch('email_notify.gmail_authenticate')
+    def test_credentials_and_client_are_reused(self, mock_auth, mock_build):
+        mock_auth.return_value = MagicMock(valid=True)
+
+        for i in range(3):
+            email_notify.send_email_notification(f'staff{i}@allinone.com.sg', 'Subject', 'Body')
+
+        mock_auth.assert_called_once()
+        mock_build.assert_called_once_with('gmail', 'v1', credentials=mock_auth.return_value,
+                                           static_discovery=True, cache_discovery=False)
+        self.assertEqual(mock_build.return_value.users().messages().send.call_count, 3)
+
+    @patch('email_notify.build')
+    @patch('email_notify.gmail_authenticate')
+    def test_expired_credentials_are_refreshed_in_place(self, mock_auth, mock_build):
+        creds = mock_auth.return_value = MagicMock(valid=True)
+        email_notify.send_email_notification('staff@allinone.com.sg', 'Subject', 'Body')
+
+        creds.valid = False
+        email_notify.send_email_notification('staff@allinone.com.sg', 'Subject', 'Body')
+
+        creds.refresh.assert_called_once()
+        mock_auth.assert_called_once()
+        mock_build.assert_called_once()
+
+    @patch('email_notify.build')
+    @patch('email_notify.gmail_authenticate')
+    def test_each_thread_gets_its_own_client(self, mock_auth, mock_build):
+        mock_auth.return_value = MagicMock(valid=True)
+        mock_build.side_effect = lambda *args, **kwargs: MagicMock()
+
+        services = []
+        threads = [threading.Thread(target=lambda: services.append(email_notify.get_service())) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(map(id, services))), 3)
+        mock_auth.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,304 @@
+import json
+import threading
+import time
+import unittest
+from collections import deque
+from unittest.mock import MagicMock, patch
+from benchmark import run_benchmark
+import dlq
+from dlq import command_queues, replay_dead_letters
+from notification import ApproverDigest, EmailWorker, assigned_queues, build_emails
+
+
+def decision(action='Approved', email='staff@allinone.com.sg'):
+    return json.dumps({'action': action, 'email': email, 'reporting_manager_email': 'manager@allinone.com.sg',
+                       'start_date': '2024-01-15', 'approver_comment': 'ok', 'duration': 1})
+
+
+class FakeMethod:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class FakeConnection:
+    """Stands in for pika.BlockingConnection and its channel, delivering at most prefetch_count unacked messages."""
+
+    def __init__(self, bodies):
+        # A list of bodies is email_queue's content; a dict gives the content of several queues
+        self.queues = {queue: deque(content) for queue, content in (bodies if isinstance(bodies, dict) else {'email_queue': bodies}).items()}
+        self.consumers = {}
+        self.callbacks = deque()
+        self.unacked = set()
+        self.acked, self.nacked, self.published = [], [], []
+        self.declared = {}
+        self.prefetch_count = None
+        self.is_open = True
+        self.next_tag = 0
+
+    def __call__(self, parameters):
+        return self
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue, durable, arguments=None):
+        self.declared[queue] = arguments
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body, properties.headers))
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        assert not auto_ack
+        self.consumers[queue] = on_message_callback
+        return queue
+
+    def basic_cancel(self, consumer_tag):
+        del self.consumers[consumer_tag]
+
+    def basic_ack(self, delivery_tag):
+        self.unacked.remove(delivery_tag)
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        self.unacked.remove(delivery_tag)
+        self.nacked.append((delivery_tag, requeue))
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.append(callback)
+
+    def process_data_events(self, time_limit):
+        while self.callbacks:
+            self.callbacks.popleft()()
+        delivered = True
+        while delivered:
+            delivered = False
+            for queue, on_message in list(self.consumers.items()):
+                if self.queues.get(queue) and len(self.unacked) < self.prefetch_count:
+                    self.next_tag += 1
+                    self.unacked.add(self.next_tag)
+                    on_message(self, FakeMethod(self.next_tag), None, self.queues[queue].popleft())
+                    delivered = True
+        time.sleep(0.005)
+
+    def close(self):
+        self.is_open = False
+
+
+class EmailWorkerTestCase(unittest.TestCase):
+    def run_worker(self, connection, send, until, **kwargs):
+        worker = EmailWorker(parameters=object(), connection_factory=connection, send=send, **kwargs)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while not until() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        worker.stop()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        return worker
+
+    def test_sends_concurrently_and_acks_after_both_emails(self):
+        connection = FakeConnection([decision(email=f'staff{i}@allinone.com.sg') for i in range(12)])
+        lock = threading.Lock()
+        sent, active, peak = [], [0], [0]
+
+        def send(to_email, subject, body):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.02)
+            with lock:
+                active[0] -= 1
+                sent.append(to_email)
+
+        worker = self.run_worker(connection, send, lambda: len(connection.acked) == 12,
+                                 prefetch_count=4, send_threads=4)
+
+        self.assertEqual(connection.prefetch_count, 4)
+        self.assertEqual(sorted(connection.acked), list(range(1, 13)))
+        self.assertEqual(len(sent), 24)
+        self.assertGreater(peak[0], 1)
+        self.assertLessEqual(peak[0], 4)
+        self.assertIn('email_worker_messages_acked_total 12', worker.metrics())
+
+    def test_failed_send_is_delayed_and_malformed_message_dead_lettered(self):
+        connection = FakeConnection([decision(email='bounce@allinone.com.sg'), 'not json', decision()])
+        sent = []
+
+        def send(to_email, subject, body):
+            if to_email == 'manager@allinone.com.sg' and sent == ['bounce@allinone.com.sg']:
+                sent.append('failed')
+                raise IOError('rate limit exceeded')
+            sent.append(to_email)
+
+        self.run_worker(connection, send, lambda: len(connection.acked) == 3, prefetch_count=1, send_threads=1)
+
+        self.assertEqual(connection.declared['email_queue.retry.5s'],
+                         {'x-message-ttl': 5000, 'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': 'email_queue'})
+        self.assertIn('email_queue.dead', connection.declared)
+        # The requester email of the first message went out, the approver's did not: only that is retried
+        (retry_queue, _, retry_headers), (dead_queue, dead_body, dead_headers) = connection.published
+        self.assertEqual(retry_queue, 'email_queue.retry.5s')
+        self.assertEqual((retry_headers['x-attempts'], retry_headers['x-sent']), (1, [0]))
+        self.assertEqual((dead_queue, dead_body), ('email_queue.dead', 'not json'))
+        self.assertEqual(connection.nacked, [])
+
+    def test_retry_skips_sent_emails_and_gives_up_after_max_attempts(self):
+        retried = FakeConnection([])
+        sent = []
+
+        def send(to_email, subject, body):
+            sent.append(to_email)
+            raise IOError('rate limit exceeded')
+
+        class Properties:
+            headers = {'x-attempts': 3, 'x-sent': [0]}
+
+        worker = EmailWorker(parameters=object(), connection_factory=retried, send=send, max_attempts=4)
+        worker.connect()
+        worker.pool = MagicMock()
+        worker.in_flight = 1
+        worker.process(retried, retried, 'email_queue', 7, Properties, decision())
+        retried.unacked.add(7)
+        retried.process_data_events(0)
+
+        self.assertEqual(sent, ['manager@allinone.com.sg'])
+        self.assertEqual([queue for queue, _, _ in retried.published], ['email_queue.dead'])
+        self.assertEqual(retried.published[0][2]['x-attempts'], 4)
+        self.assertEqual(retried.acked, [7])
+
+    def test_shutdown_waits_for_in_flight_sends(self):
+        connection = FakeConnection([decision()])
+        started = threading.Event()
+
+        def send(to_email, subject, body):
+            started.set()
+            time.sleep(0.2)
+
+        self.run_worker(connection, send, started.is_set)
+
+        self.assertEqual(connection.acked, [1])
+        self.assertEqual(connection.consumers, {})
+
+    def test_digest_sends_one_confirmation_per_manager(self):
+        bodies = [decision(email=f'staff{i}@allinone.com.sg') for i in range(5)]
+        bodies.append(json.dumps({**json.loads(decision()), 'reporting_manager_email': 'other@allinone.com.sg'}))
+        connection = FakeConnection(bodies)
+        sent = []
+
+        def send(to_email, subject, body):
+            sent.append((to_email, subject, body))
+
+        self.run_worker(connection, send, lambda: len(connection.acked) == 6, digest_window=60)
+
+        # Requesters are emailed straight away; the window has not expired, so shutdown flushes the digests
+        self.assertEqual(len([to for to, _, _ in sent if to.startswith('staff')]), 6)
+        digests = {to: (subject, body) for to, subject, body in sent if not to.startswith('staff')}
+        self.assertEqual(len(sent), 8)
+        self.assertEqual(digests['manager@allinone.com.sg'][0], 'Confirmation of 5 WFH decisions')
+        self.assertIn('staff4@allinone.com.sg', digests['manager@allinone.com.sg'][1])
+        self.assertEqual(digests['other@allinone.com.sg'][0], 'Confirmation of 1 WFH decision')
+
+    def test_digest_window_expiry(self):
+        digest = ApproverDigest(window=0.05)
+        digest.add('manager@allinone.com.sg', 'first')
+        self.assertEqual(digest.take(), [])
+        time.sleep(0.06)
+        digest.add('manager@allinone.com.sg', 'second')
+        self.assertEqual(digest.take(), [('manager@allinone.com.sg', ['first', 'second'])])
+
+        digest.restore('manager@allinone.com.sg', ['first'])
+        digest.add('manager@allinone.com.sg', 'third')
+        self.assertEqual(digest.take(everything=True), [('manager@allinone.com.sg', ['first', 'third'])])
+        self.assertEqual(len(digest), 0)
+
+    def test_ordered_mode_keeps_each_partition_in_order(self):
+        queues = ['email_queue.0', 'email_queue.1']
+        connection = FakeConnection({queue: [decision(email=f'{queue}-{i}@allinone.com.sg') for i in range(6)]
+                                     for queue in queues})
+        lock = threading.Lock()
+        sent, active, peak = [], {}, {'total': 0, 'partition': 0}
+
+        def send(to_email, subject, body):
+            queue = to_email.split('-')[0] if '-' in to_email else None
+            with lock:
+                if queue:
+                    active[queue] = active.get(queue, 0) + 1
+                    peak['partition'] = max(peak['partition'], active[queue])
+                peak['total'] = max(peak['total'], sum(active.values()))
+            time.sleep(0.01)
+            with lock:
+                if queue:
+                    active[queue] -= 1
+                    sent.append(to_email)
+
+        worker = self.run_worker(connection, send, lambda: len(connection.acked) == 12,
+                                 queues=queues, ordered=True, prefetch_count=20, send_threads=8)
+
+        self.assertEqual(connection.declared['email_queue.0'], {'x-single-active-consumer': True})
+        for queue in queues:
+            self.assertEqual([email for email in sent if email.startswith(queue)],
+                             [f'{queue}-{i}@allinone.com.sg' for i in range(6)])
+        # The two partitions are sent in parallel, but never two messages of one partition
+        self.assertEqual((peak['total'], peak['partition']), (2, 1))
+        self.assertEqual(worker.counters['acked'], 12)
+
+    def test_assigned_queues_split_partitions(self):
+        with patch('amqp_publisher.EMAIL_QUEUE_PARTITIONS', 5):
+            self.assertEqual(assigned_queues(0, 2), ['email_queue.0', 'email_queue.2', 'email_queue.4'])
+            self.assertEqual(assigned_queues(1, 2), ['email_queue.1', 'email_queue.3'])
+
+    def test_replay_dead_letters(self):
+        channel = MagicMock()
+        dead = [(MagicMock(delivery_tag=1), MagicMock(headers={'x-attempts': 5, 'x-sent': [0], 'x-last-error': 'quota'}), b'{}'),
+                (None, None, None)]
+        channel.basic_get.side_effect = dead
+
+        self.assertEqual(replay_dead_letters(channel, 'email_queue', limit=10), 1)
+
+        channel.basic_get.assert_called_with(queue='email_queue.dead', auto_ack=False)
+        publish = channel.basic_publish.call_args.kwargs
+        self.assertEqual(publish['routing_key'], 'email_queue')
+        self.assertEqual(publish['properties'].headers, {'x-sent': [0]})
+        channel.basic_ack.assert_called_once_with(1)
+
+    def test_dead_letter_commands_cover_every_partition(self):
+        connection = MagicMock()
+        channel = connection.channel.return_value
+        channel.basic_get.return_value = (None, None, None)
+        channel.queue_purge.return_value.method.message_count = 0
+        with patch('amqp_publisher.EMAIL_QUEUE_PARTITIONS', 3), patch.object(dlq.pika, 'BlockingConnection', return_value=connection), \
+                patch('dlq.connection_parameters'), patch('builtins.print'):
+            self.assertEqual(command_queues('email_queue'), ['email_queue.0', 'email_queue.1', 'email_queue.2'])
+            self.assertEqual(command_queues('email_queue.1'), ['email_queue.1'])
+            with patch('sys.argv', ['dlq.py', 'purge']):
+                dlq.main()
+
+        # Partitions are redeclared with the arguments the workers use, or the broker closes the channel
+        declared = {call.kwargs['queue']: call.kwargs.get('arguments') for call in channel.queue_declare.call_args_list}
+        for i in range(3):
+            self.assertEqual(declared[f'email_queue.{i}'], {'x-single-active-consumer': True})
+            self.assertIn(f'email_queue.{i}.dead', declared)
+        self.assertEqual([call.kwargs['queue'] for call in channel.queue_purge.call_args_list],
+                         ['email_queue.0.dead', 'email_queue.1.dead', 'email_queue.2.dead'])
+
+    def test_benchmark_through_local_broker(self):
+        result = run_benchmark('10x4', messages=40)
+        self.assertEqual(result['messages'], 40)
+        self.assertEqual(result['emails'], 80)
+        self.assertGreater(result['per_second'], 0)
+        self.assertGreaterEqual(result['p99_ms'], result['p50_ms'])
+
+    def test_build_emails(self):
+        emails = build_emails(json.loads(decision(action='Rejected')))
+        self.assertEqual([to for to, _, _ in emails], ['staff@allinone.com.sg', 'manager@allinone.com.sg'])
+        self.assertEqual(emails[0][1], 'WFH Request Rejected')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import json
+import os
+import smtplib
+import tempfile
+import unittest
+from unittest.mock import patch
+from transports import FileTransport, MemoryTransport, SmtpTransport, get_transport
+
+
+class TransportTestCase(unittest.TestCase):
+    def test_memory_transport(self):
+        transport = MemoryTransport()
+        transport.send('staff@allinone.com.sg', 'Subject', 'Body')
+        self.assertEqual(transport.sent, [{'to': 'staff@allinone.com.sg', 'subject': 'Subject', 'body': 'Body'}])
+
+    def test_file_transport_appends_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sent.jsonl')
+            transport = FileTransport(path)
+            transport.send('a@allinone.com.sg', 'One', 'Body')
+            transport.send('b@allinone.com.sg', 'Two', 'Body')
+            with open(path) as sink:
+                lines = [json.loads(line) for line in sink]
+        self.assertEqual([line['subject'] for line in lines], ['One', 'Two'])
+
+    @patch('transports.smtplib.SMTP')
+    def test_smtp_transport_reuses_connection(self, mock_smtp):
+        transport = SmtpTransport(host='localhost', port=1025, sender='noreply@allinone.com.sg', username='')
+        transport.send('a@allinone.com.sg', 'One', 'Body')
+        transport.send('b@allinone.com.sg', 'Two', 'Body')
+
+        mock_smtp.assert_called_once_with('localhost', 1025, timeout=30)
+        message = mock_smtp.return_value.send_message.call_args.args[0]
+        self.assertEqual((message['To'], message['Subject']), ('b@allinone.com.sg', 'Two'))
+
+        transport.close()
+        mock_smtp.return_value.quit.assert_called_once()
+
+    @patch('transports.smtplib.SMTP')
+    def test_smtp_transport_reconnects_once(self, mock_smtp):
+        mock_smtp.return_value.send_message.side_effect = [smtplib.SMTPServerDisconnected(), None]
+        transport = SmtpTransport(host='localhost', port=1025, username='')
+        transport.send('a@allinone.com.sg', 'One', 'Body')
+        self.assertEqual(mock_smtp.call_count, 2)
+
+    def test_get_transport_by_name(self):
+        self.assertIsInstance(get_transport('memory'), MemoryTransport)
+        with self.assertRaises(ValueError):
+            get_transport('carrier-pigeon')
+
+if __name__ == '__main__':
+    unittest.main()
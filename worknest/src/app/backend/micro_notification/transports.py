@@ -0,0 +1,133 @@
+# where notification emails go: Gmail API, an SMTP server, a file or memory (EMAIL_TRANSPORT)
+from email.message import EmailMessage
+import json
+import os
+import smtplib
+import threading
+import time
+
+EMAIL_TRANSPORT = os.getenv('EMAIL_TRANSPORT', 'gmail')  # gmail | smtp | file | memory
+EMAIL_SENDER = os.getenv('EMAIL_SENDER', 'noreply@allinone.com.sg')
+EMAIL_SMTP_HOST = os.getenv('EMAIL_SMTP_HOST', 'localhost')
+EMAIL_SMTP_PORT = int(os.getenv('EMAIL_SMTP_PORT') or 1025)  # e.g. python -m aiosmtpd -n -l localhost:1025
+EMAIL_SMTP_USER = os.getenv('EMAIL_SMTP_USER')
+EMAIL_SMTP_PASSWORD = os.getenv('EMAIL_SMTP_PASSWORD')
+EMAIL_SMTP_STARTTLS = os.getenv('EMAIL_SMTP_STARTTLS', '').lower() in ('1', 'true', 'yes')
+EMAIL_FILE = os.getenv('EMAIL_FILE', 'sent_emails.jsonl')
+
+
+class Transport:
+    """Sends one plain-text email. Implementations must be safe to call from several threads."""
+
+    def send(self, to_email, subject, body):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class GmailTransport(Transport):
+    def send(self, to_email, subject, body):
+        # Imported here so the other transports work without the Google client libraries
+        from email_notify import send_email_notification
+        send_email_notification(to_email, subject, body)
+
+
+class SmtpTransport(Transport):
+    """Plain SMTP, one kept-alive connection per sending thread."""
+
+    def __init__(self, host=None, port=None, sender=None, username=None, password=None, starttls=None):
+        self.host = host or EMAIL_SMTP_HOST
+        self.port = port or EMAIL_SMTP_PORT
+        self.sender = sender or EMAIL_SENDER
+        self.username = username if username is not None else EMAIL_SMTP_USER
+        self.password = password if password is not None else EMAIL_SMTP_PASSWORD
+        self.starttls = EMAIL_SMTP_STARTTLS if starttls is None else starttls
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            connection.starttls()
+        if self.username:
+            connection.login(self.username, self.password)
+        with self.lock:
+            self.connections.append(connection)
+        self.local.connection = connection
+        return connection
+
+    def send(self, to_email, subject, body):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = to_email
+        message['Subject'] = subject
+        message.set_content(body)
+        connection = getattr(self.local, 'connection', None) or self.connect()
+        try:
+            connection.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped an idle connection; one fresh attempt
+            self.connect().send_message(message)
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.quit()
+            except smtplib.SMTPException:
+                pass
+
+
+class MemoryTransport(Transport):
+    """Keeps sent emails in a list; latency (seconds) simulates a slow provider."""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send(self, to_email, subject, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.sent.append({'to': to_email, 'subject': subject, 'body': body})
+
+
+class FileTransport(Transport):
+    """Appends each email as a JSON line to a file, for running the pipeline offline."""
+
+    def __init__(self, path=None):
+        self.path = path or EMAIL_FILE
+        self.lock = threading.Lock()
+
+    def send(self, to_email, subject, body):
+        line = json.dumps({'to': to_email, 'subject': subject, 'body': body, 'sent_at': time.time()})
+        with self.lock:
+            with open(self.path, 'a') as sink:
+                sink.write(line + "\n")
+
+
+TRANSPORTS = {'gmail': GmailTransport, 'smtp': SmtpTransport, 'memory': MemoryTransport, 'file': FileTransport}
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport(name=None):
+    """A new transport by name, or the process-wide EMAIL_TRANSPORT one when no name is given."""
+    global _transport
+    if name is not None:
+        if name not in TRANSPORTS:
+            raise ValueError(f"Unknown email transport {name!r}, expected one of {', '.join(TRANSPORTS)}")
+        return TRANSPORTS[name]()
+    with _transport_lock:
+        if _transport is None:
+            _transport = get_transport(EMAIL_TRANSPORT)
+        return _transport
+
+
+def send_email(to_email, subject, body):
+    get_transport().send(to_email, subject, body)
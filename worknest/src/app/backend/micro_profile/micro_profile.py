@@ -1,7 +1,12 @@
 from collections import defaultdict
 import datetime
-from flask import Flask, Request, request, jsonify
+import hashlib
+import hmac
+import threading
+import time
+from flask import Flask, Request, Response, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
 from dotenv import load_dotenv
 import os
 from flask_cors import CORS
@@ -10,6 +15,10 @@ load_dotenv()
 
 
 db_url = os.getenv("SQLALCHEMY_DATABASE_URI")
+# Profiles written outside this process (SQL scripts, another replica) show up after at most this long
+PROFILE_DIRECTORY_TTL = float(os.getenv("PROFILE_DIRECTORY_TTL") or 300)  # seconds
+# Shared secret for internal endpoints, sent as X-Internal-Token; unset allows only callers on this host
+INTERNAL_TOKEN = os.getenv("PROFILE_INTERNAL_TOKEN")
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -49,6 +58,137 @@ class Profile(db.Model):
             # Exclude or obfuscate sensitive data like passwords in the dictionary output
     }
     
+class ProfileDirectory:
+    """Every profile held in memory, indexed by staff_id, email, department and manager.
+
+    The ~550 rows rarely change, so the endpoints below read a snapshot instead of the
+    database. Writes through this process's session call invalidate() on commit, which
+    bumps the version; the next read loads a fresh snapshot. Response bodies are
+    serialised once per version and reused, together with their ETag.
+    """
+
+    def __init__(self, ttl=PROFILE_DIRECTORY_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.version = 0
+        self.snapshot = None
+        self.counters = {'hits': 0, 'loads': 0, 'invalidations': 0}
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.snapshot = None
+            self.counters['invalidations'] += 1
+
+    def current(self):
+        with self.lock:
+            snapshot, version = self.snapshot, self.version
+            if snapshot is not None and time.monotonic() - snapshot['loaded_at'] <= self.ttl:
+                self.counters['hits'] += 1
+                return snapshot
+        # Query without the lock so readers of a fresh snapshot never wait on the database
+        snapshot = self.load(version)
+        with self.lock:
+            self.counters['loads'] += 1
+            # An invalidate() during the load means it may have missed that write: serve it, don't keep it
+            if self.version == version and (self.snapshot is None or self.snapshot['loaded_at'] < snapshot['loaded_at']):
+                self.snapshot = snapshot
+        return snapshot
+
+    def load(self, version):
+        profiles = [profile.to_dict() for profile in Profile.query.all()]
+        snapshot = {
+            'version': version,
+            'loaded_at': time.monotonic(),
+            'profiles': profiles,
+            'by_id': {},
+            'by_email': {},
+            'by_department': defaultdict(list),
+            'by_manager': defaultdict(list),
+            'bodies': {},
+            'body_lock': threading.Lock(),
+        }
+        for profile in profiles:
+            snapshot['by_id'][profile['staff_id']] = profile
+            if profile['email']:
+                snapshot['by_email'][profile['email'].lower()] = profile
+            snapshot['by_department'][profile['department']].append(profile)
+            snapshot['by_manager'][profile['reporting_manager_id']].append(profile)
+        return snapshot
+
+    def get(self, staff_id=None, email=None):
+        snapshot = self.current()
+        if email is not None:
+            return snapshot['by_email'].get(email.lower())
+        return snapshot['by_id'].get(staff_id)
+
+    def filter(self, department=None, staff_id=None, reporting_manager_id=None, snapshot=None):
+        """Profiles matching every given filter, in the order of the full list."""
+        snapshot = snapshot or self.current()
+        if staff_id is not None:
+            profile = snapshot['by_id'].get(staff_id)
+            profiles = [profile] if profile else []
+        elif reporting_manager_id is not None:
+            profiles = snapshot['by_manager'].get(reporting_manager_id, [])
+        elif department is not None:
+            profiles = snapshot['by_department'].get(department, [])
+        else:
+            return snapshot['profiles']
+        return [p for p in profiles
+                if (department is None or p['department'] == department)
+                and (reporting_manager_id is None or p['reporting_manager_id'] == reporting_manager_id)]
+
+    def response(self, key, build, snapshot=None):
+        """A JSON response for key, built by build(snapshot) once per version.
+
+        Pass the snapshot a handler has already read from, so the body is built from the same data.
+        """
+        snapshot = snapshot or self.current()
+        with snapshot['body_lock']:
+            cached = snapshot['bodies'].get(key)
+            if cached is None:
+                body = (app.json.dumps(build(snapshot)) + "\n").encode()
+                cached = snapshot['bodies'][key] = (body, hashlib.md5(body).hexdigest())
+        body, etag = cached
+        response = Response(body, mimetype=app.json.mimetype)
+        response.set_etag(etag)
+        return response
+
+    def metrics(self):
+        lines = ['# TYPE profile_directory_version gauge', f'profile_directory_version {self.version}']
+        for name, value in self.counters.items():
+            lines.append(f'# TYPE profile_directory_{name}_total counter')
+            lines.append(f'profile_directory_{name}_total {value}')
+        return "\n".join(lines) + "\n"
+
+
+directory = ProfileDirectory()
+
+
+@event.listens_for(Profile, 'after_insert')
+@event.listens_for(Profile, 'after_update')
+@event.listens_for(Profile, 'after_delete')
+def mark_profiles_written(mapper, connection, target):
+    db.session.info['profiles_written'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_directory(session):
+    if session.info.pop('profiles_written', False):
+        directory.invalidate()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_profile_writes(session):
+    session.info.pop('profiles_written', None)
+
+
+def int_arg(name):
+    """An integer query argument; None if absent, ValueError if not a number."""
+    value = request.args.get(name)
+    return int(value) if value else None
+
+
 def update_profile_location():
     # Get today's date
     today = datetime.today().strftime('%d-%m-%Y')
@@ -64,42 +204,57 @@ def update_profile_location():
             if profile:
                 # Update the location to WFH
                 profile.location = 'WFH'
-                db.session.commit()
+                db.session.commit()  # invalidates the profile directory
+
+@app.after_request
+def add_etag(response):
+    # Directory responses already carry their cached body's ETag; add_etag() keeps it
+    if request.method == 'GET' and response.status_code == 200:
+        response.add_etag()
+    return response.make_conditional(request)
+
 
 @app.route("/managers/<int:staff_id>", methods=['GET'])
 def get_department_employees(staff_id):
     # Find the manager's profile based on the given staff_id and ensure their role is 3 (manager)
-    manager = Profile.query.filter_by(staff_id=staff_id, role=3).first()
-    
-    if not manager:
+    snapshot = directory.current()
+    manager = snapshot['by_id'].get(staff_id)
+
+    if not manager or manager['role'] != 3:
         return jsonify({
             "code": 404,
             "message": "Manager not found or not a valid manager."
         }), 404
 
-    # Get the manager's department
-    department = manager.department
-    
-    # Query all employees that belong to the same department as the manager
-    employees_in_department = Profile.query.filter_by(department=department).all()
+    # Everyone in the manager's department (profiles never include passwords)
+    return directory.response(('managers', staff_id), lambda snapshot: managers_data(snapshot, staff_id), snapshot)
 
-    # Convert the list of employees to dictionaries (excluding sensitive info like passwords)
-    employee_data = [employee.to_dict() for employee in employees_in_department]
 
-    return jsonify({
+def managers_data(snapshot, staff_id):
+    manager = snapshot['by_id'][staff_id]
+    return {
         "code": 200,
         "data": {
-            "manager": f"{manager.staff_fname} {manager.staff_lname}",
-            "department": department,
-            "employees": employee_data
+            "manager": f"{manager['staff_fname']} {manager['staff_lname']}",
+            "department": manager['department'],
+            "employees": snapshot['by_department'].get(manager['department'], [])
         }
-    })
+    }
 
 
 @app.route("/profile", methods=['GET'])
 def get_all_profiles():
-    profiles = Profile.query.all()
-    return jsonify([profile.to_dict() for profile in profiles])
+    # Optional scope filters, e.g. /profile?department=Sales or /profile?reporting_manager_id=140894
+    try:
+        filters = {
+            'department': request.args.get('department') or None,
+            'staff_id': int_arg('staff_id'),
+            'reporting_manager_id': int_arg('reporting_manager_id'),
+        }
+    except ValueError:
+        return jsonify({"code": 400, "message": "staff_id and reporting_manager_id must be integers."}), 400
+    key = ('profile',) + tuple(filters.values())
+    return directory.response(key, lambda snapshot: directory.filter(snapshot=snapshot, **filters))
 
 @app.route("/login", methods=['POST'])
 def authentication():
@@ -128,11 +283,15 @@ def authentication():
     
 @app.route("/piechart", methods=['GET'])
 def get_piechart_data():
-    profiles = Profile.query.all()
+    return directory.response('piechart', piechart_data)
+
+
+def piechart_data(snapshot):
+    profiles = snapshot['profiles']
     data = {"office": 0, "wfh": 0}  # Initialize office and wfh counts
 
     for profile in profiles:
-        if profile.location == "OFFICE":
+        if profile['location'] == "OFFICE":
             data["office"] += 1
         else:
             data["wfh"] += 1
@@ -142,49 +301,78 @@ def get_piechart_data():
         {"label": "WFH", "value": data["wfh"]}
     ]
 
-    return jsonify(piechart_data)
+    return piechart_data
 
 @app.route("/departments", methods=['GET'])
 def get_departments():
-    profiles = Profile.query.all()
+    return directory.response('departments', departments_data)
+
+
+def departments_data(snapshot):
+    profiles = snapshot['profiles']
     # Create a dictionary to ensure unique departments, with the first profile's staff_id, staff_name, and location
     department_list = []
     
     for profile in profiles:
         department_list.append({
-            "staff_id": profile.staff_id,
-            "department": profile.department,
-            "staff_name": f"{profile.staff_fname} {profile.staff_lname}",
-            "location": profile.location
+            "staff_id": profile['staff_id'],
+            "department": profile['department'],
+            "staff_name": f"{profile['staff_fname']} {profile['staff_lname']}",
+            "location": profile['location']
         })
 
-    return jsonify(department_list)
+    return department_list
 @app.route("/barchart", methods=['GET'])
 def get_barchart_data():
-    profiles = Profile.query.all()
+    return directory.response('barchart', barchart_data)
+
+
+def barchart_data(snapshot):
+    profiles = snapshot['profiles']
 
     # Dictionary to store data by department
     data = defaultdict(lambda: {"WFH": 0, "OFFICE": 0})
 
     # Loop through profiles and count employees based on location
     for profile in profiles:
-        if profile.location == 'WFH':
-            data[profile.department]['WFH'] += 1
-        elif profile.location == 'OFFICE':
-            data[profile.department]['OFFICE'] += 1
+        if profile['location'] == 'WFH':
+            data[profile['department']]['WFH'] += 1
+        elif profile['location'] == 'OFFICE':
+            data[profile['department']]['OFFICE'] += 1
 
     # Convert to list format for easy use in frontend charts
     departments = list(data.keys())
     wfh_data = [data[dept]['WFH'] for dept in departments]
     office_data = [data[dept]['OFFICE'] for dept in departments]
 
-    return jsonify({
+    return {
         "xLabels": departments,  # List of departments for x-axis
         "seriesData": [
             {"label": "WFH", "data": wfh_data},  # WFH counts for each department
             {"label": "OFFICE", "data": office_data},  # Office counts for each department
         ]
-    })
+    }
+
+
+def internal_caller():
+    """Whether the request carries PROFILE_INTERNAL_TOKEN or, with no token configured, comes from this host."""
+    if INTERNAL_TOKEN:
+        return hmac.compare_digest(request.headers.get("X-Internal-Token", ""), INTERNAL_TOKEN)
+    return request.remote_addr in ("127.0.0.1", "::1")
+
+
+@app.route("/profile/directory/invalidate", methods=['POST'])
+def invalidate_profile_directory():
+    # For profile changes made outside this service, e.g. a bulk import
+    if not internal_caller():
+        return jsonify({"code": 403, "message": "Internal endpoint."}), 403
+    directory.invalidate()
+    return jsonify({"code": 200, "version": directory.version})
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    return Response(directory.metrics(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == '__main__':
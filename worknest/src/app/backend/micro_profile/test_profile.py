@@ -1,7 +1,7 @@
 import unittest
 from flask import json
 from unittest.mock import patch
-from micro_profile import app, Profile
+from micro_profile import app, directory, Profile
 
 class FlaskAppTestCase(unittest.TestCase):
     def setUp(self):
@@ -13,6 +13,9 @@ class FlaskAppTestCase(unittest.TestCase):
         self.app_context = app.app_context()
         self.app_context.push()
 
+        # Each test mocks the rows, so start from an empty directory
+        directory.invalidate()
+
     def tearDown(self):
         # Pop the application context
         self.app_context.pop()
@@ -42,6 +45,21 @@ class FlaskAppTestCase(unittest.TestCase):
         self.assertEqual(data[0]['staff_fname'], 'John')
         self.assertEqual(data[0]['department'], 'HR')
 
+    @patch('micro_profile.Profile.query')
+    def test_get_profiles_by_department(self, mock_query):
+        mock_query.all.return_value = [
+            Profile(staff_id=1, staff_fname="John", staff_lname="Doe", department="HR"),
+            Profile(staff_id=2, staff_fname="Jane", staff_lname="Smith", department="Sales"),
+        ]
+
+        response = self.app.get('/profile?department=HR')
+
+        self.assertEqual(response.status_code, 200)
+        mock_query.filter_by.assert_not_called()
+        data = json.loads(response.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['department'], 'HR')
+
     @patch('micro_profile.Profile.query')
     def test_get_piechart_data(self, mock_query):
         # Mock two profiles with different locations
@@ -64,6 +82,106 @@ class FlaskAppTestCase(unittest.TestCase):
         self.assertEqual(data[1]['label'], 'WFH')
         self.assertEqual(data[1]['value'], 1)
 
+    @patch('micro_profile.Profile.query')
+    def test_directory_serves_endpoints_from_one_load(self, mock_query):
+        mock_query.all.return_value = [
+            Profile(staff_id=1, staff_fname="Ann", staff_lname="Lee", department="HR", location="OFFICE",
+                    email="ann@allinone.com.sg", role=3, reporting_manager_id=1),
+            Profile(staff_id=2, staff_fname="Bob", staff_lname="Tan", department="HR", location="WFH",
+                    email="bob@allinone.com.sg", role=2, reporting_manager_id=1),
+            Profile(staff_id=3, staff_fname="Cy", staff_lname="Ng", department="Sales", location="OFFICE",
+                    email="cy@allinone.com.sg", role=2, reporting_manager_id=1),
+        ]
+
+        managers = json.loads(self.app.get('/managers/1').data)
+        self.assertEqual([e['staff_id'] for e in managers['data']['employees']], [1, 2])
+        self.assertEqual(self.app.get('/managers/2').status_code, 404)
+        by_manager = json.loads(self.app.get('/profile?reporting_manager_id=1&department=Sales').data)
+        self.assertEqual([p['staff_id'] for p in by_manager], [3])
+        barchart = json.loads(self.app.get('/barchart').data)
+        self.assertEqual(barchart['xLabels'], ['HR', 'Sales'])
+        self.assertEqual(barchart['seriesData'][0]['data'], [1, 0])
+        self.assertEqual(len(json.loads(self.app.get('/departments').data)), 3)
+        self.assertEqual(directory.get(email='BOB@allinone.com.sg')['staff_id'], 2)
+        self.assertEqual(self.app.get('/profile?staff_id=abc').status_code, 400)
+
+        first = self.app.get('/piechart')
+        again = self.app.get('/piechart', headers={'If-None-Match': first.headers['ETag'].strip('"')})
+        self.assertEqual(again.status_code, 304)
+
+        # All of the above came from a single query
+        mock_query.all.assert_called_once()
+        self.assertIn('profile_directory_loads_total 1', self.app.get('/metrics').data.decode())
+
+    @patch('micro_profile.Profile.query')
+    def test_invalidate_reloads_with_new_version(self, mock_query):
+        mock_query.all.return_value = [Profile(staff_id=1, staff_fname="Ann", staff_lname="Lee", location="OFFICE")]
+        self.assertEqual(json.loads(self.app.get('/piechart').data)[0]['value'], 1)
+        version = directory.version
+
+        mock_query.all.return_value = [Profile(staff_id=1, staff_fname="Ann", staff_lname="Lee", location="WFH")]
+        self.assertEqual(json.loads(self.app.get('/piechart').data)[0]['value'], 1)  # still cached
+
+        response = self.app.post('/profile/directory/invalidate')
+        self.assertEqual(json.loads(response.data)['version'], version + 1)
+        self.assertEqual(json.loads(self.app.get('/piechart').data)[0]['value'], 0)
+        self.assertEqual(mock_query.all.call_count, 2)
+
+    def test_invalidate_is_internal_only(self):
+        outside = {'REMOTE_ADDR': '203.0.113.7'}
+        version = directory.version
+        self.assertEqual(self.app.post('/profile/directory/invalidate', environ_base=outside).status_code, 403)
+        with patch('micro_profile.INTERNAL_TOKEN', 's3cret'):
+            self.assertEqual(self.app.post('/profile/directory/invalidate').status_code, 403)
+            self.assertEqual(self.app.post('/profile/directory/invalidate', environ_base=outside,
+                                           headers={'X-Internal-Token': 'wrong'}).status_code, 403)
+            response = self.app.post('/profile/directory/invalidate', environ_base=outside,
+                                     headers={'X-Internal-Token': 's3cret'})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(directory.version, version + 1)
+
+    @patch('micro_profile.Profile.query')
+    def test_managers_body_comes_from_the_snapshot_it_was_checked_in(self, mock_query):
+        mock_query.all.return_value = [Profile(staff_id=1, staff_fname="Ann", staff_lname="Lee", department="HR", role=3)]
+        first = directory.current()
+
+        # A newer snapshot arrives while the handler runs; the body still matches the one it checked
+        mock_query.all.return_value = [Profile(staff_id=1, staff_fname="Ann", staff_lname="Lee", department="Sales", role=2)]
+        with patch.object(directory, 'current', side_effect=[first, directory.load(directory.version)]):
+            managers = json.loads(self.app.get('/managers/1').data)
+        self.assertEqual(managers['data']['department'], 'HR')
+        self.assertEqual([e['staff_id'] for e in managers['data']['employees']], [1])
+
+    @patch('micro_profile.Profile.query')
+    def test_profile_body_comes_from_the_snapshot_it_was_built_for(self, mock_query):
+        mock_query.all.return_value = [Profile(staff_id=1, staff_fname="Ann", staff_lname="Lee", department="HR")]
+        first = directory.current()
+
+        mock_query.all.return_value = [Profile(staff_id=2, staff_fname="Bob", staff_lname="Tan", department="HR")]
+        with patch.object(directory, 'current', side_effect=[first, directory.load(directory.version)]):
+            profiles = json.loads(self.app.get('/profile?department=HR').data)
+        self.assertEqual([p['staff_id'] for p in profiles], [1])
+
+    @patch('micro_profile.Profile.query')
+    def test_load_runs_outside_the_lock_and_a_raced_snapshot_is_not_kept(self, mock_query):
+        mock_query.all.return_value = [Profile(staff_id=1, staff_fname="Ann", staff_lname="Lee")]
+        load = directory.load
+
+        def load_while_invalidated(version):
+            # Other readers and invalidate() are not blocked by the query
+            self.assertTrue(directory.lock.acquire(blocking=False))
+            directory.lock.release()
+            directory.invalidate()
+            return load(version)
+
+        with patch.object(directory, 'load', side_effect=load_while_invalidated):
+            self.assertEqual(directory.current()['by_id'][1]['staff_fname'], "Ann")
+        self.assertIsNone(directory.snapshot)
+
+        snapshot = directory.current()
+        self.assertIs(directory.current(), snapshot)
+        self.assertEqual(snapshot['version'], directory.version)
+
     @patch('micro_profile.Profile.query')
     def test_authentication(self, mock_query):
         # Mock the Profile data
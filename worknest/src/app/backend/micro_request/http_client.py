@@ -0,0 +1,121 @@
+# pooled HTTP client for service-to-service calls
+# NOTE: each service is built from its own folder, so this file is kept identical in
+# complex_service_staff/ and micro_request/ -- change both together.
+from os import environ
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Defaults for every upstream, overridable per upstream with <NAME>_CONNECT_TIMEOUT etc.
+HTTP_CONNECT_TIMEOUT = float(environ.get("HTTP_CONNECT_TIMEOUT") or 3.05)
+HTTP_READ_TIMEOUT = float(environ.get("HTTP_READ_TIMEOUT") or 10)
+HTTP_RETRIES = int(environ.get("HTTP_RETRIES") or 2)
+HTTP_BACKOFF = float(environ.get("HTTP_BACKOFF") or 0.1)  # seconds, doubled per attempt, full jitter
+HTTP_POOL_SIZE = int(environ.get("HTTP_POOL_SIZE") or 10)
+
+RETRY_STATUSES = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def upstream_url(env_name, default):
+    """Read an upstream URL from the environment the way EVENT_URL always has been."""
+    return environ.get(env_name) or default
+
+
+class LatencyStats:
+    """Per-upstream latency histogram and error count, rendered in Prometheus text format."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.upstreams = {}
+
+    def record(self, upstream, seconds, error=False):
+        with self.lock:
+            stats = self.upstreams.setdefault(upstream, {"count": 0, "sum": 0.0, "errors": 0, "buckets": [0] * len(LATENCY_BUCKETS)})
+            stats["count"] += 1
+            stats["sum"] += seconds
+            if error:
+                stats["errors"] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+
+    def metrics(self):
+        with self.lock:
+            upstreams = {name: {**stats, "buckets": list(stats["buckets"])} for name, stats in self.upstreams.items()}
+        lines = [
+            "# TYPE internal_http_request_duration_seconds histogram",
+        ]
+        for name, stats in upstreams.items():
+            for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+                lines.append(f'internal_http_request_duration_seconds_bucket{{upstream="{name}",le="{bound}"}} {count}')
+            lines.append(f'internal_http_request_duration_seconds_bucket{{upstream="{name}",le="+Inf"}} {stats["count"]}')
+            lines.append(f'internal_http_request_duration_seconds_sum{{upstream="{name}"}} {stats["sum"]:.6f}')
+            lines.append(f'internal_http_request_duration_seconds_count{{upstream="{name}"}} {stats["count"]}')
+        lines.append("# TYPE internal_http_request_errors_total counter")
+        for name, stats in upstreams.items():
+            lines.append(f'internal_http_request_errors_total{{upstream="{name}"}} {stats["errors"]}')
+        return "\n".join(lines) + "\n"
+
+
+latency_stats = LatencyStats()
+
+
+class ServiceClient:
+    """Keep-alive connection pool to one upstream with timeouts, bounded retries and latency tracking."""
+
+    def __init__(self, name, base_url, connect_timeout=None, read_timeout=None, retries=None, pool_size=None):
+        prefix = name.upper()
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (
+            connect_timeout or float(environ.get(f"{prefix}_CONNECT_TIMEOUT") or HTTP_CONNECT_TIMEOUT),
+            read_timeout or float(environ.get(f"{prefix}_TIMEOUT") or HTTP_READ_TIMEOUT),
+        )
+        self.retries = retries if retries is not None else int(environ.get(f"{prefix}_RETRIES") or HTTP_RETRIES)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or HTTP_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, path=""):
+        return f"{self.base_url}/{path.lstrip('/')}" if path else self.base_url
+
+    def request(self, method, path="", retries=None, **kwargs):
+        """Send a request, retrying connection errors and 502/503/504 with jittered backoff.
+
+        Non-idempotent methods are only retried when retries is passed explicitly.
+        """
+        method = method.upper()
+        if retries is None:
+            retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.url(path)
+
+        for attempt in range(retries + 1):
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                latency_stats.record(self.name, time.perf_counter() - started, error=True)
+                if attempt == retries:
+                    raise
+                logging.warning(f"{self.name} {method} {url} failed ({e}), retrying")
+            else:
+                failed = response.status_code in RETRY_STATUSES
+                latency_stats.record(self.name, time.perf_counter() - started, error=failed)
+                if not failed or attempt == retries:
+                    return response
+                logging.warning(f"{self.name} {method} {url} returned {response.status_code}, retrying")
+            time.sleep(random.uniform(0, HTTP_BACKOFF * 2 ** attempt))
+
+    def get(self, path="", **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path="", **kwargs):
+        return self.request("POST", path, **kwargs)
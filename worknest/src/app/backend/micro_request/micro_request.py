@@ -1,19 +1,39 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
 import os
 from flask_cors import CORS
-import requests
-from datetime import datetime
+from http_client import ServiceClient, latency_stats, upstream_url
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, date, timedelta, timezone
+import base64
+import json
+import logging
+import threading
+import time
+from collections import Counter
 
 load_dotenv()
 
 db_url = os.getenv("SQLALCHEMY_DATABASE_URI")
 
+class IsoDateJSONProvider(DefaultJSONProvider):
+    """Send dates as YYYY-MM-DD; Flask's default is an HTTP date ("Fri, 01 Mar 2024 00:00:00 GMT")."""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+
 app = Flask(__name__)
+app.json = IsoDateJSONProvider(app)
 app.secret_key = os.getenv('SECRET_KEY', 'supersecretkey')  # Replace with a secure key or use an environment variable
 
-CORS(app) # Replace with your frontend's URL
+CORS(app, expose_headers=['X-Next-Cursor']) # Replace with your frontend's URL
 
 app.config['SQLALCHEMY_DATABASE_URI'] =db_url # Use the database URL from the environment variable
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -36,8 +56,11 @@ class RequestModel(db.Model):
     day_id = db.Column(db.Integer, nullable=True)  # Allowing null values
     recurring_days = db.Column(db.Integer, nullable=True)  # Allowing null values
     approver_comment = db.Column(db.String(50), nullable=True)  # Allowing null values
+    recurrence_weekdays = db.Column(db.String(20), nullable=True)  # e.g. "0,2" = every Monday and Wednesday
+    recurrence_end_date = db.Column(db.String(50), nullable=True)  # last day the series may fall on
+    excluded_dates = db.Column(db.Text, nullable=True)  # days left out by on_overlap=merge, e.g. "2024-03-06,2024-03-07"
     
-    def __init__(self, staff_id, department, start_date, reason, duration, status, reporting_manager_id, reporting_manager_name, reporting_manager_email, requester_email, day_id=None, recurring_days=None, approver_comment=None):
+    def __init__(self, staff_id, department, start_date, reason, duration, status, reporting_manager_id, reporting_manager_name, reporting_manager_email, requester_email, day_id=None, recurring_days=None, approver_comment=None, recurrence_weekdays=None, recurrence_end_date=None, excluded_dates=None):
         self.staff_id = staff_id
         self.department = department
         self.start_date = start_date
@@ -51,6 +74,9 @@ class RequestModel(db.Model):
         self.day_id = day_id
         self.recurring_days = recurring_days
         self.approver_comment = approver_comment
+        self.recurrence_weekdays = recurrence_weekdays
+        self.recurrence_end_date = recurrence_end_date
+        self.excluded_dates = excluded_dates
         
     def to_dict(self):
         return {
@@ -67,20 +93,582 @@ class RequestModel(db.Model):
             'requester_email': self.requester_email,
             'day_id': self.day_id,
             'recurring_days': self.recurring_days,
-            'approver_comment': self.approver_comment
+            'approver_comment': self.approver_comment,
+            'recurrence_weekdays': self.recurrence_weekdays,
+            'recurrence_end_date': self.recurrence_end_date,
+            'excluded_dates': self.excluded_dates
+        }
+
+
+class RequestOccurrence(db.Model):
+    """One WFH day of a request; a recurring series has one row per day it covers."""
+    __tablename__ = "request_occurrence"
+    occurrence_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    request_id = db.Column(db.Integer, nullable=False, index=True)
+    staff_id = db.Column(db.Integer, nullable=False)
+    department = db.Column(db.String(50), nullable=False)
+    occurrence_date = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(50), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_request_occurrence_staff_date', 'staff_id', 'occurrence_date'),
+        db.Index('ix_request_occurrence_department_date', 'department', 'occurrence_date'),
+        # At most one pending or approved day per staff member and date, enforced by the database (V009)
+        db.Index('ux_request_occurrence_active_staff_date', 'staff_id', 'occurrence_date', unique=True,
+                 postgresql_where=db.text("lower(status) IN ('pending', 'approved')"),
+                 sqlite_where=db.text("lower(status) IN ('pending', 'approved')")),
+    )
+
+    def to_dict(self):
+        return {
+            'occurrence_id': self.occurrence_id,
+            'request_id': self.request_id,
+            'staff_id': self.staff_id,
+            'department': self.department,
+            'occurrence_date': self.occurrence_date.isoformat(),
+            'status': self.status
+        }
+
+
+class ScheduleOutbox(db.Model):
+    """Schedule changes waiting to be delivered to micro_schedule, written in the same
+    transaction as the request change that caused them."""
+    __tablename__ = "schedule_outbox"
+    outbox_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    payload = db.Column(db.Text, nullable=False)  # JSON body for /schedule/update
+    staff_id = db.Column(db.Integer, nullable=True)  # rows of one staff member are delivered in order
+    created_at = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False)
+    delivered_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(255), nullable=True)
+    dead_at = db.Column(db.DateTime, nullable=True)  # given up after OUTBOX_MAX_ATTEMPTS
+
+
+class DepartmentCapacity(db.Model):
+    """Running count of WFH days per department and date, kept in step with request_occurrence."""
+    __tablename__ = "department_daily_capacity"
+    department = db.Column(db.String(50), primary_key=True)
+    capacity_date = db.Column(db.Date, primary_key=True)
+    approved_count = db.Column(db.Integer, nullable=False, default=0)
+    pending_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        return {
+            'date': self.capacity_date.isoformat(),
+            'approved': self.approved_count,
+            'pending': self.pending_count
         }
 
+
+class DepartmentWfhLimit(db.Model):
+    """How many of a department may work from home on the same day."""
+    __tablename__ = "department_wfh_limit"
+    department = db.Column(db.String(50), primary_key=True)
+    headcount = db.Column(db.Integer, nullable=False)
+    max_ratio = db.Column(db.Float, nullable=False, default=0.5)
+
+    @property
+    def limit(self):
+        return max(1, int(self.headcount * self.max_ratio))
+
+
+# ---------------------------------- Recurrence ----------------------------------
+
+# A series may not run for more than a year
+MAX_OCCURRENCES = 366
+
+
+def parse_weekdays(value):
+    """Accept [0, 2] or "0,2" (0 = Monday) and return the normalized "0,2" string, or None."""
+    if value in (None, '', []):
+        return None
+    if isinstance(value, str):
+        value = [part for part in value.split(',') if part.strip()]
+    weekdays = sorted({int(day) for day in value})
+    if any(day < 0 or day > 6 for day in weekdays):
+        raise ValueError('recurrence_weekdays must be between 0 (Monday) and 6 (Sunday).')
+    return ','.join(str(day) for day in weekdays)
+
+
+def to_date(value):
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value), '%Y-%m-%d').date()
+
+
+def expand_occurrences(start_date, duration, recurrence_weekdays=None, recurrence_end_date=None):
+    """Return the dates a request covers.
+
+    A one-off request covers duration consecutive days from start_date. A recurring
+    request covers every listed weekday from start_date through recurrence_end_date.
+    """
+    start = to_date(start_date)
+    if not recurrence_weekdays:
+        return [start + timedelta(days=i) for i in range(max(duration or 1, 1))]
+
+    if not recurrence_end_date:
+        raise ValueError('recurrence_end_date is required for a recurring request.')
+    end = to_date(recurrence_end_date)
+    if end < start:
+        raise ValueError('recurrence_end_date must not be before start_date.')
+    if (end - start).days >= MAX_OCCURRENCES:
+        raise ValueError(f'A recurring request cannot span more than {MAX_OCCURRENCES} days.')
+    weekdays = {int(day) for day in recurrence_weekdays.split(',')}
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)
+            if (start + timedelta(days=i)).weekday() in weekdays]
+
+
+def parse_excluded_dates(value):
+    """The set of dates in a stored "2024-03-06,2024-03-07" excluded_dates value."""
+    return {to_date(part.strip()) for part in (value or '').split(',') if part.strip()}
+
+
+def format_excluded_dates(dates):
+    return ','.join(sorted(day.isoformat() for day in dates)) or None
+
+
+def occurrence_rows(request_id, data):
+    """Occurrence rows for one request, ready for a multi-row insert, leaving out its excluded dates."""
+    excluded = parse_excluded_dates(data.get('excluded_dates'))
+    return [{
+        'request_id': request_id,
+        'staff_id': data['staff_id'],
+        'department': data['department'],
+        'occurrence_date': occurrence_date,
+        'status': data['status'],
+    } for occurrence_date in expand_occurrences(data['start_date'], data['duration'],
+                                                data.get('recurrence_weekdays'), data.get('recurrence_end_date'))
+      if occurrence_date not in excluded]
+
+
+# ---------------------------------- Overlap Detection ----------------------------------
+
+# Occurrences in these statuses block another request on the same day
+ACTIVE_STATUSES = ('pending', 'approved')
+
+
+class OverlapError(Exception):
+    def __init__(self, conflicts):
+        super().__init__('Request overlaps an existing WFH request.')
+        self.conflicts = conflicts
+
+
+class CapacityError(Exception):
+    def __init__(self, full_dates):
+        super().__init__('Department WFH capacity reached.')
+        self.full_dates = full_dates
+
+
+def find_overlaps(staff_id, dates, exclude_request_id=None):
+    """Active occurrences of staff_id falling on any of dates.
+
+    Each date is a point lookup on the (staff_id, occurrence_date) index, so the cost
+    grows with log(table size), not with the staff member's request history.
+    """
+    if not dates:
+        return []
+    query = RequestOccurrence.query.filter(
+        RequestOccurrence.staff_id == staff_id,
+        RequestOccurrence.occurrence_date.in_(list(dates)),
+        db.func.lower(RequestOccurrence.status).in_(ACTIVE_STATUSES)
+    )
+    if exclude_request_id is not None:
+        query = query.filter(RequestOccurrence.request_id != exclude_request_id)
+    return query.order_by(RequestOccurrence.occurrence_date).all()
+
+
+def overlap_conflicts(occurrences):
+    return [{'request_id': o.request_id, 'date': o.occurrence_date.isoformat()} for o in occurrences]
+
+
+def insert_occurrences(occurrences):
+    """Multi-row insert of occurrence rows (caller commits).
+
+    find_overlaps only reads, so two submissions for the same day can both pass it; the
+    unique index on active (staff_id, occurrence_date) lets just one of them insert. The
+    loser's transaction is rolled back and OverlapError names the days now taken.
+    """
+    try:
+        db.session.execute(db.insert(RequestOccurrence), occurrences)
+    except IntegrityError:
+        db.session.rollback()
+        days = {}
+        for occurrence in occurrences:
+            days.setdefault((occurrence['staff_id'], occurrence['request_id']), []).append(occurrence['occurrence_date'])
+        raise OverlapError([conflict for (staff_id, request_id), dates in days.items()
+                            for conflict in overlap_conflicts(find_overlaps(staff_id, dates, request_id))])
+
+
+def rebuild_occurrences(request_obj):
+    """Replace a request's materialized days after its dates changed (caller commits).
+
+    Raises OverlapError if the new dates clash with another active request, and
+    CapacityError if an approved request moves onto days its department has no room on.
+    Returns (old dates, new dates) of the request as sets.
+    """
+    data = {
+        'staff_id': request_obj.staff_id,
+        'department': request_obj.department,
+        'start_date': request_obj.start_date,
+        'duration': request_obj.duration,
+        'status': request_obj.status,
+        'recurrence_weekdays': request_obj.recurrence_weekdays,
+        'recurrence_end_date': request_obj.recurrence_end_date,
+        'excluded_dates': request_obj.excluded_dates,
+    }
+    rows = occurrence_rows(request_obj.request_id, data)
+    conflicts = find_overlaps(request_obj.staff_id, [row['occurrence_date'] for row in rows], request_obj.request_id)
+    if conflicts:
+        raise OverlapError(overlap_conflicts(conflicts))
+    old_days = series_days(request_obj.request_id)
+    if str(request_obj.status).lower() == 'approved':
+        # Only the days the request did not already hold an approval on need room
+        held = {day['occurrence_date'] for day in old_days if str(day['status']).lower() == 'approved'}
+        added = [row['occurrence_date'] for row in rows if row['occurrence_date'] not in held]
+        full = full_days(request_obj.department, added,
+                         remaining_capacity({(request_obj.department, day) for day in added}))
+        if full:
+            raise CapacityError(full)
+    deltas = capacity_deltas(old_days, -1)
+    deltas.update(capacity_deltas(rows))
+    db.session.execute(db.delete(RequestOccurrence).where(RequestOccurrence.request_id == request_obj.request_id))
+    insert_occurrences(rows)
+    adjust_capacity(deltas)
+    return {day['occurrence_date'] for day in old_days}, {row['occurrence_date'] for row in rows}
+
+
+def set_occurrence_status(request_id, status):
+    """Move a whole series to a new status with one set-based UPDATE (caller commits)."""
+    days = series_days(request_id)
+    deltas = capacity_deltas(days, -1)
+    deltas.update(capacity_deltas([{**day, 'status': status} for day in days]))
+    db.session.execute(
+        db.update(RequestOccurrence).where(RequestOccurrence.request_id == request_id).values(status=status)
+    )
+    adjust_capacity(deltas)
+
+
+# ---------------------------------- Department Capacity ----------------------------------
+
+# Which counter an occurrence in a given status is tallied under
+CAPACITY_COLUMNS = {'approved': 'approved_count', 'pending': 'pending_count'}
+
+
+def series_days(request_id):
+    """(department, occurrence_date, status) of every day of a request, before it changes."""
+    rows = db.session.query(RequestOccurrence.department, RequestOccurrence.occurrence_date, RequestOccurrence.status)\
+        .filter(RequestOccurrence.request_id == request_id).all()
+    return [{'department': row.department, 'occurrence_date': row.occurrence_date, 'status': row.status} for row in rows]
+
+
+def capacity_deltas(occurrences, sign=1):
+    """Counter of {(department, date, column): change} for occurrences entering (+1) or leaving (-1) a status."""
+    deltas = Counter()
+    for occurrence in occurrences:
+        column = CAPACITY_COLUMNS.get(str(occurrence['status']).lower())
+        if column:
+            deltas[(occurrence['department'], occurrence['occurrence_date'], column)] += sign
+    return deltas
+
+
+def adjust_capacity(deltas):
+    """Apply counter changes with one multi-row upsert (caller commits)."""
+    days = {}
+    for (department, capacity_date, column), change in deltas.items():
+        if change:
+            day = days.setdefault((department, capacity_date), {
+                'department': department, 'capacity_date': capacity_date, 'approved_count': 0, 'pending_count': 0
+            })
+            day[column] += change
+    if not days:
+        return
+    dialect = postgresql if db.session.get_bind().dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(DepartmentCapacity).values(list(days.values()))
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['department', 'capacity_date'],
+        set_={
+            'approved_count': DepartmentCapacity.approved_count + statement.excluded.approved_count,
+            'pending_count': DepartmentCapacity.pending_count + statement.excluded.pending_count,
+        }
+    ))
+
+
+def remaining_capacity(days):
+    """{(department, date): approvals still allowed} for the days whose department has a limit.
+
+    The counter rows are created if missing and locked FOR UPDATE until the caller commits,
+    so a concurrent submission of the same days waits here and then sees this one's
+    increment. Rows are locked in key order so two batches cannot deadlock.
+    """
+    departments = {department for department, _ in days}
+    limits = {limit.department: limit.limit for limit in
+              DepartmentWfhLimit.query.filter(DepartmentWfhLimit.department.in_(departments))}
+    days = sorted(day for day in days if day[0] in limits)
+    if not days:
+        return {}
+    dialect = postgresql if db.session.get_bind().dialect.name == 'postgresql' else sqlite
+    db.session.execute(dialect.insert(DepartmentCapacity).values([
+        {'department': department, 'capacity_date': capacity_date, 'approved_count': 0, 'pending_count': 0}
+        for department, capacity_date in days
+    ]).on_conflict_do_nothing(index_elements=['department', 'capacity_date']))
+    approved = {(counter.department, counter.capacity_date): counter.approved_count for counter in
+                DepartmentCapacity.query.filter(
+                    db.tuple_(DepartmentCapacity.department, DepartmentCapacity.capacity_date).in_(days))
+                .order_by(DepartmentCapacity.department, DepartmentCapacity.capacity_date)
+                .with_for_update()}
+    return {day: limits[day[0]] - approved.get(day, 0) for day in days}
+
+
+def full_days(department, dates, remaining):
+    """Dates on which the department has no approvals left, per remaining_capacity()."""
+    return [day.isoformat() for day in sorted(dates) if remaining.get((department, day), 1) <= 0]
+
+
+def claim_capacity(department, dates, status, remaining):
+    """Count a request submitted as approved against the remaining capacity of its days."""
+    if str(status).lower() == 'approved':
+        for day in dates:
+            if (department, day) in remaining:
+                remaining[(department, day)] -= 1
+
+@app.after_request
+def add_etag(response):
+    # NDJSON exports are streamed and never hashed
+    if request.method == 'GET' and response.status_code == 200 and not response.is_streamed:
+        response.add_etag()
+    return response.make_conditional(request)
+
+
 # ---------------------------------- Get All Requests ----------------------------------
 
+def parse_date_arg(name):
+    value = request.args.get(name)
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+
+def within_window(query, start, end, filters=None):
+    """Keep the requests with at least one day in [start, end] (either end may be open).
+
+    Answered from request_occurrence, so a recurring series counts on the weekdays it
+    really falls on and days merged away do not count at all. A request never has a day
+    before its start_date, which also bounds the request side of the query.
+    """
+    days = db.select(RequestOccurrence.request_id)
+    for arg in ('department', 'staff_id'):
+        if filters and filters.get(arg):
+            days = days.where(getattr(RequestOccurrence, arg) == filters[arg])
+    if start:
+        days = days.where(RequestOccurrence.occurrence_date >= start)
+    if end:
+        days = days.where(RequestOccurrence.occurrence_date <= end)
+        query = query.filter(RequestModel.start_date <= end.isoformat())
+    return query.filter(RequestModel.request_id.in_(days))
+
+
+# ---------------------------------- Pagination / Projection ----------------------------------
+
+REQUEST_FIELDS = [column.name for column in RequestModel.__table__.columns]
+# order_by -> keyset columns, the last one always unique so the cursor is unambiguous
+KEYSET_ORDERS = {
+    'request_id': ('request_id',),
+    'start_date': ('start_date', 'request_id'),
+}
+MAX_PAGE_SIZE = 500
+LIST_ARGS = ('limit', 'cursor', 'order_by', 'fields', 'status')
+
+
+def wants_list_args():
+    return any(arg in request.args for arg in LIST_ARGS)
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, date) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, keys):
+    """The keyset values encode_cursor() wrote for keys; ValueError for anything else.
+
+    start_date is checked as an ISO date but compared as its ISO text, which orders the
+    same and works whether the column is a date or, as in the model, a string.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor.')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor.')
+    if len(values) != len(keys):
+        raise ValueError('Cursor does not match order_by.')
+    decoded = []
+    for key, value in zip(keys, values):
+        if key == 'start_date' and isinstance(value, str):
+            try:
+                decoded.append(date.fromisoformat(value).isoformat())
+            except ValueError:
+                raise ValueError('Invalid cursor.')
+        elif key == 'request_id' and type(value) is int:
+            decoded.append(value)
+        else:
+            raise ValueError('Invalid cursor.')
+    return decoded
+
+
+def project_requests(query):
+    """Apply ?status=, ?order_by= and ?fields= to a RequestModel query; ValueError if one is invalid.
+
+    Only the requested columns are selected, plus the keyset columns of order_by.
+    Returns (query, fields, keys).
+    """
+    status = request.args.get('status')
+    if status:
+        query = query.filter(db.func.lower(RequestModel.status) == status.lower())
+
+    order_by = request.args.get('order_by', 'request_id')
+    if order_by not in KEYSET_ORDERS:
+        raise ValueError(f"order_by must be one of: {', '.join(KEYSET_ORDERS)}.")
+    keys = KEYSET_ORDERS[order_by]
+
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    unknown = [field for field in fields if field not in REQUEST_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}.")
+    fields = fields or REQUEST_FIELDS
+
+    # Keyset columns are selected even when not asked for, then left out of the output
+    columns = fields + [name for name in keys if name not in fields]
+    table = RequestModel.__table__
+    query = query.with_entities(*[table.c[name] for name in columns]).order_by(*[table.c[key] for key in keys])
+    return query, fields, keys
+
+
+def list_requests(query):
+    """Run a RequestModel query honouring ?status=, ?fields=, ?order_by=, ?limit= and ?cursor=.
+
+    Pagination is keyset-based on order_by (request_id or start_date), so deep pages
+    cost the same as the first one.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    query, fields, keys = project_requests(query)
+    table = RequestModel.__table__
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        values = decode_cursor(cursor, keys)
+        if len(keys) == 1:
+            query = query.filter(table.c[keys[0]] > values[0])
+        else:
+            query = query.filter(db.tuple_(*[table.c[key] for key in keys]) > db.tuple_(*values))
+
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError('limit must be an integer.')
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}.')
+        query = query.limit(limit + 1)
+
+    rows = query.all()
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], key) for key in keys])
+
+    return [{field: getattr(row, field) for field in fields} for row in rows], next_cursor
+
+
+def list_response(query):
+    try:
+        rows, next_cursor = list_requests(query)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    response = jsonify(rows)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response, 200
+
+
+# ---------------------------------- Streaming Export ----------------------------------
+
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', 500))
+
+
+def wants_stream():
+    """?stream=1 or Accept: application/x-ndjson switches /request to NDJSON streaming."""
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def stream_response(query):
+    """Stream one JSON object per line, reading rows through a server-side cursor in batches.
+
+    ?status=, ?fields= and ?order_by= work as for a page; a stream has no pages, so
+    ?limit= and ?cursor= are refused.
+    """
+    paging = [arg for arg in ('limit', 'cursor') if arg in request.args]
+    if paging:
+        return jsonify({'message': f"{' and '.join(paging)} cannot be combined with streaming."}), 400
+    try:
+        query, fields, _ = project_requests(query)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    # Plain column rows (no ORM objects or identity map) fetched STREAM_BATCH_SIZE at a time
+    query = query.yield_per(STREAM_BATCH_SIZE)
+
+    def generate():
+        lines = []
+        for row in query:
+            lines.append(json.dumps({field: getattr(row, field) for field in fields}, default=str))
+            if len(lines) >= STREAM_BATCH_SIZE:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @app.route('/request', methods=['GET'])
 def get_all_requests():
-    requests = RequestModel.query.all()
+    # Optional scope filters so callers (e.g. the complex schedule view) only pull the slice they need
+    filters = {}
+    for arg in ('department', 'staff_id', 'reporting_manager_id'):
+        if request.args.get(arg):
+            filters[arg] = request.args.get(arg)
+    try:
+        start = parse_date_arg('start')
+        end = parse_date_arg('end')
+    except ValueError:
+        return jsonify({'message': 'Invalid date format, expected YYYY-MM-DD.'}), 400
+
+    if not filters and not start and not end and not wants_list_args() and not wants_stream():
+        requests = RequestModel.query.all()
+        return jsonify([request.to_dict() for request in requests])
+
+    query = RequestModel.query.filter_by(**filters)
+    if start or end:
+        query = within_window(query, start, end, filters)
+    if wants_stream():
+        return stream_response(query)
+    if wants_list_args():
+        return list_response(query)
+
+    requests = query.all()
     return jsonify([request.to_dict() for request in requests])
 
 
 # Get all requests for a specific manager, based on reporting_manager_id
+# e.g. the inbox: /requests/manager/140894?status=pending&limit=10&fields=request_id,staff_id,start_date
 @app.route('/requests/manager/<int:manager_id>', methods=['GET'])
 def get_requests_for_manager(manager_id):
+    # Paginated / projected listing returns an empty page rather than 404
+    if wants_list_args():
+        return list_response(RequestModel.query.filter_by(reporting_manager_id=manager_id))
+
     # Fetch all requests where the reporting_manager_id matches the manager_id
     requests = RequestModel.query.filter_by(reporting_manager_id=manager_id).all()
 
@@ -94,6 +682,9 @@ def get_requests_for_manager(manager_id):
 
 @app.route('/request/staff/<int:staff_id>', methods=['GET'])
 def get_staff_requests(staff_id):
+    if wants_list_args():
+        return list_response(RequestModel.query.filter_by(staff_id=staff_id))
+
     staff_requests = RequestModel.query.filter_by(staff_id=staff_id).all()
     if not staff_requests:
         return jsonify({'message': 'No requests found for this staff member.'}), 404
@@ -108,11 +699,124 @@ def get_request(request_id):
         return jsonify({'message': 'Request not found'}), 404
     return jsonify(request.to_dict()), 200
 
+# ---------------------------------- Occurrences ----------------------------------
+
+# e.g. /occurrences?department=Sales&start=2024-03-01&end=2024-03-31&status=Approved
+# or a manager's team: /occurrences?reporting_manager_id=140894&start=2024-03-01&end=2024-03-31
+@app.route('/occurrences', methods=['GET'])
+def get_occurrences():
+    try:
+        start = parse_date_arg('start')
+        end = parse_date_arg('end')
+        on = parse_date_arg('date')
+    except ValueError:
+        return jsonify({'message': 'Invalid date format, expected YYYY-MM-DD.'}), 400
+
+    query = RequestOccurrence.query
+    for arg in ('staff_id', 'department', 'request_id'):
+        if request.args.get(arg):
+            query = query.filter_by(**{arg: request.args.get(arg)})
+    if request.args.get('reporting_manager_id'):
+        query = query.filter(RequestOccurrence.request_id.in_(db.select(RequestModel.request_id).where(
+            RequestModel.reporting_manager_id == request.args.get('reporting_manager_id'))))
+    if request.args.get('status'):
+        query = query.filter(db.func.lower(RequestOccurrence.status) == request.args.get('status').lower())
+    if on:
+        query = query.filter(RequestOccurrence.occurrence_date == on)
+    if start:
+        query = query.filter(RequestOccurrence.occurrence_date >= start)
+    if end:
+        query = query.filter(RequestOccurrence.occurrence_date <= end)
+
+    occurrences = query.order_by(RequestOccurrence.occurrence_date, RequestOccurrence.staff_id).all()
+    return jsonify([occurrence.to_dict() for occurrence in occurrences]), 200
+
+# Who is WFH on a given day: /wfh?date=2024-03-04[&department=Sales][&status=pending]
+@app.route('/wfh', methods=['GET'])
+def get_wfh_staff():
+    try:
+        on = parse_date_arg('date')
+    except ValueError:
+        return jsonify({'message': 'Invalid date format, expected YYYY-MM-DD.'}), 400
+    if not on:
+        return jsonify({'message': 'date is required.'}), 400
+
+    statuses = [status.strip().lower() for status in request.args.get('status', 'approved').split(',')]
+    query = db.session.query(RequestOccurrence.staff_id, RequestOccurrence.request_id).filter(
+        RequestOccurrence.occurrence_date == on,
+        db.func.lower(RequestOccurrence.status).in_(statuses)
+    )
+    if request.args.get('department'):
+        query = query.filter(RequestOccurrence.department == request.args.get('department'))
+
+    rows = query.order_by(RequestOccurrence.staff_id).all()
+    return jsonify({
+        'date': on.isoformat(),
+        'staff': [{'staff_id': row.staff_id, 'request_id': row.request_id} for row in rows]
+    }), 200
+
+# Department capacity per day: /capacity?department=Sales&start=2024-03-01&end=2024-03-31
+@app.route('/capacity', methods=['GET'])
+def get_capacity():
+    department = request.args.get('department')
+    try:
+        start, end = parse_date_arg('start'), parse_date_arg('end')
+    except ValueError:
+        return jsonify({'message': 'Invalid date format, expected YYYY-MM-DD.'}), 400
+    if not department or not start or not end:
+        return jsonify({'message': 'department, start and end are required.'}), 400
+    if end < start or (end - start).days >= MAX_OCCURRENCES:
+        return jsonify({'message': f'start..end must span 1 to {MAX_OCCURRENCES} days.'}), 400
+
+    limit = db.session.get(DepartmentWfhLimit, department)
+    counters = {counter.capacity_date: counter for counter in DepartmentCapacity.query.filter(
+        DepartmentCapacity.department == department,
+        DepartmentCapacity.capacity_date.between(start, end)
+    )}
+    days = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        counts = counters[day].to_dict() if day in counters else {'date': day.isoformat(), 'approved': 0, 'pending': 0}
+        if limit is not None:
+            counts['remaining'] = max(0, limit.limit - counts['approved'])
+        days.append(counts)
+    return jsonify({
+        'department': department,
+        'headcount': limit.headcount if limit else None,
+        'limit': limit.limit if limit else None,
+        'days': days
+    }), 200
+
 # ---------------------------------- Add Request ----------------------------------
 
 @app.route('/add_request/<int:staff_id>', methods=['POST'])
 def add_request(staff_id):
     data = request.get_json()
+    try:
+        recurrence_weekdays = parse_weekdays(data.get('recurrence_weekdays'))
+        dates = expand_occurrences(data['start_date'], data['duration'], recurrence_weekdays, data.get('recurrence_end_date'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'message': f'Invalid recurrence: {str(e)}'}), 400
+
+    # on_overlap: "reject" (default) refuses the request, "merge" drops the days already covered
+    conflicts = find_overlaps(staff_id, dates)
+    skip_dates = set()
+    if conflicts:
+        if data.get('on_overlap') != 'merge':
+            return jsonify({'message': 'Request overlaps an existing WFH request.',
+                            'conflicts': overlap_conflicts(conflicts)}), 409
+        skip_dates = {conflict.occurrence_date for conflict in conflicts}
+        if len(skip_dates) == len(dates):
+            return jsonify({'message': 'Every day of this request is already covered.',
+                            'conflicts': overlap_conflicts(conflicts)}), 409
+
+    new_dates = [day for day in dates if day not in skip_dates]
+    full = full_days(data['department'], new_dates,
+                     remaining_capacity({(data['department'], day) for day in new_dates}))
+    if full:
+        db.session.rollback()
+        return jsonify({'message': 'Department WFH capacity reached.', 'full_dates': full}), 409
+
     new_request = RequestModel(
         staff_id=staff_id,
         department=data['department'],
@@ -126,12 +830,137 @@ def add_request(staff_id):
         requester_email=data['requester_email'],
         day_id=data.get('day_id'),  
         recurring_days=data.get('recurring_days'),  
-        approver_comment=data.get('approver_comment')
+        approver_comment=data.get('approver_comment'),
+        recurrence_weekdays=recurrence_weekdays,
+        recurrence_end_date=data.get('recurrence_end_date'),
+        # Remembered so rebuilding the series later does not bring the merged days back
+        excluded_dates=format_excluded_dates(skip_dates)
     )
     db.session.add(new_request)
+    db.session.flush()
+    # Materialize every day the request covers in the same transaction
+    occurrences = occurrence_rows(new_request.request_id, new_request.to_dict())
+    try:
+        insert_occurrences(occurrences)
+    except OverlapError as e:
+        return jsonify({'message': str(e), 'conflicts': e.conflicts}), 409
+    adjust_capacity(capacity_deltas(occurrences))
     db.session.commit()
     return jsonify(new_request.to_dict()), 201
 
+# ---------------------------------- Bulk Add Requests ----------------------------------
+
+REQUIRED_REQUEST_FIELDS = ('staff_id', 'department', 'start_date', 'reason', 'duration', 'status',
+                           'reporting_manager_id', 'reporting_manager_name', 'reporting_manager_email',
+                           'requester_email')
+OPTIONAL_REQUEST_FIELDS = ('day_id', 'recurring_days', 'approver_comment', 'recurrence_weekdays', 'recurrence_end_date')
+MAX_BATCH_SIZE = 500
+
+
+def validate_request_data(data):
+    """Return a list of problems with one request payload (empty when valid)."""
+    errors = [f'{field} is required.' for field in REQUIRED_REQUEST_FIELDS if data.get(field) in (None, '')]
+    if data.get('start_date'):
+        try:
+            datetime.strptime(str(data['start_date']), '%Y-%m-%d')
+        except ValueError:
+            errors.append('start_date must be YYYY-MM-DD.')
+    # bool is a subclass of int, so True would otherwise pass as a duration of 1
+    if data.get('duration') is not None and (type(data['duration']) is not int or data['duration'] < 1):
+        errors.append('duration must be a positive integer.')
+    if data.get('staff_id') not in (None, '') and type(data['staff_id']) is not int:
+        errors.append('staff_id must be an integer.')
+    if not errors:
+        try:
+            data['recurrence_weekdays'] = parse_weekdays(data.get('recurrence_weekdays'))
+            expand_occurrences(data['start_date'], data['duration'],
+                               data['recurrence_weekdays'], data.get('recurrence_end_date'))
+        except (TypeError, ValueError) as e:
+            errors.append(f'Invalid recurrence: {str(e)}')
+    return errors
+
+
+@app.route('/add_requests', methods=['POST'])
+def add_requests():
+    """Submit many requests at once, for one staff member or many.
+
+    Body: {"requests": [{...}, ...], ...}. Any other top-level keys (e.g. staff_id,
+    department, reporting manager details) are defaults for every item, so the
+    multi-date picker only has to vary start_date. The batch is all-or-nothing:
+    every item is validated first and, if all are valid, inserted with a single
+    multi-row INSERT in one transaction. Otherwise nothing is created and the reply is
+    409 when the only problems are overlaps and full days, 400 when any item is invalid.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('requests')
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'requests must be a non-empty list.'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'message': f'A batch cannot contain more than {MAX_BATCH_SIZE} requests.'}), 400
+
+    defaults = {key: value for key, value in data.items() if key != 'requests'}
+    rows = []
+    results = []
+    for index, item in enumerate(items):
+        merged = {**defaults, **(item if isinstance(item, dict) else {})}
+        errors = validate_request_data(merged)
+        results.append({'index': index, 'status': 'invalid' if errors else 'valid', 'errors': errors})
+        rows.append({field: merged.get(field) for field in REQUIRED_REQUEST_FIELDS + OPTIONAL_REQUEST_FIELDS})
+
+    row_dates = [[] if result['errors'] else
+                 expand_occurrences(row['start_date'], row['duration'], row['recurrence_weekdays'], row['recurrence_end_date'])
+                 for result, row in zip(results, rows)]
+    # Locked up front for the whole batch, then drawn down by its own approved items as they are checked
+    remaining = remaining_capacity({(row['department'], day) for row, dates in zip(rows, row_dates) for day in dates})
+
+    # Reject items that overlap an existing request or an earlier item of the same batch
+    claimed = {}
+    for result, row, dates in zip(results, rows, row_dates):
+        if result['errors']:
+            continue
+        staff_claimed = claimed.setdefault(row['staff_id'], {})
+        conflicts = overlap_conflicts(find_overlaps(row['staff_id'], dates))
+        conflicts += [{'index': staff_claimed[day], 'date': day.isoformat()} for day in dates if day in staff_claimed]
+        if conflicts:
+            result.update(status='overlap', errors=['Request overlaps an existing WFH request.'], conflicts=conflicts)
+        staff_claimed.update({day: result['index'] for day in dates if day not in staff_claimed})
+        full = full_days(row['department'], dates, remaining)
+        if full:
+            result.update(status='full', full_dates=full)
+            result['errors'].append('Department WFH capacity reached.')
+        else:
+            claim_capacity(row['department'], dates, row['status'], remaining)
+
+    if any(result['errors'] for result in results):
+        db.session.rollback()
+        # Overlaps and full days are conflicts, as for /add_request; anything else is a bad request
+        if all(result['status'] in ('valid', 'overlap', 'full') for result in results):
+            return jsonify({'message': 'No requests were created, some clash with existing requests or full days.',
+                            'results': results}), 409
+        return jsonify({'message': 'No requests were created, fix the invalid items and resubmit.',
+                        'results': results}), 400
+
+    try:
+        request_ids = db.session.scalars(
+            db.insert(RequestModel).returning(RequestModel.request_id, sort_by_parameter_order=True),
+            rows
+        ).all()
+        occurrences = [occurrence for request_id, row in zip(request_ids, rows)
+                       for occurrence in occurrence_rows(request_id, row)]
+        insert_occurrences(occurrences)
+        adjust_capacity(capacity_deltas(occurrences))
+        db.session.commit()
+    except OverlapError as e:
+        # Another submission claimed some of these days after they were checked
+        return jsonify({'message': 'No requests were created: ' + str(e), 'conflicts': e.conflicts}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'message': f'Error creating requests: {str(e)}'}), 500
+
+    results = [{'index': index, 'status': 'created', 'request_id': request_id}
+               for index, request_id in enumerate(request_ids)]
+    return jsonify({'message': f'{len(results)} requests created.', 'results': results}), 201
+
 # ---------------------------------- Withdraw Request ----------------------------------
 
 @app.route('/request/withdraw/<int:request_id>', methods=['PUT'])
@@ -193,26 +1022,12 @@ def withdraw_request(request_id):
     else:
         return jsonify({'message': 'Invalid role.'}), 400
 
-    # Update the request status to 'Withdrawn'
+    # Update the request status to 'Withdrawn' and queue the schedule change in the same transaction
     request_obj.status = 'Withdrawn'
+    set_occurrence_status(request_obj.request_id, request_obj.status)
+    enqueue_schedule_update(request_obj)
     db.session.commit()
 
-    # Update the schedule if necessary
-    schedule_update_url = "http://localhost:5004/schedule/update"  
-    schedule_update_data = {
-        'staff_id': request_obj.staff_id,
-        'date': request_obj.start_date,
-        'department': request_obj.department,
-        'status': request_obj.status
-    }
-
-    try:
-        response = requests.post(schedule_update_url, json=schedule_update_data)
-        if response.status_code != 200:
-            return jsonify({'message': 'Request withdrawn, but failed to update schedule.'}), 500
-    except Exception as e:
-        return jsonify({'message': 'Request withdrawn, but an error occurred while updating schedule.', 'error': str(e)}), 500
-
     return jsonify({'message': 'Request withdrawn successfully.'}), 200
 
 
@@ -250,23 +1065,10 @@ def cancel_request(request_id):
         return jsonify({'message': 'Invalid role.'}), 400
 
     request_obj.status = 'Cancelled'
+    set_occurrence_status(request_obj.request_id, request_obj.status)
+    enqueue_schedule_update(request_obj)
     db.session.commit()
 
-    schedule_update_url = "http://localhost:5004/schedule/update"  
-    schedule_update_data = {
-        'staff_id': request_obj.staff_id,
-        'date': request_obj.start_date,
-        'department': request_obj.department,
-        'status': request_obj.status
-    }
-
-    try:
-        response = requests.post(schedule_update_url, json=schedule_update_data)
-        if response.status_code != 200:
-            return jsonify({'message': 'Request canceled, but failed to update schedule.'}), 500
-    except Exception as e:
-        return jsonify({'message': 'Request canceled, but an error occurred while updating schedule.', 'error': str(e)}), 500
-
     return jsonify({'message': 'Request canceled successfully.'}), 200
 
 
@@ -306,20 +1108,39 @@ def update_request(request_id):
 
     # Update the request object with new data
     try:
+        # Days merged away only stay excluded while the request keeps its dates
+        if (str(request_obj.start_date), request_obj.duration) != (data['start_date'], data['duration']):
+            request_obj.excluded_dates = None
         request_obj.start_date = datetime.strptime(data['start_date'], '%Y-%m-%d').date()
         request_obj.duration = data['duration']
         request_obj.reason = data['reason']
         
         # Update status if it was previously approved
-        if request_obj.status == 'Approved' and data.get('status') == 'Pending':
+        was_approved = request_obj.status == 'Approved'
+        if was_approved and data.get('status') == 'Pending':
             request_obj.status = 'Pending'
 
+        # Dates may have moved, so rebuild the series
+        old_dates, new_dates = rebuild_occurrences(request_obj)
+        if was_approved:
+            # micro_schedule holds the approved days: drop the ones left behind, then send the
+            # new ones (every day again if the request went back to pending)
+            for day in sorted(old_dates - new_dates):
+                enqueue_schedule_update(request_obj, day, 'Cancelled')
+            for day in sorted(new_dates if request_obj.status == 'Pending' else new_dates - old_dates):
+                enqueue_schedule_update(request_obj, day)
         db.session.commit()
         print(f"Request {request_id} updated successfully")
         return jsonify({
             'message': 'Request updated successfully.',
             'request': request_obj.to_dict()
         }), 200
+    except OverlapError as e:
+        db.session.rollback()
+        return jsonify({'message': str(e), 'conflicts': e.conflicts}), 409
+    except CapacityError as e:
+        db.session.rollback()
+        return jsonify({'message': str(e), 'full_dates': e.full_dates}), 409
     except Exception as e:
         print(f"Error updating request {request_id}: {str(e)}")
         db.session.rollback()
@@ -353,6 +1174,181 @@ def update_request(request_id):
     # }), 200
 
 
+# ---------------------------------- Schedule Outbox ----------------------------------
+
+schedule_client = ServiceClient('schedule', upstream_url('SCHEDULE_URL', 'http://localhost:5004/schedule'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1))
+OUTBOX_MAX_BACKOFF = int(os.getenv('OUTBOX_MAX_BACKOFF', 300))  # seconds between retries, at most
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 20))  # then the row is marked dead
+OUTBOX_RETENTION_HOURS = int(os.getenv('OUTBOX_RETENTION_HOURS', 24))  # delivered rows kept this long
+# Run the dispatcher thread inside the web process; several processes may (rows are claimed
+# with SKIP LOCKED). Leave unset to run it separately with "flask --app micro_request outbox-dispatcher".
+OUTBOX_DISPATCHER = os.getenv('OUTBOX_DISPATCHER', '').lower() in ('1', 'true', 'yes')
+
+outbox_stats = {'delivered': 0, 'failed': 0, 'dead': 0, 'batches': 0}
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def enqueue_schedule_update(request_obj, day=None, status=None):
+    """Queue a schedule change for the dispatcher; the caller's commit makes it durable.
+
+    day and status default to the request's start date and status.
+    """
+    now = utcnow()
+    db.session.add(ScheduleOutbox(
+        payload=json.dumps({
+            'staff_id': request_obj.staff_id,
+            'date': day or request_obj.start_date,
+            'department': request_obj.department,
+            'status': status or request_obj.status
+        }, default=str),
+        staff_id=request_obj.staff_id,
+        created_at=now,
+        attempts=0,
+        next_attempt_at=now
+    ))
+
+
+def dispatch_outbox_batch():
+    """Deliver one batch of due outbox rows to micro_schedule; returns how many were delivered.
+
+    Rows are claimed with FOR UPDATE SKIP LOCKED so several dispatchers can run side by
+    side. A row is held back while an earlier row of the same staff member is undelivered
+    (pending, backing off after a failure, or claimed by another dispatcher), so a staff
+    member's changes reach micro_schedule in the order they were made; that also means at
+    most one row per staff member per batch. Failed rows are retried with exponential
+    backoff capped at OUTBOX_MAX_BACKOFF, and marked dead after OUTBOX_MAX_ATTEMPTS, which
+    releases the rows behind them.
+    """
+    now = utcnow()
+    earlier = db.aliased(ScheduleOutbox)
+    rows = ScheduleOutbox.query.filter(
+        ScheduleOutbox.delivered_at.is_(None),
+        ScheduleOutbox.dead_at.is_(None),
+        ScheduleOutbox.next_attempt_at <= now,
+        ~db.exists().where(
+            earlier.staff_id == ScheduleOutbox.staff_id,
+            earlier.outbox_id < ScheduleOutbox.outbox_id,
+            earlier.delivered_at.is_(None),
+            earlier.dead_at.is_(None)
+        )
+    ).order_by(ScheduleOutbox.outbox_id).limit(OUTBOX_BATCH_SIZE).with_for_update(skip_locked=True).all()
+    if not rows:
+        db.session.commit()
+        return 0
+
+    try:
+        # Batch updates are idempotent, so a couple of quick transport retries are safe
+        response = schedule_client.post('update/batch', json=[json.loads(row.payload) for row in rows], retries=2)
+        if response.status_code != 200:
+            raise RuntimeError(f"schedule service responded {response.status_code}")
+        results = response.json()['results']
+        if len(results) != len(rows):
+            raise RuntimeError(f"schedule service returned {len(results)} results for {len(rows)} updates")
+    except Exception as e:
+        results = [{'error': str(e)}] * len(rows)
+
+    delivered = 0
+    for row, result in zip(rows, results):
+        if result.get('error'):
+            row.attempts += 1
+            row.last_error = str(result['error'])[:255]
+            row.next_attempt_at = now + timedelta(seconds=min(2 ** row.attempts, OUTBOX_MAX_BACKOFF))
+            outbox_stats['failed'] += 1
+            if row.attempts >= OUTBOX_MAX_ATTEMPTS:
+                row.dead_at = now
+                outbox_stats['dead'] += 1
+                logging.error(f"Outbox row {row.outbox_id} gave up after {row.attempts} attempts: {row.last_error}")
+        else:
+            row.delivered_at = now
+            delivered += 1
+    outbox_stats['delivered'] += delivered
+    outbox_stats['batches'] += 1
+    db.session.commit()
+    return delivered
+
+
+def purge_delivered_outbox():
+    cutoff = utcnow() - timedelta(hours=OUTBOX_RETENTION_HOURS)
+    db.session.execute(db.delete(ScheduleOutbox).where(
+        ScheduleOutbox.delivered_at.is_not(None), ScheduleOutbox.delivered_at < cutoff
+    ))
+    db.session.commit()
+
+
+def run_outbox_dispatcher():
+    last_purge = 0
+    while True:
+        with app.app_context():
+            try:
+                # Keep draining while full batches come back, otherwise wait for the next poll
+                while dispatch_outbox_batch() == OUTBOX_BATCH_SIZE:
+                    pass
+                if time.monotonic() - last_purge > 3600:
+                    purge_delivered_outbox()
+                    last_purge = time.monotonic()
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Outbox dispatcher error: {e}")
+            finally:
+                db.session.remove()
+        time.sleep(OUTBOX_POLL_INTERVAL)
+
+
+outbox_dispatcher = None
+outbox_dispatcher_lock = threading.Lock()
+
+
+def start_outbox_dispatcher():
+    """Start this process's dispatcher thread, once."""
+    global outbox_dispatcher
+    with outbox_dispatcher_lock:
+        if outbox_dispatcher is None:
+            outbox_dispatcher = threading.Thread(target=run_outbox_dispatcher, name="outbox-dispatcher", daemon=True)
+            outbox_dispatcher.start()
+    return outbox_dispatcher
+
+
+@app.before_request
+def ensure_outbox_dispatcher():
+    # Started by the first request rather than at import, so it runs in whichever process
+    # serves (a gunicorn worker, the reloader's child) and never in the reloader's watcher
+    if OUTBOX_DISPATCHER and outbox_dispatcher is None:
+        start_outbox_dispatcher()
+
+
+@app.cli.command('outbox-dispatcher')
+def outbox_dispatcher_command():
+    """Deliver the schedule outbox until interrupted."""
+    run_outbox_dispatcher()
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format: outbox backlog and lag
+    backlog, oldest = db.session.query(
+        db.func.count(ScheduleOutbox.outbox_id), db.func.min(ScheduleOutbox.created_at)
+    ).filter(ScheduleOutbox.delivered_at.is_(None), ScheduleOutbox.dead_at.is_(None)).one()
+    retrying = ScheduleOutbox.query.filter(
+        ScheduleOutbox.delivered_at.is_(None), ScheduleOutbox.dead_at.is_(None), ScheduleOutbox.attempts > 0
+    ).count()
+    dead = ScheduleOutbox.query.filter(ScheduleOutbox.dead_at.is_not(None)).count()
+    lag = (utcnow() - oldest).total_seconds() if oldest else 0
+    lines = [
+        "# TYPE schedule_outbox_backlog gauge", f"schedule_outbox_backlog {backlog}",
+        "# TYPE schedule_outbox_retrying gauge", f"schedule_outbox_retrying {retrying}",
+        "# TYPE schedule_outbox_dead gauge", f"schedule_outbox_dead {dead}",
+        "# TYPE schedule_outbox_lag_seconds gauge", f"schedule_outbox_lag_seconds {lag:.3f}",
+    ]
+    for counter, value in outbox_stats.items():
+        lines += [f"# TYPE schedule_outbox_{counter}_total counter", f"schedule_outbox_{counter}_total {value}"]
+    return Response("\n".join(lines) + "\n" + latency_stats.metrics(), mimetype="text/plain; version=0.0.4")
+
+
 # ---------------------------------- Main ----------------------------------
 
 if __name__ == '__main__':
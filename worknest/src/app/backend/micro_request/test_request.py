@@ -1,8 +1,12 @@
+import base64
 import unittest
 from unittest.mock import patch, MagicMock
 from flask import json
-from micro_request import app, RequestModel, db
+from micro_request import (app, RequestModel, ScheduleOutbox, DepartmentWfhLimit, db, dispatch_outbox_batch,
+                           enqueue_schedule_update, find_overlaps)
 from datetime import datetime, timedelta
+from types import SimpleNamespace
+import micro_request
 
 class RequestServiceTestCase(unittest.TestCase):
     def setUp(self):
@@ -41,8 +45,9 @@ class RequestServiceTestCase(unittest.TestCase):
         self.assertEqual(data[1]['request_id'], 2)
         self.assertEqual(data[1]['recurring_days'], 2)
 
+    @patch('micro_request.rebuild_occurrences')
     @patch('micro_request.RequestModel.query')
-    def test_update_request(self, mock_query):
+    def test_update_request(self, mock_query, mock_rebuild):
         mock_request = MagicMock()
         mock_request.status = 'Pending'
         mock_request.staff_id = 1
@@ -57,6 +62,7 @@ class RequestServiceTestCase(unittest.TestCase):
             'status': 'Pending'
         }
         mock_query.get.return_value = mock_request
+        mock_rebuild.return_value = (set(), set())
 
         update_data = {
             'start_date': '2024-02-01',
@@ -81,9 +87,11 @@ class RequestServiceTestCase(unittest.TestCase):
         self.assertEqual(mock_request.start_date.isoformat(), '2024-02-01')
         self.assertEqual(mock_request.duration, 3)
         self.assertEqual(mock_request.reason, 'WFH - Updated')
+        mock_rebuild.assert_called_once_with(mock_request)
 
+    @patch('micro_request.rebuild_occurrences')
     @patch('micro_request.RequestModel.query')
-    def test_update_approved_request(self, mock_query):
+    def test_update_approved_request(self, mock_query, mock_rebuild):
         mock_request = MagicMock()
         mock_request.status = 'Approved'
         mock_request.staff_id = 1
@@ -98,6 +106,7 @@ class RequestServiceTestCase(unittest.TestCase):
             'status': 'Pending'
         }
         mock_query.get.return_value = mock_request
+        mock_rebuild.return_value = (set(), set())
 
         update_data = {
             'start_date': '2024-02-01',
@@ -138,5 +147,504 @@ class RequestServiceTestCase(unittest.TestCase):
         self.assertEqual(data['reason'], "WFH")
         self.assertEqual(data['recurring_days'], 1)
 
+class RequestListTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.app.testing = True
+        with app.app_context():
+            db.create_all()
+            for i, status in enumerate(["pending", "Approved", "pending", "pending", "Rejected"]):
+                db.session.add(RequestModel(staff_id=1, department="IT", start_date=f"2024-01-{10 - i:02d}",
+                    reason="WFH", duration=1, status=status, reporting_manager_id=2,
+                    reporting_manager_name="John Doe", reporting_manager_email="john@example.com",
+                    requester_email="staff@example.com"))
+            db.session.commit()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_keyset_pagination(self):
+        response = self.app.get('/requests/manager/2?limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['request_id'] for r in json.loads(response.data)], [1, 2])
+
+        cursor = response.headers['X-Next-Cursor']
+        response = self.app.get(f'/requests/manager/2?limit=2&cursor={cursor}')
+        self.assertEqual([r['request_id'] for r in json.loads(response.data)], [3, 4])
+
+        cursor = response.headers['X-Next-Cursor']
+        response = self.app.get(f'/requests/manager/2?limit=2&cursor={cursor}')
+        self.assertEqual([r['request_id'] for r in json.loads(response.data)], [5])
+        self.assertNotIn('X-Next-Cursor', response.headers)
+
+    def test_malformed_cursor_is_a_bad_request(self):
+        def cursor(value):
+            return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+        for order_by, bad in (('request_id', 'not base64!'), ('request_id', cursor({'a': 1})), ('request_id', cursor(3)),
+                              ('request_id', cursor([[1]])), ('request_id', cursor(['3'])), ('request_id', cursor([True])),
+                              ('request_id', cursor([1, 2])), ('start_date', cursor(['2024-01-07'])),
+                              ('start_date', cursor(['yesterday', 1])), ('start_date', cursor([20240107, 1]))):
+            with self.subTest(order_by=order_by, cursor=bad):
+                response = self.app.get(f'/requests/manager/2?limit=2&order_by={order_by}&cursor={bad}')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('ursor', json.loads(response.data)['message'])
+
+        response = self.app.get(f"/requests/manager/2?limit=2&order_by=start_date&cursor={cursor(['2024-01-07', 4])}")
+        self.assertEqual(response.status_code, 200)
+
+    def test_status_filter_and_projection(self):
+        response = self.app.get('/request/staff/1?status=Pending&fields=request_id,start_date&order_by=start_date&limit=2')
+        self.assertEqual(response.status_code, 200)
+
+        data = json.loads(response.data)
+        self.assertEqual(data, [
+            {'request_id': 4, 'start_date': '2024-01-07'},
+            {'request_id': 3, 'start_date': '2024-01-08'},
+        ])
+
+        cursor = response.headers['X-Next-Cursor']
+        response = self.app.get(f'/request/staff/1?status=pending&fields=request_id&order_by=start_date&limit=2&cursor={cursor}')
+        self.assertEqual(json.loads(response.data), [{'request_id': 1}])
+
+    def test_stream_requests(self):
+        response = self.app.get('/request?stream=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([row['request_id'] for row in rows], [1, 2, 3, 4, 5])
+        self.assertEqual(rows[0]['start_date'], '2024-01-10')
+        self.assertNotIn('ETag', response.headers)
+        page = self.app.get('/request?limit=2')
+        self.assertEqual(self.app.get('/request?limit=2', headers={'If-None-Match': page.headers['ETag']}).status_code, 304)
+
+        response = self.app.get('/request?status=pending', headers={'Accept': 'application/x-ndjson'})
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([row['request_id'] for row in rows], [1, 3, 4])
+
+        # Projection and order work as for a page; paging does not apply to a stream
+        response = self.app.get('/request?stream=1&status=pending&fields=request_id,start_date&order_by=start_date')
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(rows, [{'request_id': 4, 'start_date': '2024-01-07'}, {'request_id': 3, 'start_date': '2024-01-08'},
+                                {'request_id': 1, 'start_date': '2024-01-10'}])
+        for query in ('limit=2', 'cursor=abc', 'fields=password', 'order_by=reason'):
+            with self.subTest(query=query):
+                response = self.app.get(f'/request?stream=1&{query}')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('message', json.loads(response.data))
+
+    def test_add_requests_batch(self):
+        payload = {
+            "staff_id": 7, "department": "IT", "reason": "WFH", "duration": 1, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com",
+            "requests": [{"start_date": "2024-02-01"}, {"start_date": "2024-02-02"}, {"start_date": "2024-02-03", "staff_id": 8}]
+        }
+        response = self.app.post('/add_requests', json=payload)
+        self.assertEqual(response.status_code, 201)
+
+        data = json.loads(response.data)
+        self.assertEqual([r['request_id'] for r in data['results']], [6, 7, 8])
+        with app.app_context():
+            self.assertEqual(RequestModel.query.filter_by(staff_id=7).count(), 2)
+            self.assertEqual(db.session.get(RequestModel, 8).staff_id, 8)
+
+    def test_add_requests_batch_is_all_or_nothing(self):
+        payload = {
+            "staff_id": 7, "department": "IT", "reason": "WFH", "duration": 1, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com",
+            "requests": [{"start_date": "2024-02-01"}, {"start_date": "01-02-2024"}]
+        }
+        response = self.app.post('/add_requests', json=payload)
+        self.assertEqual(response.status_code, 400)
+
+        data = json.loads(response.data)
+        self.assertEqual(data['results'][0]['status'], 'valid')
+        self.assertEqual(data['results'][1]['errors'], ['start_date must be YYYY-MM-DD.'])
+        with app.app_context():
+            self.assertEqual(RequestModel.query.filter_by(staff_id=7).count(), 0)
+
+        # Booleans are not numbers here, and the defaults are checked like the items
+        for defaults, error in (({"duration": True}, 'duration must be a positive integer.'),
+                                ({"staff_id": "7"}, 'staff_id must be an integer.'),
+                                ({"staff_id": False}, 'staff_id must be an integer.')):
+            with self.subTest(defaults=defaults):
+                response = self.app.post('/add_requests', json={**payload, **defaults, "requests": [{"start_date": "2024-02-01"}]})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(error, json.loads(response.data)['results'][0]['errors'])
+
+    def test_add_recurring_request_materializes_occurrences(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 1, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com",
+            "recurrence_weekdays": [0, 2], "recurrence_end_date": "2024-03-17"
+        }
+        response = self.app.post('/add_request/7', json=payload)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.data)['recurrence_weekdays'], '0,2')
+
+        response = self.app.get('/occurrences?staff_id=7')
+        dates = [o['occurrence_date'] for o in json.loads(response.data)]
+        self.assertEqual(dates, ['2024-03-04', '2024-03-06', '2024-03-11', '2024-03-13'])
+
+    @patch('micro_request.schedule_client.post')
+    def test_cancel_series_updates_all_occurrences(self, mock_post):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 3, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        request_id = json.loads(self.app.post('/add_request/7', json=payload).data)['request_id']
+
+        response = self.app.put(f'/request/cancel/{request_id}', headers={'X-Role': '2', 'X-Staff-ID': '7', 'X-Department': 'IT'})
+        self.assertEqual(response.status_code, 200)
+
+        statuses = [o['status'] for o in json.loads(self.app.get(f'/occurrences?request_id={request_id}').data)]
+        self.assertEqual(statuses, ['Cancelled'] * 3)
+
+        # The schedule change is queued in the outbox, not sent inside the request
+        mock_post.assert_not_called()
+        with app.app_context():
+            outbox = ScheduleOutbox.query.one()
+            self.assertEqual(json.loads(outbox.payload), {'staff_id': 7, 'date': '2024-03-04', 'department': 'IT', 'status': 'Cancelled'})
+
+    @patch('micro_request.run_outbox_dispatcher')
+    def test_dispatcher_starts_with_the_first_request_when_enabled(self, mock_run):
+        self.addCleanup(setattr, micro_request, 'outbox_dispatcher', None)
+        self.app.get('/metrics')
+        mock_run.assert_not_called()
+
+        with patch('micro_request.OUTBOX_DISPATCHER', True):
+            self.app.get('/metrics')
+            self.app.get('/metrics')
+            micro_request.outbox_dispatcher.join(5)
+        mock_run.assert_called_once_with()
+
+        app.test_cli_runner().invoke(args=['outbox-dispatcher'])
+        self.assertEqual(mock_run.call_count, 2)
+
+    def test_moving_an_approved_request_queues_the_schedule_changes(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 2, "status": "Approved",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        request_id = json.loads(self.app.post('/add_request/7', json=payload).data)['request_id']
+        headers = {'X-Role': '2', 'X-Staff-ID': '7', 'X-Department': 'IT'}
+
+        def queued():
+            with app.app_context():
+                rows = [(json.loads(row.payload)['date'], json.loads(row.payload)['status'], row.staff_id)
+                        for row in ScheduleOutbox.query.order_by(ScheduleOutbox.outbox_id)]
+                db.session.query(ScheduleOutbox).delete()
+                db.session.commit()
+            return rows
+
+        self.app.put(f'/request/update/{request_id}', json={"start_date": "2024-03-05", "duration": 2, "reason": "WFH"}, headers=headers)
+        self.assertEqual(queued(), [('2024-03-04', 'Cancelled', 7), ('2024-03-06', 'Approved', 7)])
+
+        # Back to pending on the same days: every day is sent again with the new status
+        self.app.put(f'/request/update/{request_id}', json={"start_date": "2024-03-05", "duration": 2, "reason": "WFH", "status": "Pending"}, headers=headers)
+        self.assertEqual(queued(), [('2024-03-05', 'Pending', 7), ('2024-03-06', 'Pending', 7)])
+
+        # A pending request is not on the schedule, so moving it queues nothing
+        self.app.put(f'/request/update/{request_id}', json={"start_date": "2024-03-11", "duration": 1, "reason": "WFH"}, headers=headers)
+        self.assertEqual(queued(), [])
+
+    @patch('micro_request.schedule_client.post')
+    def test_outbox_dispatch_and_retry(self, mock_post):
+        headers = {'X-Role': '1', 'X-Staff-ID': '9', 'X-Department': 'IT'}
+        self.app.put('/request/withdraw/1', headers=headers)
+        self.app.put('/request/withdraw/3', headers=headers)
+        change = SimpleNamespace(staff_id=8, start_date='2024-03-05', department='IT', status='Cancelled')
+        with app.app_context():
+            enqueue_schedule_update(change)
+            db.session.commit()
+
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {'results': [{'created': False}, {'error': 'boom'}]}
+        with app.app_context():
+            # Staff 1's second change waits for the first
+            self.assertEqual(dispatch_outbox_batch(), 1)
+            self.assertEqual([(u['staff_id'], u['status']) for u in mock_post.call_args.kwargs['json']],
+                             [(1, 'Withdrawn'), (8, 'Cancelled')])
+
+            delivered, held, failed = ScheduleOutbox.query.order_by(ScheduleOutbox.outbox_id).all()
+            self.assertIsNotNone(delivered.delivered_at)
+            self.assertIsNone(failed.delivered_at)
+            self.assertEqual(failed.attempts, 1)
+            self.assertGreater(failed.next_attempt_at, failed.created_at)
+
+            mock_post.return_value.json.return_value = {'results': [{'created': True}]}
+            self.assertEqual(dispatch_outbox_batch(), 1)
+            self.assertEqual([u['staff_id'] for u in mock_post.call_args.kwargs['json']], [1])
+
+            # Staff 8's next change is held while the failed one backs off
+            enqueue_schedule_update(change)
+            db.session.commit()
+            mock_post.reset_mock()
+            self.assertEqual(dispatch_outbox_batch(), 0)
+            mock_post.assert_not_called()
+
+            # A reply that does not match the batch fails every row; at the attempt cap the row is dead
+            failed.next_attempt_at = failed.created_at
+            db.session.commit()
+            mock_post.return_value.json.return_value = {'results': []}
+            with patch('micro_request.OUTBOX_MAX_ATTEMPTS', 2):
+                self.assertEqual(dispatch_outbox_batch(), 0)
+            failed = db.session.get(ScheduleOutbox, failed.outbox_id)
+            self.assertEqual(failed.attempts, 2)
+            self.assertIsNotNone(failed.dead_at)
+            self.assertIn('0 results for 1 updates', failed.last_error)
+
+            metrics = self.app.get('/metrics').data.decode()
+            self.assertIn('schedule_outbox_backlog 1', metrics)
+            self.assertIn('schedule_outbox_dead 1', metrics)
+
+            # The dead row no longer holds up the one behind it
+            mock_post.return_value.json.return_value = {'results': [{'created': True}]}
+            self.assertEqual(dispatch_outbox_batch(), 1)
+            self.assertIsNone(ScheduleOutbox.query.filter(ScheduleOutbox.delivered_at.is_(None),
+                                                          ScheduleOutbox.dead_at.is_(None)).first())
+
+    def test_overlapping_request_is_rejected_or_merged(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 3, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        first = json.loads(self.app.post('/add_request/7', json=payload).data)['request_id']
+
+        response = self.app.post('/add_request/7', json={**payload, "start_date": "2024-03-06"})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)['conflicts'], [{'request_id': first, 'date': '2024-03-06'}])
+
+        # Another staff member is unaffected
+        self.assertEqual(self.app.post('/add_request/8', json={**payload, "start_date": "2024-03-06"}).status_code, 201)
+
+        response = self.app.post('/add_request/7', json={**payload, "start_date": "2024-03-06", "on_overlap": "merge"})
+        self.assertEqual(response.status_code, 201)
+        merged = json.loads(response.data)['request_id']
+        dates = [o['occurrence_date'] for o in json.loads(self.app.get(f'/occurrences?request_id={merged}').data)]
+        self.assertEqual(dates, ['2024-03-07', '2024-03-08'])
+
+        # Withdrawn days no longer block
+        self.app.put(f'/request/withdraw/{first}', headers={'X-Role': '1', 'X-Staff-ID': '9', 'X-Department': 'IT'})
+        self.assertEqual(self.app.post('/add_request/7', json={**payload, "duration": 2}).status_code, 201)
+
+    def test_update_keeps_merged_days_excluded(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 3, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        self.app.post('/add_request/7', json=payload)
+        merged = json.loads(self.app.post('/add_request/7', json={**payload, "start_date": "2024-03-06", "on_overlap": "merge"}).data)
+        self.assertEqual(merged['excluded_dates'], '2024-03-06')
+
+        # Changing only the reason rebuilds the same days, without the one merged away
+        response = self.app.put(f"/request/update/{merged['request_id']}", json={"start_date": "2024-03-06", "duration": 3, "reason": "Dentist"},
+                                headers={'X-Role': '2', 'X-Staff-ID': '7', 'X-Department': 'IT'})
+        self.assertEqual(response.status_code, 200)
+        dates = [o['occurrence_date'] for o in json.loads(self.app.get(f"/occurrences?request_id={merged['request_id']}").data)]
+        self.assertEqual(dates, ['2024-03-07', '2024-03-08'])
+
+        # Moving the request drops the exclusions and checks every new day again
+        response = self.app.put(f"/request/update/{merged['request_id']}", json={"start_date": "2024-03-11", "duration": 2, "reason": "Dentist"},
+                                headers={'X-Role': '2', 'X-Staff-ID': '7', 'X-Department': 'IT'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(json.loads(response.data)['request']['excluded_dates'])
+        dates = [o['occurrence_date'] for o in json.loads(self.app.get(f"/occurrences?request_id={merged['request_id']}").data)]
+        self.assertEqual(dates, ['2024-03-11', '2024-03-12'])
+
+    def test_overlap_missed_by_the_check_is_refused_by_the_database(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 2, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        first = json.loads(self.app.post('/add_request/7', json=payload).data)['request_id']
+
+        # As if a concurrent submission checked before the first one committed: the read finds nothing
+        def stale_check(*args):
+            return stale.pop() if stale else find_overlaps(*args)
+
+        stale = [[]]
+        with patch('micro_request.find_overlaps', side_effect=stale_check):
+            response = self.app.post('/add_request/7', json={**payload, "start_date": "2024-03-05"})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)['conflicts'], [{'request_id': first, 'date': '2024-03-05'}])
+
+        stale = [[]]
+        with patch('micro_request.find_overlaps', side_effect=stale_check):
+            response = self.app.post('/add_requests', json={**payload, "staff_id": 7, "requests": [{"start_date": "2024-03-05"}]})
+        self.assertEqual(response.status_code, 409)
+        with app.app_context():
+            self.assertEqual(RequestModel.query.filter_by(staff_id=7).count(), 1)
+            self.assertEqual(len(find_overlaps(7, [datetime(2024, 3, 5).date()])), 1)
+
+    def test_update_into_overlap_is_rejected(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 1, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        self.app.post('/add_request/7', json=payload)
+        second = json.loads(self.app.post('/add_request/7', json={**payload, "start_date": "2024-03-05"}).data)['request_id']
+
+        response = self.app.put(f'/request/update/{second}', json={"start_date": "2024-03-04", "duration": 1, "reason": "WFH"},
+                                headers={'X-Role': '2', 'X-Staff-ID': '7', 'X-Department': 'IT'})
+        self.assertEqual(response.status_code, 409)
+        with app.app_context():
+            self.assertEqual(db.session.get(RequestModel, second).start_date, '2024-03-05')
+
+    def test_add_requests_batch_rejects_overlaps_within_batch(self):
+        payload = {
+            "staff_id": 7, "department": "IT", "reason": "WFH", "duration": 2, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com",
+            "requests": [{"start_date": "2024-02-01"}, {"start_date": "2024-02-02"}, {"start_date": "2024-02-02", "staff_id": 8}]
+        }
+        response = self.app.post('/add_requests', json=payload)
+        self.assertEqual(response.status_code, 409)
+
+        results = json.loads(response.data)['results']
+        self.assertEqual(results[1]['conflicts'], [{'index': 0, 'date': '2024-02-02'}])
+        self.assertEqual(results[2]['status'], 'valid')
+
+    def test_who_is_wfh_on_date(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 2, "status": "Approved",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        self.app.post('/add_request/7', json=payload)
+        self.app.post('/add_request/8', json={**payload, "department": "Sales"})
+        self.app.post('/add_request/9', json={**payload, "status": "pending"})
+
+        data = json.loads(self.app.get('/wfh?date=2024-03-05').data)
+        self.assertEqual([s['staff_id'] for s in data['staff']], [7, 8])
+
+        data = json.loads(self.app.get('/wfh?date=2024-03-05&department=IT&status=approved,pending').data)
+        self.assertEqual([s['staff_id'] for s in data['staff']], [7, 9])
+
+        self.assertEqual(self.app.get('/wfh').status_code, 400)
+
+    def test_department_capacity_counters(self):
+        with app.app_context():
+            db.session.add(DepartmentWfhLimit(department="IT", headcount=2, max_ratio=0.5))
+            db.session.commit()
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 2, "status": "Approved",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        self.app.post('/add_request/7', json={**payload, "duration": 1})
+        pending = json.loads(self.app.post('/add_request/9', json={**payload, "start_date": "2024-03-05", "duration": 1, "status": "pending"}).data)['request_id']
+
+        data = json.loads(self.app.get('/capacity?department=IT&start=2024-03-04&end=2024-03-06').data)
+        self.assertEqual(data['limit'], 1)
+        self.assertEqual(data['days'], [
+            {'date': '2024-03-04', 'approved': 1, 'pending': 0, 'remaining': 0},
+            {'date': '2024-03-05', 'approved': 0, 'pending': 1, 'remaining': 1},
+            {'date': '2024-03-06', 'approved': 0, 'pending': 0, 'remaining': 1},
+        ])
+
+        # 2024-03-04 is full, so a request touching it is refused
+        response = self.app.post('/add_request/8', json=payload)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)['full_dates'], ['2024-03-04'])
+
+        # 2024-03-07 has room for one approval: the batch's second approved item counts the first
+        batch = {**payload, "duration": 1, "start_date": "2024-03-07",
+                 "requests": [{"staff_id": 11, "status": "pending"}, {"staff_id": 10}, {"staff_id": 12}]}
+        response = self.app.post('/add_requests', json=batch)
+        self.assertEqual(response.status_code, 409)
+        results = json.loads(response.data)['results']
+        self.assertEqual([result['status'] for result in results], ['valid', 'valid', 'full'])
+        self.assertEqual(results[2]['full_dates'], ['2024-03-07'])
+        batch['requests'].pop()
+        self.assertEqual(self.app.post('/add_requests', json=batch).status_code, 201)
+        data = json.loads(self.app.get('/capacity?department=IT&start=2024-03-07&end=2024-03-07').data)
+        self.assertEqual(data['days'], [{'date': '2024-03-07', 'approved': 1, 'pending': 1, 'remaining': 0}])
+
+        # Withdrawing and moving requests keep the counters in step
+        self.app.put(f'/request/withdraw/{pending}', headers={'X-Role': '1', 'X-Staff-ID': '9', 'X-Department': 'IT'})
+        self.app.put('/request/update/6', json={"start_date": "2024-03-06", "duration": 1, "reason": "WFH"},
+                     headers={'X-Role': '2', 'X-Staff-ID': '7', 'X-Department': 'IT'})
+        data = json.loads(self.app.get('/capacity?department=IT&start=2024-03-04&end=2024-03-06').data)
+        self.assertEqual([(d['approved'], d['pending']) for d in data['days']], [(0, 0), (0, 0), (1, 0)])
+
+        # Moving the approved request onto the full 2024-03-07 is refused and changes nothing
+        response = self.app.put('/request/update/6', json={"start_date": "2024-03-06", "duration": 2, "reason": "WFH"},
+                                headers={'X-Role': '2', 'X-Staff-ID': '7', 'X-Department': 'IT'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)['full_dates'], ['2024-03-07'])
+        data = json.loads(self.app.get('/capacity?department=IT&start=2024-03-06&end=2024-03-07').data)
+        self.assertEqual([(d['approved'], d['pending']) for d in data['days']], [(1, 0), (1, 1)])
+        with app.app_context():
+            self.assertEqual(db.session.get(RequestModel, 6).duration, 1)
+
+    def test_date_window_follows_recurrence(self):
+        payload = {
+            "department": "Sales", "start_date": "2024-03-04", "reason": "WFH", "duration": 1, "status": "Approved",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        # Every Monday in March, and a one-off Wednesday
+        mondays = json.loads(self.app.post('/add_request/7', json={**payload, "recurrence_weekdays": [0], "recurrence_end_date": "2024-03-25"}).data)['request_id']
+        wednesday = json.loads(self.app.post('/add_request/8', json={**payload, "start_date": "2024-03-06"}).data)['request_id']
+
+        def ids(query):
+            response = self.app.get('/request?department=Sales&' + query)
+            if response.mimetype == 'application/x-ndjson':
+                return [json.loads(line)['request_id'] for line in response.data.decode().splitlines()]
+            return [r['request_id'] for r in json.loads(response.data)]
+
+        self.assertEqual(ids('start=2024-03-05&end=2024-03-10'), [wednesday])
+        self.assertEqual(ids('start=2024-03-18&end=2024-03-18'), [mondays])
+        self.assertEqual(ids('start=2024-03-26'), [])
+        self.assertEqual(ids('end=2024-03-05'), [mondays])
+        self.assertEqual(ids('start=2024-03-05&end=2024-03-12&limit=1'), [mondays])
+        self.assertEqual(ids('start=2024-03-07&end=2024-03-12&stream=1'), [mondays])
+
+        # The joined schedule view reads a manager's team straight from the occurrences
+        days = json.loads(self.app.get('/occurrences?reporting_manager_id=2&start=2024-03-04&end=2024-03-11').data)
+        self.assertEqual([(d['staff_id'], d['occurrence_date']) for d in days], [(7, '2024-03-04'), (8, '2024-03-06'), (7, '2024-03-11')])
+        self.assertEqual(json.loads(self.app.get('/occurrences?reporting_manager_id=3').data), [])
+
+    def test_dates_are_returned_as_iso(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 1, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com"
+        }
+        request_id = json.loads(self.app.post('/add_request/7', json=payload).data)['request_id']
+        # The update stores a datetime.date, as PostgreSQL returns for every start_date
+        response = self.app.put(f'/request/update/{request_id}', json={"start_date": "2024-03-06", "duration": 1, "reason": "WFH"},
+                                headers={'X-Role': '2', 'X-Staff-ID': '7', 'X-Department': 'IT'})
+        self.assertEqual(json.loads(response.data)['request']['start_date'], '2024-03-06')
+        with app.app_context():
+            self.assertEqual(app.json.dumps({'at': datetime(2024, 3, 1, 9, 30)}), '{"at": "2024-03-01T09:30:00"}')
+
+    def test_invalid_recurrence(self):
+        payload = {
+            "department": "IT", "start_date": "2024-03-04", "reason": "WFH", "duration": 1, "status": "pending",
+            "reporting_manager_id": 2, "reporting_manager_name": "John Doe",
+            "reporting_manager_email": "john@example.com", "requester_email": "staff7@example.com",
+            "recurrence_weekdays": [0, 9], "recurrence_end_date": "2024-03-17"
+        }
+        self.assertEqual(self.app.post('/add_request/7', json=payload).status_code, 400)
+
+    def test_invalid_list_args(self):
+        self.assertEqual(self.app.get('/request?fields=password').status_code, 400)
+        self.assertEqual(self.app.get('/request?limit=0').status_code, 400)
+        self.assertEqual(self.app.get('/request?order_by=reason').status_code, 400)
+
 if __name__ == '__main__':
     unittest.main()
@@ -47,34 +47,66 @@ class Schedule(db.Model):
 
 # ---------------------------------- Update Schedule ----------------------------------
 
+def apply_schedule_update(data):
+    """Create or update the staff member's schedule entry; returns True if it was created."""
+    staff_id = data['staff_id']
+    date = datetime.strptime(data['date'], "%Y-%m-%d").date()
+    department = data['department']
+    status = data['status']
+
+    schedule_entry = Schedule.query.filter_by(staff_id=staff_id).first()
+
+    if schedule_entry:
+        schedule_entry.date = date
+        schedule_entry.department = department
+        schedule_entry.status = status
+        return False
+    db.session.add(Schedule(staff_id=staff_id, date=date, department=department, status=status))
+    return True
+
+
 @app.route('/schedule/update', methods=['POST'])
 def update_schedule():
     try:
         data = request.get_json()
-        staff_id = data['staff_id']
-        date = datetime.strptime(data['date'], "%Y-%m-%d").date()
-        department = data['department']
-        status = data['status']
-
-        schedule_entry = Schedule.query.filter_by(staff_id=staff_id).first()
-
-        if schedule_entry:
-            schedule_entry.date = date
-            schedule_entry.department = department
-            schedule_entry.status = status
-            db.session.commit()
-            return jsonify({"message": "Schedule updated successfully"}), 200
-        else:
-            new_schedule = Schedule(staff_id=staff_id, date=date, department=department, status=status)
-            db.session.add(new_schedule)
-            db.session.commit()
+        created = apply_schedule_update(data)
+        db.session.commit()
+        if created:
             return jsonify({"message": "New schedule entry created successfully"}), 201
+        return jsonify({"message": "Schedule updated successfully"}), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
 
 
+# ---------------------------------- Batch Update Schedule ----------------------------------
+
+@app.route('/schedule/update/batch', methods=['POST'])
+def update_schedule_batch():
+    """Apply a list of schedule updates in order with one commit; used by the micro_request outbox."""
+    data = request.get_json()
+    if not isinstance(data, list):
+        return jsonify({"error": "Expected a list of schedule updates"}), 400
+
+    results = []
+    for item in data:
+        try:
+            with db.session.begin_nested():
+                created = apply_schedule_update(item)
+            results.append({"staff_id": item.get('staff_id'), "created": created})
+        except Exception as e:
+            results.append({"staff_id": item.get('staff_id') if isinstance(item, dict) else None, "error": str(e)})
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"results": results}), 200
+
+
+
 # ---------------------------------- Get All Schedules ----------------------------------
 
 @app.route('/schedule', methods=['GET'])
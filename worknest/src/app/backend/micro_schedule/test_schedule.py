@@ -123,6 +123,28 @@ class ScheduleServiceTestCase(unittest.TestCase):
             self.assertEqual(new_schedule.department, "HR")
             self.assertEqual(new_schedule.status, "present")
 
+    def test_batch_update_schedule(self):
+        with app.app_context():
+            db.session.add(Schedule(staff_id=1, date="2024-01-01", department="HR", status="present"))
+            db.session.commit()
+
+        updates = [
+            {"staff_id": 1, "date": "2024-01-02", "department": "HR", "status": "Withdrawn"},
+            {"staff_id": 2, "date": "not-a-date", "department": "IT", "status": "Cancelled"},
+            {"staff_id": 3, "date": "2024-01-03", "department": "IT", "status": "Cancelled"},
+        ]
+        response = self.app.post('/schedule/update/batch', json=updates)
+        self.assertEqual(response.status_code, 200)
+
+        results = json.loads(response.data)['results']
+        self.assertEqual(results[0], {"staff_id": 1, "created": False})
+        self.assertIn("error", results[1])
+        self.assertEqual(results[2], {"staff_id": 3, "created": True})
+
+        with app.app_context():
+            self.assertEqual(Schedule.query.filter_by(staff_id=1).first().status, "Withdrawn")
+            self.assertIsNone(Schedule.query.filter_by(staff_id=2).first())
+
     def test_get_schedule_not_found(self):
         # Send GET request to the /schedule/<staff_id> route for a non-existent staff_id
         response = self.app.get('/schedule/999')
@@ -0,0 +1,30 @@
+-- Recurrence columns and materialized occurrences for requests (see worknest.sql).
+-- Idempotent so databases created from the updated worknest.sql can run it too.
+
+ALTER TABLE request ADD COLUMN IF NOT EXISTS recurrence_weekdays VARCHAR(20);
+ALTER TABLE request ADD COLUMN IF NOT EXISTS recurrence_end_date DATE;
+
+CREATE TABLE IF NOT EXISTS request_occurrence (
+    occurrence_id SERIAL PRIMARY KEY,
+    request_id INT NOT NULL,
+    staff_id INT NOT NULL,
+    department VARCHAR(50) NOT NULL,
+    occurrence_date DATE NOT NULL,
+    status VARCHAR(50) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_request_occurrence_request_id ON request_occurrence (request_id);
+CREATE INDEX IF NOT EXISTS ix_request_occurrence_staff_date ON request_occurrence (staff_id, occurrence_date);
+CREATE INDEX IF NOT EXISTS ix_request_occurrence_department_date ON request_occurrence (department, occurrence_date);
+
+-- Materialize the requests that already exist: duration consecutive days from start_date,
+-- or every listed weekday (0 = Monday) up to recurrence_end_date for a recurring series.
+-- Requests that already have occurrences are left alone, so running this again is harmless.
+INSERT INTO request_occurrence (request_id, staff_id, department, occurrence_date, status)
+SELECT r.request_id, r.staff_id, r.department, r.start_date + day, r.status
+FROM request r
+CROSS JOIN generate_series(0, CASE WHEN r.recurrence_weekdays IS NULL THEN greatest(r.duration, 1) - 1
+                                   ELSE r.recurrence_end_date - r.start_date END) AS day
+WHERE (r.recurrence_weekdays IS NULL
+       OR (extract(isodow FROM r.start_date + day)::INT - 1)::TEXT = ANY (string_to_array(r.recurrence_weekdays, ',')))
+  AND NOT EXISTS (SELECT 1 FROM request_occurrence o WHERE o.request_id = r.request_id)
+ORDER BY r.request_id, day;
@@ -0,0 +1,15 @@
+-- Composite indexes for the filters the services actually run.
+-- schedule is only ever looked up by staff_id (its primary key) and audit_log by
+-- request_id (unique), so neither needs more than it already has.
+
+-- micro_request: /request/staff/<id> (keyset on request_id)
+CREATE INDEX IF NOT EXISTS ix_request_staff_id ON request (staff_id, request_id);
+
+-- micro_request: /requests/manager/<id>?status=pending (case-insensitive status, keyset on request_id)
+CREATE INDEX IF NOT EXISTS ix_request_manager_status ON request (reporting_manager_id, lower(status), request_id);
+
+-- micro_request: /request?department=..&start=..&end=.. and the complex schedule view
+CREATE INDEX IF NOT EXISTS ix_request_department_start_date ON request (department, start_date);
+
+-- micro_request: /request?start=..&end=.. and order_by=start_date keyset
+CREATE INDEX IF NOT EXISTS ix_request_start_date ON request (start_date, request_id);
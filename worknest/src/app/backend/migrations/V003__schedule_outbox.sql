@@ -0,0 +1,14 @@
+-- Transactional outbox for schedule changes made by micro_request (withdraw / cancel).
+
+CREATE TABLE IF NOT EXISTS schedule_outbox (
+    outbox_id SERIAL PRIMARY KEY,
+    payload TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL,
+    delivered_at TIMESTAMP,
+    last_error VARCHAR(255)
+);
+
+-- The dispatcher only ever looks at undelivered rows
+CREATE INDEX IF NOT EXISTS ix_schedule_outbox_pending ON schedule_outbox (outbox_id) WHERE delivered_at IS NULL;
@@ -0,0 +1,10 @@
+-- Overlap checks and "who is WFH on date X" only look at days that still count:
+-- pending or approved occurrences. Partial indexes keep those lookups small as
+-- withdrawn, rejected and cancelled history accumulates.
+CREATE INDEX IF NOT EXISTS ix_request_occurrence_active_staff_date
+    ON request_occurrence (staff_id, occurrence_date)
+    WHERE lower(status) IN ('pending', 'approved');
+
+CREATE INDEX IF NOT EXISTS ix_request_occurrence_active_date
+    ON request_occurrence (occurrence_date, staff_id)
+    WHERE lower(status) IN ('pending', 'approved');
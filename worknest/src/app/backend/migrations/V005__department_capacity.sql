@@ -0,0 +1,33 @@
+-- Per-department WFH limits and per-day counters used to enforce them without counting
+-- requests. micro_request and micro_approval adjust the counters in the same transaction
+-- as every occurrence status change.
+
+CREATE TABLE IF NOT EXISTS department_wfh_limit (
+    department VARCHAR(50) PRIMARY KEY,
+    headcount INT NOT NULL,
+    max_ratio REAL NOT NULL DEFAULT 0.5
+);
+
+CREATE TABLE IF NOT EXISTS department_daily_capacity (
+    department VARCHAR(50) NOT NULL,
+    capacity_date DATE NOT NULL,
+    approved_count INT NOT NULL DEFAULT 0,
+    pending_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (department, capacity_date)
+);
+
+-- Half of each department may be out of office on the same day unless HR changes it
+INSERT INTO department_wfh_limit (department, headcount, max_ratio)
+SELECT department, count(*), 0.5 FROM profile GROUP BY department
+ON CONFLICT (department) DO NOTHING;
+
+-- Start the counters from the occurrences that already exist
+INSERT INTO department_daily_capacity (department, capacity_date, approved_count, pending_count)
+SELECT department, occurrence_date,
+       count(*) FILTER (WHERE lower(status) = 'approved'),
+       count(*) FILTER (WHERE lower(status) = 'pending')
+FROM request_occurrence
+WHERE lower(status) IN ('approved', 'pending')
+GROUP BY department, occurrence_date
+ON CONFLICT (department, capacity_date) DO UPDATE
+SET approved_count = EXCLUDED.approved_count, pending_count = EXCLUDED.pending_count;
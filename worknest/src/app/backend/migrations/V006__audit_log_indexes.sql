@@ -0,0 +1,7 @@
+-- Indexes behind the GET /audit_log filters. Each ends in (action_timestamp, log_id), the
+-- keyset the endpoint pages on, so "one department, one month, newest first" is a single
+-- backwards range scan.
+CREATE INDEX IF NOT EXISTS ix_audit_log_timestamp ON audit_log (action_timestamp, log_id);
+CREATE INDEX IF NOT EXISTS ix_audit_log_department_timestamp ON audit_log (department, action_timestamp, log_id);
+CREATE INDEX IF NOT EXISTS ix_audit_log_manager_timestamp ON audit_log (reporting_manager_id, action_timestamp, log_id);
+CREATE INDEX IF NOT EXISTS ix_audit_log_requester_timestamp ON audit_log (requester_email, action_timestamp, log_id);
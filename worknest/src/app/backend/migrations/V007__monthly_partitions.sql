@@ -0,0 +1,121 @@
+-- Monthly range partitioning of request (by start_date) and audit_log (by action_timestamp).
+--
+-- Almost every query touches the current and the next few months, so partitions keep
+-- those indexes small and let old months be detached and archived (see partitions.py).
+-- Partitions are named <table>_YYYYMM; rows outside every monthly partition land in
+-- <table>_default until the month they belong to is created, at which point they move.
+--
+-- PostgreSQL requires the partition key in every primary key and unique index, so:
+--   request   primary key (request_id)         -> (request_id, start_date)
+--   audit_log primary key (log_id)             -> (log_id, action_timestamp)
+--   audit_log unique (request_id)              -> plain index ix_audit_log_request_id;
+--             one log per request is now guaranteed by micro_approval's conditional
+--             UPDATE ... WHERE status = 'pending', not by the database.
+-- The services' models are unchanged: lookups by request_id / log_id still work, they
+-- just probe each partition's index unless the date is also given.
+
+-- Create one monthly partition of a partitioned table, moving any rows for that month out
+-- of the default partition first. Returns the partition name, or NULL if it existed.
+CREATE OR REPLACE FUNCTION create_monthly_partition(parent TEXT, month_start DATE) RETURNS TEXT AS $$
+DECLARE
+    month DATE := date_trunc('month', month_start)::DATE;
+    next_month DATE := (date_trunc('month', month_start) + INTERVAL '1 month')::DATE;
+    partition_name TEXT := parent || '_' || to_char(month_start, 'YYYYMM');
+    partition_key TEXT := substring(pg_get_partkeydef(parent::regclass) FROM '\((.*)\)');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN NULL;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name, parent);
+    IF to_regclass(parent || '_default') IS NOT NULL THEN
+        EXECUTE format('WITH moved AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+                       parent || '_default', partition_key, month, partition_key, next_month, partition_name);
+    END IF;
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', parent, partition_name, month, next_month);
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Make sure every month from from_month up to and including to_month has a partition.
+CREATE OR REPLACE FUNCTION ensure_monthly_partitions(parent TEXT, from_month DATE, to_month DATE) RETURNS SETOF TEXT AS $$
+DECLARE
+    month DATE := date_trunc('month', from_month)::DATE;
+    created TEXT;
+BEGIN
+    WHILE month <= to_month LOOP
+        created := create_monthly_partition(parent, month);
+        IF created IS NOT NULL THEN
+            RETURN NEXT created;
+        END IF;
+        month := (month + INTERVAL '1 month')::DATE;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Rebuild a plain table as a partitioned one with the same columns, data, sequences and
+-- indexes. Does nothing if the table is already partitioned.
+CREATE OR REPLACE FUNCTION partition_by_month(parent TEXT, partition_key TEXT, primary_key TEXT) RETURNS VOID AS $$
+DECLARE
+    old_table TEXT := parent || '_unpartitioned';
+    index_definitions TEXT[];
+    definition TEXT;
+    owned RECORD;
+    first_month DATE;
+    last_month DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = parent::regclass) THEN
+        RETURN;
+    END IF;
+
+    -- Secondary indexes to recreate on the new table; unique ones lose UNIQUE because they
+    -- do not contain the partition key
+    SELECT array_agg(replace(indexdef, 'CREATE UNIQUE INDEX', 'CREATE INDEX'))
+    INTO index_definitions
+    FROM pg_indexes i
+    WHERE i.schemaname = (SELECT relnamespace::regnamespace::TEXT FROM pg_class WHERE oid = parent::regclass)
+      AND i.tablename = parent
+      AND i.indexname <> parent || '_pkey';
+
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', parent, old_table);
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (%I)',
+                   parent, old_table, partition_key);
+    EXECUTE format('ALTER TABLE %I ALTER COLUMN %I SET NOT NULL', parent, partition_key);
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', parent || '_default', parent);
+
+    -- Partitions for the months already in the table and the next six
+    EXECUTE format('SELECT min(%I)::DATE, max(%I)::DATE FROM %I', partition_key, partition_key, old_table)
+    INTO first_month, last_month;
+    PERFORM ensure_monthly_partitions(parent,
+                                      LEAST(COALESCE(first_month, CURRENT_DATE), CURRENT_DATE),
+                                      GREATEST(COALESCE(last_month, CURRENT_DATE), (CURRENT_DATE + INTERVAL '6 months')::DATE));
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I', parent, old_table);
+
+    -- Keep SERIAL sequences alive when the old table goes
+    FOR owned IN
+        SELECT s.oid::regclass::TEXT AS sequence_name, a.attname AS column_name
+        FROM pg_depend d
+        JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+        JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+        WHERE d.refobjid = old_table::regclass AND d.deptype = 'a'
+    LOOP
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', owned.sequence_name);
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I', owned.sequence_name, parent, owned.column_name);
+    END LOOP;
+
+    EXECUTE format('DROP TABLE %I', old_table);
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (%s)', parent, primary_key);
+    IF index_definitions IS NOT NULL THEN
+        FOREACH definition IN ARRAY index_definitions LOOP
+            EXECUTE definition;
+        END LOOP;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+UPDATE audit_log SET action_timestamp = start_date WHERE action_timestamp IS NULL;
+ALTER TABLE audit_log ALTER COLUMN action_timestamp SET NOT NULL;
+
+SELECT partition_by_month('request', 'start_date', 'request_id, start_date');
+SELECT partition_by_month('audit_log', 'action_timestamp', 'log_id, action_timestamp');
+
+ALTER INDEX IF EXISTS audit_log_request_id_key RENAME TO ix_audit_log_request_id;
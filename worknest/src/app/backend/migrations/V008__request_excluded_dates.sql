@@ -0,0 +1,5 @@
+-- Days a request leaves out of its range because they were already covered when it was
+-- submitted with on_overlap=merge, e.g. '2024-03-06,2024-03-07'. micro_request skips them
+-- whenever it rebuilds the request's occurrences, so an update that keeps the dates does
+-- not collide with the request those days were merged into.
+ALTER TABLE request ADD COLUMN IF NOT EXISTS excluded_dates TEXT;
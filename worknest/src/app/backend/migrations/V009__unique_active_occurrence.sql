@@ -0,0 +1,44 @@
+-- One pending or approved day per staff member and date, enforced by the database.
+--
+-- micro_request checks for overlaps before inserting, but two submissions racing for the
+-- same day can both pass that read. A unique partial index over active occurrences makes
+-- the second insert fail, which micro_request answers with 409 like any other overlap.
+--
+-- Days that already clash (submitted before overlaps were checked) are settled first: the
+-- oldest request keeps the day and later requests leave it out, exactly as if they had been
+-- submitted with on_overlap=merge (see V008), with the capacity counters adjusted to match.
+
+CREATE TEMPORARY TABLE duplicate_occurrence ON COMMIT DROP AS
+SELECT occurrence_id, request_id, department, occurrence_date, lower(status) AS status
+FROM (
+    SELECT o.*, row_number() OVER (PARTITION BY staff_id, occurrence_date ORDER BY request_id, occurrence_id) AS rank
+    FROM request_occurrence o
+    WHERE lower(status) IN ('pending', 'approved')
+) ranked
+WHERE rank > 1;
+
+UPDATE request r
+SET excluded_dates = concat_ws(',', r.excluded_dates, d.dates)
+FROM (
+    SELECT request_id, string_agg(DISTINCT occurrence_date::TEXT, ',') AS dates
+    FROM duplicate_occurrence GROUP BY request_id
+) d
+WHERE r.request_id = d.request_id;
+
+UPDATE department_daily_capacity c
+SET approved_count = c.approved_count - d.approved, pending_count = c.pending_count - d.pending
+FROM (
+    SELECT department, occurrence_date,
+           count(*) FILTER (WHERE status = 'approved') AS approved,
+           count(*) FILTER (WHERE status = 'pending') AS pending
+    FROM duplicate_occurrence GROUP BY department, occurrence_date
+) d
+WHERE c.department = d.department AND c.capacity_date = d.occurrence_date;
+
+DELETE FROM request_occurrence WHERE occurrence_id IN (SELECT occurrence_id FROM duplicate_occurrence);
+
+-- Replaces V004's non-unique index on the same columns
+DROP INDEX IF EXISTS ix_request_occurrence_active_staff_date;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_request_occurrence_active_staff_date
+    ON request_occurrence (staff_id, occurrence_date)
+    WHERE lower(status) IN ('pending', 'approved');
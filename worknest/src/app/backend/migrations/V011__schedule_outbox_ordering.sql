@@ -0,0 +1,12 @@
+-- The dispatcher delivers a staff member's schedule changes in order, holding later rows
+-- while an earlier one is undelivered, and gives a row up (dead_at) after too many attempts.
+
+ALTER TABLE schedule_outbox ADD COLUMN IF NOT EXISTS staff_id INT;
+ALTER TABLE schedule_outbox ADD COLUMN IF NOT EXISTS dead_at TIMESTAMP;
+
+UPDATE schedule_outbox SET staff_id = (payload::json->>'staff_id')::int
+WHERE staff_id IS NULL AND delivered_at IS NULL;
+
+-- "Is there an earlier live row for this staff member?" for every row the dispatcher claims
+CREATE INDEX IF NOT EXISTS ix_schedule_outbox_staff_live ON schedule_outbox (staff_id, outbox_id)
+WHERE delivered_at IS NULL AND dead_at IS NULL;
@@ -0,0 +1,91 @@
+# applies the versioned V<number>__<name>.sql files in this folder, in order, once each
+import argparse
+import glob
+import os
+import re
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env'))
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+MIGRATION_FILE = re.compile(r'^V(\d+)__(\w+)\.sql$')
+
+
+def list_migrations():
+    """Return [(version, description, path)] sorted by version."""
+    migrations = []
+    for path in glob.glob(os.path.join(MIGRATIONS_DIR, 'V*.sql')):
+        match = MIGRATION_FILE.match(os.path.basename(path))
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), path))
+    return sorted(migrations)
+
+
+def applied_versions(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(100) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def apply_migrations(connection, target=None):
+    """Apply every pending migration up to target on a DB-API connection.
+
+    Each migration runs in its own transaction together with its schema_migrations row.
+    Returns the versions applied.
+    """
+    cursor = connection.cursor()
+    done = applied_versions(cursor)
+    connection.commit()
+
+    applied = []
+    for version, description, path in list_migrations():
+        if version in done or (target is not None and version > target):
+            continue
+        with open(path) as migration:
+            sql = migration.read()
+        try:
+            cursor.execute(sql)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        print(f"Applied V{version:03d} {description}")
+        applied.append(version)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply database migrations.')
+    parser.add_argument('--target', type=int, help='stop after this version')
+    parser.add_argument('--list', action='store_true', help='show applied and pending migrations')
+    args = parser.parse_args()
+
+    engine = create_engine(os.getenv('SQLALCHEMY_DATABASE_URI'))
+    connection = engine.raw_connection()
+    try:
+        if args.list:
+            done = applied_versions(connection.cursor())
+            connection.commit()
+            for version, description, _ in list_migrations():
+                print(f"V{version:03d} {description}: {'applied' if version in done else 'pending'}")
+            return
+        if not apply_migrations(connection, args.target):
+            print("Database is up to date.")
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
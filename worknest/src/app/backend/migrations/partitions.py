@@ -0,0 +1,150 @@
+# monthly partition maintenance for the tables partitioned by V007: run daily from cron
+import argparse
+import datetime
+import gzip
+import os
+import re
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env'))
+
+PARTITIONED_TABLES = ('request', 'audit_log')
+PARTITION_MONTHS_AHEAD = int(os.getenv('PARTITION_MONTHS_AHEAD') or 6)
+RETENTION_MONTHS = int(os.getenv('RETENTION_MONTHS') or 24)
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive')
+PARTITION_NAME = re.compile(r'^(\w+)_(\d{4})(\d{2})$')
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def month_bounds(partition):
+    """(parent, first day, first day of the next month) from a <table>_YYYYMM name."""
+    match = PARTITION_NAME.match(partition)
+    if not match or match.group(1) not in PARTITIONED_TABLES:
+        raise ValueError(f"{partition} is not a monthly partition of {', '.join(PARTITIONED_TABLES)}")
+    month = datetime.date(int(match.group(2)), int(match.group(3)), 1)
+    return match.group(1), month, add_months(month, 1)
+
+
+def archive_path(partition, archive_dir=None):
+    return os.path.join(archive_dir or ARCHIVE_DIR, f"{partition}.csv.gz")
+
+
+def list_partitions(cursor, parent):
+    """Monthly partitions currently attached to parent, oldest first."""
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (parent,))
+    return sorted(name for name, in cursor.fetchall() if PARTITION_NAME.match(name))
+
+
+def ensure_partitions(connection, months_ahead=None, today=None):
+    """Create any missing partition from this month up to months_ahead months out. Returns the new names."""
+    today = today or datetime.date.today()
+    last = add_months(today.replace(day=1), PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead)
+    cursor = connection.cursor()
+    created = []
+    for parent in PARTITIONED_TABLES:
+        cursor.execute("SELECT ensure_monthly_partitions(%s, %s, %s)", (parent, today, last))
+        created.extend(name for name, in cursor.fetchall())
+    connection.commit()
+    return created
+
+
+def archive_partition(connection, partition, archive_dir=None):
+    """Detach a partition, write it to <archive_dir>/<partition>.csv.gz and drop it.
+
+    Runs in one transaction, so the rows are either in the database or in a complete
+    archive file, never neither. Returns the number of rows archived.
+    """
+    parent = month_bounds(partition)[0]
+    path = archive_path(partition, archive_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cursor = connection.cursor()
+    partial = path + '.partial'
+    try:
+        cursor.execute(f'ALTER TABLE "{parent}" DETACH PARTITION "{partition}"')
+        with gzip.open(partial, 'wb') as archive:
+            cursor.copy_expert(f'COPY "{partition}" TO STDOUT WITH (FORMAT csv, HEADER)', archive)
+        cursor.execute(f'SELECT count(*) FROM "{partition}"')
+        rows = cursor.fetchone()[0]
+        cursor.execute(f'DROP TABLE "{partition}"')
+        os.replace(partial, path)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return rows
+
+
+def restore_partition(connection, partition, archive_dir=None):
+    """Load an archived partition back and attach it. Returns the number of rows restored."""
+    parent, month, next_month = month_bounds(partition)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f'CREATE TABLE "{partition}" (LIKE "{parent}" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        with gzip.open(archive_path(partition, archive_dir), 'rb') as archive:
+            cursor.copy_expert(f'COPY "{partition}" FROM STDIN WITH (FORMAT csv, HEADER)', archive)
+        rows = cursor.rowcount
+        cursor.execute(f'ALTER TABLE "{parent}" ATTACH PARTITION "{partition}" FOR VALUES FROM (%s) TO (%s)',
+                       (month, next_month))
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    return rows
+
+
+def expired_partitions(connection, retention_months=None, today=None):
+    """Partitions whose whole month lies more than retention_months before this month."""
+    today = today or datetime.date.today()
+    cutoff = add_months(today.replace(day=1), -(RETENTION_MONTHS if retention_months is None else retention_months))
+    cursor = connection.cursor()
+    expired = []
+    for parent in PARTITIONED_TABLES:
+        expired.extend(name for name in list_partitions(cursor, parent) if month_bounds(name)[2] <= cutoff)
+    connection.commit()
+    return expired
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create upcoming monthly partitions and archive expired ones.')
+    parser.add_argument('--list', action='store_true', help='show attached partitions and archive files')
+    parser.add_argument('--restore', metavar='PARTITION', help='reattach an archived partition, e.g. request_202301')
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    engine = create_engine(os.getenv('SQLALCHEMY_DATABASE_URI'))
+    connection = engine.raw_connection()
+    try:
+        if args.list:
+            cursor = connection.cursor()
+            for parent in PARTITIONED_TABLES:
+                print(f"{parent}: {', '.join(list_partitions(cursor, parent)) or '-'}")
+            connection.commit()
+            archived = sorted(f for f in os.listdir(args.archive_dir) if f.endswith('.csv.gz')) if os.path.isdir(args.archive_dir) else []
+            print(f"archived: {', '.join(archived) or '-'}")
+            return
+        if args.restore:
+            rows = restore_partition(connection, args.restore, args.archive_dir)
+            print(f"Restored {args.restore} ({rows} rows)")
+            return
+        for name in ensure_partitions(connection):
+            print(f"Created {name}")
+        for name in expired_partitions(connection):
+            rows = archive_partition(connection, name, args.archive_dir)
+            print(f"Archived {name} ({rows} rows) to {archive_path(name, args.archive_dir)}")
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
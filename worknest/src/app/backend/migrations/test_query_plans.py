@@ -0,0 +1,223 @@
+import datetime
+import os
+import re
+import tempfile
+import unittest
+from sqlalchemy import create_engine
+from migrate import apply_migrations, MIGRATIONS_DIR
+from partitions import archive_partition, ensure_partitions, expired_partitions, restore_partition
+
+# Needs a PostgreSQL database, e.g. DATABASE_URI=postgresql://postgres:pw@localhost:5432/postgres
+db_uri = os.getenv('DATABASE_URI', '')
+SCHEMA = 'query_plan_test'
+SMALL_RELATION = 1000  # rows; below this a sequential scan is cheaper than any index
+
+# Existing data, loaded before the migrations run so they have to carry it over
+# (V001 materializes each request's occurrences, V005 counts them)
+SEED_SQL = """
+INSERT INTO request (request_id, staff_id, department, start_date, reason, duration, status,
+                     reporting_manager_id, reporting_manager_name, reporting_manager_email, requester_email)
+SELECT i,
+       100000 + i % 550,
+       (ARRAY['Sales','Engineering','Finance','HR','IT','Consultancy','Solutioning','Accounting'])[1 + i % 8],
+       DATE '2022-01-01' + (i % 1095),
+       'WFH',
+       1 + i % 5,
+       (ARRAY['pending','Approved','Rejected','Withdrawn','Cancelled'])[1 + (i / 7) % 5],
+       140000 + i % 40,
+       'Manager', 'manager@allinone.com.sg', 'staff@allinone.com.sg'
+FROM generate_series(1, 200000) AS i;
+
+-- Overlaps two of the three days of request 4242 (Approved), as allowed before overlaps were checked
+INSERT INTO request (request_id, staff_id, department, start_date, reason, duration, status,
+                     reporting_manager_id, reporting_manager_name, reporting_manager_email, requester_email)
+SELECT 200001, staff_id, department, start_date + 1, reason, duration, 'pending',
+       reporting_manager_id, reporting_manager_name, reporting_manager_email, requester_email
+FROM request WHERE request_id = 4242;
+
+INSERT INTO schedule (staff_id, date, department, status)
+SELECT 100000 + i, DATE '2024-01-01' + (i % 30), 'Sales', 'Approved' FROM generate_series(1, 20000) AS i;
+"""
+
+# Decisions on those requests, logged once the monthly audit_log partitions exist
+AUDIT_LOG_SEED_SQL = """
+INSERT INTO audit_log (request_id, requester_email, action, reporting_manager_id, reporting_manager_email,
+                       start_date, duration, department, approver_comment, action_timestamp)
+SELECT request_id, requester_email, status, reporting_manager_id, reporting_manager_email,
+       start_date, duration, department, '', start_date - interval '3 days' + (request_id % 86400) * interval '1 second'
+FROM request WHERE status IN ('Approved', 'Rejected');
+
+ANALYZE;
+"""
+
+# (index(es) the planner may pick, table that must not be sequentially scanned, query issued by an endpoint)
+HOT_PATH_QUERIES = {
+    'micro_request GET /request/staff/<id>':
+        ('ix_request_staff_id', 'request', "SELECT * FROM request WHERE staff_id = 100042 ORDER BY request_id LIMIT 51"),
+    'micro_request GET /requests/manager/<id>?status=pending':
+        ('ix_request_manager_status', 'request', "SELECT request_id, staff_id, start_date FROM request "
+                    "WHERE reporting_manager_id = 140007 AND lower(status) = 'pending' "
+                    "ORDER BY request_id LIMIT 11"),
+    'micro_request GET /request?department=&start=&end=':
+        (('ix_request_occurrence_department_date',), 'request', "SELECT * FROM request WHERE department = 'Sales' "
+                    "AND start_date <= '2024-03-31' AND request_id IN (SELECT request_id FROM request_occurrence "
+                    "WHERE department = 'Sales' AND occurrence_date >= '2024-03-01' AND occurrence_date <= '2024-03-31')"),
+    'micro_request GET /request?order_by=start_date&cursor=':
+        ('ix_request_start_date', 'request', "SELECT request_id, start_date FROM request "
+                    "WHERE (start_date, request_id) > ('2024-03-01', 5000) "
+                    "ORDER BY start_date, request_id LIMIT 51"),
+    'micro_request withdraw/cancel':
+        (('request_pkey', 'ix_request_staff_id'), 'request', "SELECT * FROM request WHERE request_id = 4242 AND staff_id = 100392 AND status = 'pending'"),
+    'micro_request GET /occurrences?staff_id=&start=&end=':
+        ('ix_request_occurrence_staff_date', 'request_occurrence', "SELECT * FROM request_occurrence WHERE staff_id = 100042 "
+                               "AND occurrence_date BETWEEN '2024-01-01' AND '2024-01-31'"),
+    'micro_request GET /occurrences?department=&date=':
+        ('ix_request_occurrence_department_date', 'request_occurrence', "SELECT * FROM request_occurrence WHERE department = 'Sales' "
+                               "AND occurrence_date = '2024-01-15'"),
+    'micro_request overlap check on submit/update':
+        (('ux_request_occurrence_active_staff_date', 'ix_request_occurrence_active_date'), 'request_occurrence',
+         "SELECT * FROM request_occurrence WHERE staff_id = 100042 "
+         "AND occurrence_date IN ('2024-01-15', '2024-01-16') "
+         "AND lower(status) IN ('pending', 'approved')"),
+    'micro_request GET /wfh?date=':
+        ('ix_request_occurrence_active_date', 'request_occurrence', "SELECT staff_id, request_id FROM request_occurrence "
+                               "WHERE occurrence_date = '2024-01-15' AND lower(status) IN ('approved') ORDER BY staff_id"),
+    'micro_approval status change of a series':
+        ('ix_request_occurrence_request_id', 'request_occurrence', "UPDATE request_occurrence SET status = 'Approved' WHERE request_id = 4242"),
+    'micro_approval approve/reject lookup':
+        ('request_pkey', 'request', "SELECT * FROM request WHERE request_id = 4242"),
+    'micro_approval audit log by request':
+        ('ix_audit_log_request_id', 'audit_log', "SELECT * FROM audit_log WHERE request_id = 4242"),
+    'micro_approval GET /audit_log?department=&from=&to=&limit=':
+        ('ix_audit_log_department_timestamp', 'audit_log', "SELECT * FROM audit_log WHERE department = 'Sales' "
+         "AND action_timestamp >= '2024-03-01' AND action_timestamp < '2024-04-01' "
+         "ORDER BY action_timestamp DESC, log_id DESC LIMIT 51"),
+    'micro_approval GET /audit_log?reporting_manager_id=&cursor=':
+        ('ix_audit_log_manager_timestamp', 'audit_log', "SELECT * FROM audit_log WHERE reporting_manager_id = 140007 "
+         "AND (action_timestamp, log_id) < ('2024-03-01 12:00', 5000) "
+         "ORDER BY action_timestamp DESC, log_id DESC LIMIT 51"),
+    'micro_approval GET /audit_log?department=&from=&to=&count=1':
+        ('ix_audit_log_department_timestamp', 'audit_log', "SELECT count(*) FROM audit_log WHERE department = 'Sales' "
+         "AND action_timestamp >= '2024-03-01' AND action_timestamp < '2024-04-01'"),
+    'micro_schedule GET /schedule/<staff_id>':
+        ('schedule_pkey', 'schedule', "SELECT * FROM schedule WHERE staff_id = 100042 LIMIT 1"),
+}
+
+
+@unittest.skipUnless(db_uri.startswith('postgresql'), 'query plan tests need DATABASE_URI pointing at PostgreSQL')
+class QueryPlanTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_engine(db_uri)
+        cls.connection = cls.engine.raw_connection()
+        cursor = cls.connection.cursor()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+        cursor.execute(f"SET search_path TO {SCHEMA}")
+        with open(os.path.join(MIGRATIONS_DIR, '..', 'worknest.sql')) as schema:
+            cursor.execute(schema.read())
+        cursor.execute(SEED_SQL)
+        cls.connection.commit()
+
+        apply_migrations(cls.connection)
+        # Monthly partitions for the seeded history (V007 only creates them around today)
+        cursor.execute("SELECT ensure_monthly_partitions('request', '2022-01-01', '2024-12-01')")
+        cursor.execute("SELECT ensure_monthly_partitions('audit_log', '2021-12-01', '2024-12-01')")
+        cursor.execute(AUDIT_LOG_SEED_SQL)
+        cls.connection.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cursor = cls.connection.cursor()
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        cls.connection.commit()
+        cls.connection.close()
+        cls.engine.dispose()
+
+    def explain(self, query):
+        cursor = self.connection.cursor()
+        cursor.execute(f"EXPLAIN {query}")
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+        self.connection.rollback()
+        return plan
+
+    def row_estimate(self, relation):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)", (relation,))
+        rows = cursor.fetchone()[0]
+        self.connection.rollback()
+        return rows
+
+    def index_names(self, index):
+        """The index itself plus, on a partitioned table, the per-partition indexes attached to it."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                       "WHERE i.inhparent = to_regclass(%s)", (index,))
+        names = [index] + [row[0] for row in cursor.fetchall()]
+        self.connection.rollback()
+        return names
+
+    def test_hot_paths_use_indexes(self):
+        for endpoint, (index, table, query) in HOT_PATH_QUERIES.items():
+            with self.subTest(endpoint=endpoint):
+                plan = self.explain(query)
+                # A partitioned table is scanned through <table>_YYYYMM / <table>_default; the planner
+                # rightly seq-scans a nearly empty partition, so only sizeable relations count
+                scanned = re.findall(rf"Seq Scan on ({table}(?:_\d{{6}}|_default)?)\b", plan)
+                self.assertEqual([name for name in scanned if self.row_estimate(name) > SMALL_RELATION], [],
+                                 f"{endpoint}\n{plan}")
+                indexes = index if isinstance(index, tuple) else (index,)
+                names = [name for index_name in indexes for name in self.index_names(index_name)]
+                self.assertTrue(any(f" {name} " in plan + " " for name in names), f"{endpoint}\n{plan}")
+
+    def count(self, query):
+        cursor = self.connection.cursor()
+        cursor.execute(query)
+        rows = cursor.fetchone()[0]
+        self.connection.rollback()
+        return rows
+
+    def test_archive_and_restore_partition(self):
+        total = self.count("SELECT count(*) FROM request")
+        in_month = self.count("SELECT count(*) FROM request WHERE start_date < '2022-02-01'")
+        self.assertIn('request_202201', expired_partitions(self.connection, retention_months=24,
+                                                           today=datetime.date(2024, 6, 15)))
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            self.assertEqual(archive_partition(self.connection, 'request_202201', archive_dir), in_month)
+            self.assertTrue(os.path.exists(os.path.join(archive_dir, 'request_202201.csv.gz')))
+            self.assertEqual(self.count("SELECT count(*) FROM request"), total - in_month)
+
+            self.assertEqual(restore_partition(self.connection, 'request_202201', archive_dir), in_month)
+            self.assertEqual(self.count("SELECT count(*) FROM request"), total)
+            self.assertEqual(self.count("SELECT count(*) FROM request WHERE request_id = 7"), 1)
+
+    def test_ensure_partitions_creates_upcoming_months(self):
+        created = ensure_partitions(self.connection, months_ahead=1, today=datetime.date(2030, 1, 20))
+        self.assertEqual(sorted(created), ['audit_log_203001', 'audit_log_203002', 'request_203001', 'request_203002'])
+        self.assertEqual(ensure_partitions(self.connection, months_ahead=1, today=datetime.date(2030, 1, 20)), [])
+
+    def test_existing_requests_are_materialized(self):
+        # Every day of every request has an occurrence, unless V009 left it out as already covered
+        days = self.count("SELECT sum(duration) FROM request")
+        excluded = self.count("SELECT coalesce(sum(array_length(string_to_array(excluded_dates, ','), 1)), 0) FROM request")
+        self.assertEqual(excluded, 2)
+        self.assertEqual(self.count("SELECT count(*) FROM request_occurrence"), days - excluded)
+        self.assertEqual(self.count("SELECT count(*) FROM request_occurrence WHERE request_id = 4242 "
+                                    "AND occurrence_date = (SELECT start_date + duration - 1 FROM request WHERE request_id = 4242)"), 1)
+        # The later of two overlapping requests gives up the shared days
+        self.assertEqual(self.count("SELECT count(*) FROM request WHERE request_id = 200001 AND excluded_dates = "
+                                    "(SELECT concat_ws(',', start_date + 1, start_date + 2) FROM request WHERE request_id = 4242)"), 1)
+        self.assertEqual(self.count("SELECT sum(approved_count + pending_count) FROM department_daily_capacity"),
+                         self.count("SELECT count(*) FROM request_occurrence WHERE lower(status) IN ('approved', 'pending')"))
+
+    def test_request_duration_is_not_indexed(self):
+        # Date windows are answered from request_occurrence, so nothing filters on duration
+        self.assertEqual(self.count("SELECT count(*) FROM pg_indexes WHERE tablename LIKE 'request%' "
+                                    "AND indexdef LIKE '%(duration)%'"), 0)
+
+    def test_migrations_are_idempotent(self):
+        self.assertEqual(apply_migrations(self.connection), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -612,9 +612,25 @@ CREATE TABLE request (
 
     day_id SERIAL NOT NULL,
     days INT[],
-    approver_comment VARCHAR(50)
+    approver_comment VARCHAR(50),
+    recurrence_weekdays VARCHAR(20),               -- e.g. '0,2' = every Monday and Wednesday
+    recurrence_end_date DATE                       -- last day a recurring series may fall on
 );
 
+-- One row per WFH day covered by a request (every day of a recurring series),
+-- written when the request is created so availability queries are index lookups
+CREATE TABLE request_occurrence (
+    occurrence_id SERIAL PRIMARY KEY,
+    request_id INT NOT NULL,
+    staff_id INT NOT NULL,
+    department VARCHAR(50) NOT NULL,
+    occurrence_date DATE NOT NULL,
+    status VARCHAR(50) NOT NULL
+);
+CREATE INDEX ix_request_occurrence_request_id ON request_occurrence (request_id);
+CREATE INDEX ix_request_occurrence_staff_date ON request_occurrence (staff_id, occurrence_date);
+CREATE INDEX ix_request_occurrence_department_date ON request_occurrence (department, occurrence_date);
+
 CREATE table schedule(
     staff_id INT PRIMARY KEY,
     date DATE NOT NULL,